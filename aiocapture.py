@@ -0,0 +1,190 @@
+import asyncio
+import concurrent.futures
+import os
+import percpu
+import traceline
+
+# Live capture on asyncio.  A reader coroutine per pipe (trace_pipe, or every
+# per_cpu/cpuN/trace_pipe) waits for the kernel to tell us there's something to
+# read and pushes what it reads, cut on event boundaries, into one bounded
+# queue.  The parsing, putting the per-cpu streams back in order and the handler
+# run one chunk at a time on a thread of their own, so the event loop is free
+# to keep the pipes drained while the analysis works.
+#
+# When the handler can't keep up the queue fills.  By default the readers then
+# wait, which leaves the events in the kernel buffer where they may get
+# overwritten, with drop set they throw the chunk away instead.  Either way we
+# count it so the caller can tell the results are lossy.
+
+# Readers queue this up when their pipe has nothing more to say for now
+IDLE = "idle"
+
+# Where to cut data so that everything before the cut is whole events.  A
+# <stack trace> event is followed by its " => func" lines, so if the last event
+# in data is one of those we hold it back until we know its stack is done.
+def eventsEnd(data):
+    end = data.rfind(b"\n") + 1
+    if not end:
+        return 0
+    pos = end - 1
+    while pos > 0:
+        start = data.rfind(b"\n", 0, pos) + 1
+        if not data.startswith(b" => ", start):
+            if data.find(b"<stack trace>", start, pos) != -1:
+                return start
+            return end
+        pos = start - 1
+    return end
+
+class AsyncCapture:
+    # paths maps a source name to its pipe, the sources are merged by
+    # timestamp if there's more than one.  handler gets lists of events.
+    def __init__(self, paths, handler, maxChunks=256, drop=False,
+                 readSize=65536, timeout=0.1, unmatched=None):
+        self.paths = paths
+        self.handler = handler
+        self.maxChunks = maxChunks
+        self.drop = drop
+        self.readSize = readSize
+        self.timeout = timeout
+        self.unmatched = unmatched
+        self.queue = None
+        self.executor = concurrent.futures.ThreadPoolExecutor(1)
+        self.merger = None
+        if len(paths) > 1:
+            self.merger = percpu.EventMerger(paths.keys())
+        self.stopping = False
+        # Counters, events handed to the handler, events and chunks we threw
+        # away with drop set, how many times a reader had to wait for room in
+        # the queue, the deepest the queue got, and events that came out of
+        # the per-cpu merge out of order
+        self.events = 0
+        self.dropped = 0
+        self.droppedChunks = 0
+        self.stalls = 0
+        self.maxDepth = 0
+        self.reordered = 0
+
+    # Stop once we've read what's left in the pipes
+    def stop(self):
+        self.stopping = True
+
+    async def _put(self, source, chunk):
+        if self.queue.full():
+            if self.drop and chunk is not IDLE and chunk is not None:
+                self.dropped += chunk.count(b"\n") - chunk.count(b"\n => ")
+                self.droppedChunks += 1
+                return
+            self.stalls += 1
+        await self.queue.put((source, chunk))
+        depth = self.queue.qsize()
+        if depth > self.maxDepth:
+            self.maxDepth = depth
+
+    async def _reader(self, source, path):
+        loop = asyncio.get_running_loop()
+        fd = os.open(path, os.O_RDONLY|os.O_NONBLOCK)
+        ready = asyncio.Event()
+        try:
+            loop.add_reader(fd, ready.set)
+            polled = True
+        except PermissionError:
+            # Regular files can't be polled, but they're always readable
+            polled = False
+        held = b""
+        try:
+            while True:
+                if polled and not self.stopping:
+                    try:
+                        await asyncio.wait_for(ready.wait(), self.timeout)
+                    except asyncio.TimeoutError:
+                        if held:
+                            await self._put(source, held)
+                            held = b""
+                        await self._put(source, IDLE)
+                        continue
+                    ready.clear()
+                try:
+                    chunk = os.read(fd, self.readSize)
+                except BlockingIOError:
+                    if self.stopping:
+                        break
+                    continue
+                if not chunk:
+                    break
+                data = held + chunk
+                end = eventsEnd(data)
+                held = data[end:]
+                if end:
+                    await self._put(source, data[:end])
+                if not polled:
+                    await asyncio.sleep(0)
+        finally:
+            if polled:
+                loop.remove_reader(fd)
+            os.close(fd)
+        if held:
+            if not held.endswith(b"\n"):
+                held += b"\n"
+            await self._put(source, held)
+        await self._put(source, None)
+
+    # Runs on the analysis thread
+    def _process(self, source, chunk):
+        merger = self.merger
+        if chunk is None:
+            if merger:
+                merger.done(source)
+        elif chunk is IDLE:
+            if merger:
+                merger.idle(source)
+        else:
+            batch = list(traceline.scanEvents([(chunk, 0, len(chunk))],
+                                              self.unmatched))
+            if not merger:
+                if batch:
+                    self.events += len(batch)
+                    self.handler(batch)
+                return
+            merger.add(source, batch)
+        if merger:
+            batch = merger.ready()
+            self.reordered = merger.reordered
+            if batch:
+                self.events += len(batch)
+                self.handler(batch)
+
+    # Run func on the analysis thread between two batches, so it can look at
+    # or reset whatever the handler is filling in.
+    async def call(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    async def _consumer(self):
+        running = len(self.paths)
+        while running:
+            source, chunk = await self.queue.get()
+            if chunk is None:
+                running -= 1
+            await self.call(self._process, source, chunk)
+
+    async def run(self):
+        self.queue = asyncio.Queue(self.maxChunks)
+        readers = [asyncio.ensure_future(self._reader(source, path))
+                   for source, path in self.paths.items()]
+        try:
+            await self._consumer()
+        finally:
+            for reader in readers:
+                reader.cancel()
+            await asyncio.gather(*readers, return_exceptions=True)
+            self.executor.shutdown()
+
+    def summary(self):
+        line = ("Captured %d events, queue depth max %d/%d, %d full queue waits" %
+                (self.events, self.maxDepth, self.maxChunks, self.stalls))
+        if self.drop:
+            line += ", dropped %d events in %d chunks" % (self.dropped, self.droppedChunks)
+        if len(self.paths) > 1:
+            line += ", %d out of order" % self.reordered
+        return line
@@ -0,0 +1,336 @@
+#!/bin/python
+
+import aiocapture
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import columnar
+import latency
+import os
+import platform
+import random
+import runpy
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import ftrace
+import percpu
+import report
+import sched
+import stats
+import syscall
+import tracegen
+import traceinput
+import traceline
+
+# Split a trace file up the way the per_cpu/cpuN/trace_pipe files would give
+# it to us, in a fake tracing dir so PerCpuCapture can read it like a live box.
+def splitPerCpu(path, traceDir):
+    outs = {}
+    cpu = None
+    for line in open(path, "r"):
+        trace = traceline.parseLine(line)
+        if trace:
+            cpu = trace.cpu
+        if cpu is None:
+            continue
+        if cpu not in outs:
+            os.makedirs(traceDir+"per_cpu/cpu%d" % cpu)
+            outs[cpu] = open(traceDir+"per_cpu/cpu%d/trace_pipe" % cpu, "w")
+        outs[cpu].write(line)
+    for f in outs.values():
+        f.close()
+    return sorted(outs.keys())
+
+def timeEvents(events):
+    start = time.time()
+    count = 0
+    for trace in events:
+        count += 1
+    return count, time.time() - start
+
+def benchPerCpu(path):
+    results = {}
+    traceDir = tempfile.mkdtemp() + "/"
+    try:
+        cpus = splitPerCpu(path, traceDir)
+        count, elapsed = timeEvents(traceline.readEvents(open(path, "r")))
+        results["single pipe"] = (count, elapsed)
+        files = [traceDir+"per_cpu/cpu%d/trace_pipe" % cpu for cpu in cpus]
+        count, elapsed = timeEvents(percpu.mergeEvents(percpu.openPerCpuFiles(files)))
+        results["per-cpu files, heap merge"] = (count, elapsed)
+        ftrace.setTraceDir(traceDir)
+        capture = percpu.PerCpuCapture(cpus, stop=lambda: True)
+        count, elapsed = timeEvents(capture)
+        results["per-cpu workers, heap merge"] = (count, elapsed)
+    finally:
+        ftrace.setTraceDir("")
+        shutil.rmtree(traceDir)
+    return results
+
+# Sleep ranges the way latencytop feeds them to TimeRange, mostly in time order
+# with the odd overlap, and the same ranges shuffled.
+def benchTimeRange(counts):
+    results = {}
+    for n in counts:
+        rand = random.Random(n)
+        ranges = []
+        now = 0.0
+        for i in range(n):
+            now += rand.random() * 0.001
+            ranges.append((now, now + rand.random() * 0.0015))
+        for order in ("in order", "shuffled"):
+            if order == "shuffled":
+                rand.shuffle(ranges)
+            start = time.time()
+            r = ftrace.TimeRange()
+            for begin, end in ranges:
+                r.addRange(begin, end)
+            r.total
+            results["TimeRange %d %s" % (n, order)] = (n, time.time() - start)
+    return results
+
+# The pytrace report done event by event in Python against the NumPy columns
+def benchColumnar(path):
+    results = {}
+    start = time.time()
+    count = [0]
+    def counted(events):
+        for trace in events:
+            count[0] += 1
+            yield trace
+    syscall.aggregateSyscalls(counted(traceinput.readFile(path)),
+                              stats.StatsTable(), stats.StatsTable())
+    results["python parse+aggregate"] = (count[0], time.time() - start)
+    if not columnar.available():
+        print("numpy isn't installed, skipping the columnar backend")
+        return results
+    start = time.time()
+    cols = columnar.loadSyscalls(traceinput.readFile(path))
+    results["numpy load columns"] = (count[0], time.time() - start)
+    start = time.time()
+    columnar.syscallStats(cols)
+    results["numpy aggregate"] = (len(cols), time.time() - start)
+    return results
+
+# Python's line iterator and readEvents() against the mmapped bytes scanner
+def benchInput(path):
+    results = {}
+    kind = traceinput.compression(path)
+    if kind:
+        f = io.TextIOWrapper(traceinput.openDecompressed(path, kind))
+    else:
+        f = open(path, "r")
+    count, elapsed = timeEvents(traceline.readEvents(f))
+    results["text lines, readEvents"] = (count, elapsed)
+    count, elapsed = timeEvents(traceinput.readFile(path))
+    results["traceinput.readFile"] = (count, elapsed)
+    return results
+
+# The suite.  Every benchmark is a function that does the work and returns how
+# many things it worked through.  It's run once for the time and once more
+# under tracemalloc for the peak memory, tracemalloc slows things down too much
+# to time them with it on.
+def measure(func, memory=True):
+    start = time.time()
+    count = func()
+    result = { "count" : count, "seconds" : time.time() - start }
+    if memory:
+        tracemalloc.start()
+        func()
+        result["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result
+
+def runScript(script, argv):
+    saved = sys.argv
+    sys.argv = [script] + argv
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            runpy.run_path(os.path.join(os.path.dirname(os.path.abspath(__file__)), script),
+                           run_name="__main__")
+    finally:
+        sys.argv = saved
+
+def gitCommit():
+    try:
+        out = subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                      cwd=os.path.dirname(os.path.abspath(__file__)),
+                                      stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.decode().strip()
+
+def benchSuite(events, options, memory=True):
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, "synthetic.trace")
+    try:
+        f = open(path, "w")
+        tracegen.generate(f, events, **options)
+        f.close()
+        lines = open(path, "r").readlines()
+        headers = [line for line in lines if not line.startswith(" => ")]
+        parsed = list(traceline.readEvents(lines))
+        sleeps = []
+        for trace in parsed:
+            if trace.event == "sched_switch":
+                sleeps.append((trace.timestamp, trace.timestamp + 0.0001))
+
+        def parseLines():
+            for line in headers:
+                traceline.traceParseLine(line)
+            return len(headers)
+
+        def readEvents():
+            return sum(1 for trace in traceline.readEvents(lines))
+
+        def readFile():
+            return sum(1 for trace in traceinput.readFile(path))
+
+        def pairing():
+            syscall.aggregateSyscalls(parsed, stats.StatsTable(), stats.StatsTable())
+            return len(parsed)
+
+        def addRanges():
+            r = ftrace.TimeRange()
+            for begin, end in sleeps:
+                r.addRange(begin, end)
+            r.total
+            return len(sleeps)
+
+        calls = stats.StatsTable()
+        pids = stats.StatsTable()
+        syscall.aggregateSyscalls(parsed, calls, pids)
+        def pytraceReport():
+            rows = report.latencyRows("Call", calls) + report.latencyRows("Pid", pids)
+            with contextlib.redirect_stdout(io.StringIO()):
+                report.printTable(rows)
+            return len(calls) + len(pids)
+
+        def analyzer():
+            latency.Analyzer().addEvents(parsed)
+            return len(parsed)
+
+        analyzed = latency.Analyzer()
+        analyzed.addEvents(parsed)
+        def latencytopReport():
+            with contextlib.redirect_stdout(io.StringIO()):
+                latency.printSummary(analyzed)
+            return len(analyzed.processes)
+
+        def asyncCapture():
+            capture = aiocapture.AsyncCapture({ "trace" : path },
+                                              latency.Analyzer().addEvents)
+            asyncio.run(capture.run())
+            return capture.events
+
+        def latencytop():
+            runScript("latencytop.py", ["--no-cache", path])
+            return len(parsed)
+
+        def pytrace():
+            runScript("pytrace.py", ["--no-cache", "--pids", path])
+            return len(parsed)
+
+        benches = [
+            ("traceParseLine", parseLines),
+            ("readEvents", readEvents),
+            ("traceinput.readFile", readFile),
+            ("Syscall pairing", pairing),
+            ("TimeRange.addRange", addRanges),
+            ("pytrace report", pytraceReport),
+            ("latency.Analyzer", analyzer),
+            ("latencytop report", latencytopReport),
+            ("AsyncCapture+Analyzer", asyncCapture),
+            ("pytrace", pytrace),
+            ("latencytop", latencytop),
+        ]
+        results = {}
+        for name, func in benches:
+            results[name] = measure(func, memory)
+    finally:
+        shutil.rmtree(tmp)
+    return {
+        "commit" : gitCommit(),
+        "python" : platform.python_version(),
+        "events" : events,
+        "generator" : options,
+        "results" : results,
+    }
+
+def printSuite(suite):
+    for name, r in suite["results"].items():
+        line = "%-22s %10d %8.2f seconds %10.0f /sec" % \
+               (name, r["count"], r["seconds"], r["count"] / max(r["seconds"], 1e-9))
+        if "peak_bytes" in r:
+            line += " %10.1f MB peak" % (r["peak_bytes"] / 1048576.0)
+        print(line)
+
+# Side by side of two suite runs, the ratios are new/old so anything over 1 got
+# slower or bigger
+def compareSuites(old, new):
+    print("%-22s %10s %10s %7s %10s %10s %7s" %
+          ("", "old s", "new s", "ratio", "old MB", "new MB", "ratio"))
+    for name, n in new["results"].items():
+        o = old["results"].get(name)
+        if o is None:
+            continue
+        line = "%-22s %10.2f %10.2f %7.2f" % (name, o["seconds"], n["seconds"],
+                                              n["seconds"] / max(o["seconds"], 1e-9))
+        if "peak_bytes" in o and "peak_bytes" in n:
+            line += " %10.1f %10.1f %7.2f" % (o["peak_bytes"] / 1048576.0,
+                                              n["peak_bytes"] / 1048576.0,
+                                              n["peak_bytes"] / float(max(o["peak_bytes"], 1)))
+        print(line)
+
+def printResults(results):
+    for name in results:
+        count, elapsed = results[name]
+        print("%-30s %10d events %8.2f seconds %10.0f events/sec" %
+              (name, count, elapsed, count / elapsed))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark trace processing")
+    sub = parser.add_subparsers(dest="bench")
+    p = sub.add_parser("percpu", help="Single pipe vs per-cpu merged reading")
+    p.add_argument('infile', help='Trace file to use as input')
+    p = sub.add_parser("columnar", help="Python vs NumPy syscall report")
+    p.add_argument('infile', help='Syscall trace file to use as input')
+    p = sub.add_parser("input", help="Reading text vs the bytes scanner")
+    p.add_argument('infile', help='Trace file to use as input, can be compressed')
+    p = sub.add_parser("suite", help="Time and memory profile everything on a synthetic trace")
+    tracegen.addArguments(p)
+    p.add_argument('--json', type=str, help="Save the results here")
+    p.add_argument('--no-memory', action='store_true', help="Skip the tracemalloc runs")
+    p = sub.add_parser("compare", help="Compare two saved suite runs")
+    p.add_argument('old', help="JSON from the baseline run")
+    p.add_argument('new', help="JSON from the run to check")
+    p = sub.add_parser("timerange", help="TimeRange.addRange")
+    p.add_argument('-n', type=int, action='append',
+                   help="Number of ranges, can be given more than once")
+    args = parser.parse_args()
+    if args.bench == "percpu":
+        printResults(benchPerCpu(args.infile))
+    elif args.bench == "columnar":
+        printResults(benchColumnar(args.infile))
+    elif args.bench == "input":
+        printResults(benchInput(args.infile))
+    elif args.bench == "suite":
+        suite = benchSuite(args.events, tracegen.generatorOptions(args),
+                           not args.no_memory)
+        printSuite(suite)
+        if args.json:
+            f = open(args.json, "w")
+            json.dump(suite, f, indent=2, sort_keys=True)
+            f.close()
+    elif args.bench == "compare":
+        compareSuites(json.load(open(args.old)), json.load(open(args.new)))
+    elif args.bench == "timerange":
+        printResults(benchTimeRange(args.n or [100000, 1000000]))
+    else:
+        parser.print_help()
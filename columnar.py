@@ -0,0 +1,186 @@
+import array
+import math
+import stats
+import syscall
+
+# numpy is only imported once somebody asks for this backend, it's a big
+# import for every run that never uses it
+numpy = None
+
+# Optional NumPy backend for the offline syscall report.  The events are read
+# once into flat columns, and pairing up enters and exits, the latencies and
+# the per-syscall/per-pid group-bys are done on whole arrays rather than one
+# event at a time.  The groups come out as the same stats.Histograms the
+# Python path builds, so the report code doesn't know the difference.
+
+ENTER = 1
+EXIT = 2
+
+def available():
+    global numpy
+    if numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            return False
+    return True
+
+# Columns for the syscall events of a trace.  key is the syscall number for
+# the raw_syscalls events and an index into names for the per-syscall events,
+# raw tells us which one it is.
+class SyscallColumns:
+    def __init__(self):
+        self.timestamp = array.array("d")
+        self.pid = array.array("q")
+        self.cpu = array.array("q")
+        self.kind = array.array("b")
+        self.raw = array.array("b")
+        self.key = array.array("q")
+        self.names = []
+        self.nameIds = {}
+
+    def __len__(self):
+        return len(self.timestamp)
+
+    def nameId(self, name):
+        try:
+            return self.nameIds[name]
+        except KeyError:
+            i = self.nameIds[name] = len(self.names)
+            self.names.append(name)
+            return i
+
+    def add(self, trace):
+        event = trace.fields
+        if isinstance(event, syscall.SyscallEnter):
+            kind = ENTER
+        elif isinstance(event, syscall.SyscallExit):
+            kind = EXIT
+        else:
+            return
+        if event.nr is not None:
+            self.raw.append(1)
+            self.key.append(event.nr)
+        else:
+            self.raw.append(0)
+            self.key.append(self.nameId(event.name))
+        self.kind.append(kind)
+        self.timestamp.append(trace.timestamp)
+        self.pid.append(trace.pid)
+        self.cpu.append(trace.cpu)
+
+    def column(self, name):
+        col = getattr(self, name)
+        return numpy.frombuffer(col, dtype=col.typecode)
+
+def loadSyscalls(events, cols=None):
+    if cols is None:
+        cols = SyscallColumns()
+    for trace in events:
+        cols.add(trace)
+    return cols
+
+# The report name of every event, syscall numbers go through the syscall
+# table once per distinct number.
+def reportNames(cols, raw, key):
+    names = list(cols.names)
+    ids = key.copy()
+    nrs = numpy.unique(key[raw == 1])
+    if len(nrs):
+        nameIds = dict((name, i) for i, name in enumerate(names))
+        mapping = numpy.empty(len(nrs), dtype=numpy.int64)
+        for i, nr in enumerate(nrs):
+            name = syscall.getSyscallName(int(nr))
+            if name not in nameIds:
+                nameIds[name] = len(names)
+                names.append(name)
+            mapping[i] = nameIds[name]
+        israw = raw == 1
+        ids[israw] = mapping[numpy.searchsorted(nrs, key[israw])]
+    return ids, names
+
+# Pair every exit with its enter, the same rules as Syscall.syscallExit(): the
+# exit has to directly follow an enter of the same pid (a later enter replaces
+# an earlier one, and any exit clears it) for the same syscall, except that
+# rt_sigreturn comes back as NR -1.  Returns the indexes of the enters and
+# exits and the report names.
+def pairSyscalls(cols):
+    kind = cols.column("kind")
+    raw = cols.column("raw")
+    key = cols.column("key")
+    pid = cols.column("pid")
+    nameIds, names = reportNames(cols, raw, key)
+    order = numpy.argsort(pid, kind="stable")
+    prev = order[:-1]
+    cur = order[1:]
+    match = ((pid[prev] == pid[cur]) & (kind[prev] == ENTER) &
+             (kind[cur] == EXIT) & (raw[prev] == raw[cur]))
+    same = key[prev] == key[cur]
+    if "rt_sigreturn" in names:
+        sigreturn = names.index("rt_sigreturn")
+        same |= (raw[cur] == 1) & (key[cur] == -1) & (nameIds[prev] == sigreturn)
+    match &= same
+    enters = prev[match]
+    exits = cur[match]
+    # Back into file order, so groups show up in the order the Python path
+    # sees them
+    o = numpy.argsort(exits, kind="stable")
+    return enters[o], exits[o], nameIds, names
+
+# Histogram per distinct value of keys, keyed by label(value) and in the order
+# the keys first show up.
+def groupStats(keys, values, label):
+    h = stats.Histogram
+    o = numpy.argsort(keys, kind="stable")
+    k = keys[o]
+    v = values[o]
+    if not len(k):
+        return stats.StatsTable()
+    starts = numpy.flatnonzero(numpy.r_[True, k[1:] != k[:-1]])
+    ends = numpy.r_[starts[1:], len(k)]
+    mins = numpy.minimum.reduceat(v, starts)
+    maxs = numpy.maximum.reduceat(v, starts)
+    zero = v < h.lowest
+    m, e = numpy.frexp(v)
+    buckets = e.astype(numpy.int64) * h.subBuckets + \
+              ((m - 0.5) * 2 * h.subBuckets).astype(numpy.int64)
+    # first[i] is where group i first showed up in the original order
+    first = o[starts]
+    groups = []
+    for i in range(len(starts)):
+        s, end = starts[i], ends[i]
+        hist = h()
+        hist.count = int(end - s)
+        hist.min = float(mins[i])
+        hist.max = float(maxs[i])
+        hist.partials = [math.fsum(v[s:end])]
+        z = zero[s:end]
+        hist.zeros = int(z.sum())
+        idx, counts = numpy.unique(buckets[s:end][~z], return_counts=True)
+        hist.buckets = dict(zip(idx.tolist(), counts.tolist()))
+        groups.append((first[i], label(k[s]), hist))
+    groups.sort(key=lambda g: g[0])
+    table = stats.StatsTable()
+    for f, name, hist in groups:
+        table[name] = hist
+    return table
+
+# The per-syscall and per-pid tables pytrace prints.  Only calls that exit at
+# row first or later count, the rows before it are only there to pair up
+# with, like the lookback before a --from window.
+def syscallStats(cols, first=0):
+    if not available():
+        raise ImportError("the columnar backend needs numpy")
+    if not len(cols):
+        return stats.StatsTable(), stats.StatsTable()
+    timestamp = cols.column("timestamp")
+    pid = cols.column("pid")
+    enters, exits, nameIds, names = pairSyscalls(cols)
+    if first:
+        inside = exits >= first
+        enters = enters[inside]
+        exits = exits[inside]
+    runtime = timestamp[exits] - timestamp[enters]
+    calls = groupStats(nameIds[enters], runtime, lambda i: names[i])
+    pids = groupStats(pid[exits], runtime, int)
+    return calls, pids
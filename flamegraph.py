@@ -0,0 +1,174 @@
+#!/bin/python
+
+import argparse
+import sys
+import zlib
+from xml.sax.saxutils import escape
+import stacks
+
+# Off-cpu flame graphs out of what a latency.Analyzer aggregated.  Stacks are
+# folded the way flamegraph.pl and friends want them, "comm;outer;...;inner
+# weight" a line, with the weight either the time spent asleep in that stack
+# or how many times a wakeup came from it.  We can render those ourselves into
+# a standalone SVG, so a big capture can be looked at without going back to
+# the trace or having anything else installed.
+
+weight_choices = ["sleep", "wakeups"]
+
+# Units of the weights, sleep time goes out as integer microseconds since
+# that's what the folded format tools expect
+weight_units = { "sleep" : "us", "wakeups" : "wakeups" }
+
+def processName(process):
+    if process.collapsed:
+        return process.comm
+    return "%s-%d" % (process.comm, process.pid)
+
+# folded stack string -> weight for every stack of every process
+def foldStacks(analyzer, weight="sleep"):
+    table = analyzer.stackTable
+    folded = {}
+    for process in analyzer.processes.values():
+        if weight == "sleep":
+            items = [(stack, int(round(ranges.total * 1000000)))
+                     for stack, ranges in process.stacks.items()]
+        else:
+            # Sleeps we never saw the wakeup for aren't wakeups
+            items = [(stack, n) for stack, n in process.wakeups.items()
+                     if stack != stacks.EMPTY]
+        name = processName(process).replace(";", ":")
+        for stack, value in items:
+            if value <= 0:
+                continue
+            # Stack traces come innermost first, folded stacks the other way
+            frames = table.frames(stack)
+            if not frames:
+                frames = ["[unknown]"]
+            key = ";".join([name] + [f.replace(";", ":") for f in reversed(frames)])
+            folded[key] = folded.get(key, 0) + value
+    return folded
+
+def writeFolded(out, folded):
+    for key in sorted(folded):
+        out.write("%s %d\n" % (key, folded[key]))
+
+def readFolded(f):
+    folded = {}
+    for line in f:
+        key, sep, value = line.rstrip("\n").rpartition(" ")
+        if not sep:
+            continue
+        try:
+            value = int(float(value))
+        except ValueError:
+            continue
+        folded[key] = folded.get(key, 0) + value
+    return folded
+
+class Frame:
+    def __init__(self, name):
+        self.name = name
+        self.value = 0
+        self.children = {}
+
+def buildTree(folded):
+    root = Frame("all")
+    for key, value in folded.items():
+        node = root
+        node.value += value
+        for name in key.split(";"):
+            child = node.children.get(name)
+            if child is None:
+                child = node.children[name] = Frame(name)
+            child.value += value
+            node = child
+    return root
+
+def treeDepth(node):
+    if not node.children:
+        return 1
+    return 1 + max(treeDepth(child) for child in node.children.values())
+
+# The usual warm flame graph colours, picked off the name so the same function
+# is the same colour in every graph
+def frameColor(name):
+    h = zlib.crc32(name.encode("utf-8", "replace"))
+    return "rgb(%d,%d,%d)" % (205 + h % 50, (h >> 8) % 230, (h >> 16) % 55)
+
+class SvgRenderer:
+    def __init__(self, width=1200, frameHeight=16, fontSize=12, minWidth=0.1,
+                 title="Off-CPU Flame Graph", units=""):
+        self.width = width
+        self.frameHeight = frameHeight
+        self.fontSize = fontSize
+        self.minWidth = minWidth
+        self.title = title
+        self.units = units
+        self.pad = 10
+        self.top = 3 * fontSize
+
+    def render(self, out, folded):
+        root = buildTree(folded)
+        depth = treeDepth(root)
+        height = self.top + depth * self.frameHeight + 2 * self.pad
+        out.write('<?xml version="1.0" standalone="no"?>\n')
+        out.write('<svg version="1.1" width="%d" height="%d" viewBox="0 0 %d %d" '
+                  'xmlns="http://www.w3.org/2000/svg">\n' %
+                  (self.width, height, self.width, height))
+        out.write('<rect x="0" y="0" width="100%%" height="100%%" fill="#f8f8f8"/>\n')
+        out.write('<text x="%d" y="%d" font-size="%d" font-family="Verdana" '
+                  'text-anchor="middle">%s</text>\n' %
+                  (self.width // 2, self.fontSize * 2, self.fontSize + 5,
+                   escape(self.title)))
+        if root.value:
+            self.scale = (self.width - 2.0 * self.pad) / root.value
+            self.total = float(root.value)
+            self.bottom = height - self.pad
+            self.drawFrame(out, root, self.pad, 0)
+        out.write('</svg>\n')
+
+    def drawFrame(self, out, node, x, depth):
+        width = node.value * self.scale
+        if width < self.minWidth:
+            return
+        y = self.bottom - (depth + 1) * self.frameHeight
+        info = "%s (%d %s, %.2f%%)" % (node.name, node.value, self.units,
+                                       node.value * 100.0 / self.total)
+        out.write('<g><title>%s</title>' % escape(info))
+        out.write('<rect x="%.1f" y="%d" width="%.1f" height="%d" fill="%s" rx="2" ry="2"/>' %
+                  (x, y, width, self.frameHeight - 1, frameColor(node.name)))
+        # Roughly how many characters fit, anything that doesn't gets cut
+        chars = int(width / (self.fontSize * 0.6))
+        if chars >= 3:
+            text = node.name
+            if len(text) > chars:
+                text = text[:chars - 2] + ".."
+            out.write('<text x="%.1f" y="%d" font-size="%d" font-family="Verdana">%s</text>' %
+                      (x + 3, y + self.frameHeight - 4, self.fontSize, escape(text)))
+        out.write('</g>\n')
+        # Children left to right by name, like flamegraph.pl
+        for name in sorted(node.children):
+            child = node.children[name]
+            self.drawFrame(out, child, x, depth + 1)
+            x += child.value * self.scale
+
+def writeSvg(out, folded, title="Off-CPU Flame Graph", units="", **kw):
+    SvgRenderer(title=title, units=units, **kw).render(out, folded)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render folded stacks as an SVG flame graph")
+    parser.add_argument('infile', nargs='?', help="Folded stacks, stdin if not given")
+    parser.add_argument('-o', '--output', type=str, help="Write here instead of stdout")
+    parser.add_argument('--title', type=str, default="Flame Graph")
+    parser.add_argument('--units', type=str, default="", help="What the weights count")
+    parser.add_argument('--width', type=int, default=1200)
+    args = parser.parse_args()
+    infile = sys.stdin
+    if args.infile:
+        infile = open(args.infile, "r")
+    out = sys.stdout
+    if args.output:
+        out = open(args.output, "w")
+    writeSvg(out, readFolded(infile), args.title, args.units, width=args.width)
+    if args.output:
+        out.close()
@@ -1,118 +1,1038 @@
 import re
+import os
+import struct
+import atexit
+import bisect
+import heapq
+import select
+import time
+import traceline
 
 class Ftrace:
     pass
 
 __m = Ftrace()
 __m.traceDir = ""
+# The top of the tracing dir when traceDir is one of its instances, and the
+# TraceSession the helpers below go through if there is one
+__m.rootDir = ""
+__m.session = None
+
+def writeFile(path, value):
+    try:
+        f = open(path, 'w')
+        f.write(value)
+        f.close()
+    except (IOError, OSError):
+        return False
+    return True
+
+# Every setting we change goes through here, so an open TraceSession gets to
+# batch it up and remember what to put back.
+def writeSetting(name, value):
+    if __m.session is not None:
+        return __m.session.set(name, value)
+    return writeFile(getTraceDir()+name, value)
 
 def enableEvent(event):
-    traceDir = getTraceDir()
-    eventFile = open(traceDir+"events/"+event+"/enable", 'w')
-    eventFile.write("1")
-    eventFile.close()
+    return writeSetting("events/"+event+"/enable", "1")
 
 def disableEvent(event):
-    traceDir = getTraceDir()
-    eventFile = open(traceDir+"events/"+event+"/enable", 'w')
-    eventFile.write("0")
-    eventFile.close()
+    return writeSetting("events/"+event+"/enable", "0")
 
 def enableStackTrace():
-    traceDir = getTraceDir()
-    eventFile = open(traceDir+"options/stacktrace", 'w')
-    eventFile.write("1")
-    eventFile.close()
+    return writeSetting("options/stacktrace", "1")
 
 def disableStackTrace():
-    traceDir = getTraceDir()
-    eventFile = open(traceDir+"options/stacktrace", 'w')
-    eventFile.write("0")
-    eventFile.close()
+    return writeSetting("options/stacktrace", "0")
 
 def clearTraceBuffer():
-    traceDir = getTraceDir()
-    traceFile = open(traceDir+"trace", 'w')
-    traceFile.write("")
-    traceFile.close()
+    return writeSetting("trace", "")
 
 def filterPid(pid):
-    traceDir = getTraceDir()
-    try:
-        traceFile = open(traceDir+"set_ftrace_pid", 'w')
-    except:
-        # Older kernels don't have set_ftrace_pid, losers
-        return
-    traceFile.write(str(pid))
-    traceFile.close()
+    # Older kernels don't have set_ftrace_pid, losers
+    if not os.path.exists(getTraceDir()+"set_ftrace_pid"):
+        return False
+    return writeSetting("set_ftrace_pid", str(pid))
 
 def clearFilterPid():
+    if not os.path.exists(getTraceDir()+"set_ftrace_pid"):
+        return False
+    return writeSetting("set_ftrace_pid", "")
+
+# Trace event filters.  set_ftrace_pid only applies to the function tracer, to
+# keep the kernel from handing us events we're going to throw away anyway we
+# have to use the per event filter files and set_event_pid.  The kernel may be
+# too old for either, or not like the expression we give it, so these return
+# False when the filter didn't stick and the caller has to keep filtering
+# itself (which callers should be doing anyway).
+
+# "prev_pid == 1 || next_pid == 1" for every field/value pair
+def fieldFilter(fields, op, values):
+    exprs = []
+    for field in fields:
+        for value in values:
+            if isinstance(value, str):
+                value = '"%s"' % value
+            exprs.append("%s %s %s" % (field, op, value))
+    return " || ".join(exprs)
+
+def pidFilter(fields, pids):
+    return fieldFilter(fields, "==", pids)
+
+# Substring match on a comm, the same as the comm.find(name) checks we do
+def commFilter(fields, comm):
+    return fieldFilter(fields, "~", ["*%s*" % comm])
+
+def andFilters(exprs):
+    if len(exprs) == 1:
+        return exprs[0]
+    return " && ".join("(%s)" % expr for expr in exprs)
+
+def setEventFilter(event, expr):
+    return writeSetting("events/"+event+"/filter", expr)
+
+def clearEventFilter(event):
+    return setEventFilter(event, "0")
+
+# Only trace events for these pids.  sched_switch and sched_wakeup get special
+# treatment, they pass if either side of the switch/wakeup is one of ours.
+# With fork the children of the pids are added as they're created.
+def filterEventPids(pids, fork=False):
     traceDir = getTraceDir()
-    try:
-        traceFile = open(traceDir+"set_ftrace_pid", 'w')
-    except:
-        # Older kernels don't have set_ftrace_pid
+    if not os.path.exists(traceDir+"set_event_pid"):
+        return False
+    if not writeSetting("set_event_pid", " ".join(str(pid) for pid in pids)):
+        return False
+    if fork:
+        return writeSetting("options/event-fork", "1")
+    return True
+
+# Only sched_switch/sched_wakeup events that pid or a task with name in its comm
+# had a hand in.  The pid goes into set_event_pid if the kernel has it and the
+# event filters if it doesn't, except with fork where a pid filter would lose
+# the children, so then we leave it to the caller.
+def filterSchedEvents(pid=None, name=None, fork=False):
+    switch = []
+    wakeup = []
+    if pid and not filterEventPids([pid], fork) and not fork:
+        switch.append(pidFilter(["prev_pid", "next_pid"], [pid]))
+        wakeup.append(pidFilter(["pid"], [pid]))
+    if name:
+        switch.append(commFilter(["prev_comm", "next_comm"], name))
+        wakeup.append(commFilter(["comm"], name))
+    if switch:
+        setEventFilter("sched/sched_switch", andFilters(switch))
+        setEventFilter("sched/sched_wakeup", andFilters(wakeup))
+
+def clearEventPids():
+    traceDir = getTraceDir()
+    if not os.path.exists(traceDir+"set_event_pid"):
         return
-    traceFile.write("")
-    traceFile.close()
+    writeSetting("set_event_pid", "")
+    if os.path.exists(traceDir+"options/event-fork"):
+        writeSetting("options/event-fork", "0")
 
 def enableFtrace():
-    traceDir = getTraceDir()
-    traceFile = open(traceDir+"tracing_on", 'w')
-    traceFile.write("1")
-    traceFile.close()
+    return writeSetting("tracing_on", "1")
 
 def disableFtrace():
+    return writeSetting("tracing_on", "0")
+
+def getCpus():
     traceDir = getTraceDir()
-    traceFile = open(traceDir+"tracing_on", 'w')
-    traceFile.write("0")
-    traceFile.close()
+    cpus = []
+    try:
+        names = os.listdir(traceDir+"per_cpu")
+    except OSError:
+        return cpus
+    for name in names:
+        if name.startswith("cpu") and name[3:].isdigit():
+            cpus.append(int(name[3:]))
+    cpus.sort()
+    return cpus
 
-def getTraceDir():
-    if __m.traceDir != "":
-        return __m.traceDir
-    f = open("/proc/mounts", "r")
-    mounts_re = re.compile("([a-zA-Z0-9_/\-,\.:]+) ([a-zA-Z0-9_/\-,\.:]+) (\w+) .*")
+# Ring buffer sizes.  buffer_size_kb at the top of the tracing dir sets every
+# cpu's buffer, reading it gives "X" if the cpus differ, and before anything
+# has been traced it says "7 (expanded: 1408)".  The per_cpu ones are per cpu.
+def bufferSizePath(cpu=None):
+    if cpu is None:
+        return getTraceDir()+"buffer_size_kb"
+    return getTraceDir()+"per_cpu/cpu%d/buffer_size_kb" % cpu
+
+def getBufferSizeKb(cpu=None):
+    try:
+        f = open(bufferSizePath(cpu), 'r')
+        value = f.read()
+        f.close()
+    except (IOError, OSError):
+        return None
+    m = re.search(r"expanded: (\d+)", value)
+    if m:
+        return int(m.group(1))
+    try:
+        return int(value.split()[0])
+    except (ValueError, IndexError):
+        return None
+
+def setBufferSizeKb(kb, cpu=None):
+    name = "buffer_size_kb"
+    if cpu is not None:
+        name = "per_cpu/cpu%d/buffer_size_kb" % cpu
+    return writeSetting(name, str(int(kb)))
+
+# per_cpu/cpuN/stats, "overrun: 12" and friends.  Counters come back as ints,
+# the "oldest event ts"/"now ts" ones as seconds.
+def readCpuStats(cpu):
+    stats = {}
+    try:
+        f = open(getTraceDir()+"per_cpu/cpu%d/stats" % cpu, 'r')
+        lines = f.readlines()
+        f.close()
+    except (IOError, OSError):
+        return stats
+    for line in lines:
+        name, sep, value = line.partition(":")
+        if not sep:
+            continue
+        value = value.strip()
+        try:
+            if name.endswith(" ts"):
+                stats[name] = float(value)
+            else:
+                stats[name] = int(value)
+        except ValueError:
+            pass
+    return stats
+
+# Events every cpu wrote since we started watching that didn't make it to us
+overrun_counters = ("overrun", "commit overrun", "dropped events")
+
+# Watches the ring buffer stats of every cpu while we trace.  sample() picks up
+# how many events got overwritten (overrun) or never made it in (commit
+# overrun, dropped events) since we started, and with auto set grows any
+# buffer that doesn't hold headroom seconds of events at the rate that cpu
+# has been writing them.  restore() puts the sizes back the way we found them.
+#
+# sample() isn't safe to run from two threads at once, so only call it from
+# one.  summary() and lost() only look at what the last sample() found, so
+# they can be called from anywhere.
+class BufferMonitor:
+    def __init__(self, cpus=None, auto=False, headroom=1.0, maxKb=262144):
+        if cpus is None:
+            cpus = getCpus()
+        self.cpus = cpus
+        self.auto = auto
+        self.headroom = headroom
+        self.maxKb = maxKb
+        self.sizes = dict((cpu, getBufferSizeKb(cpu)) for cpu in cpus)
+        self.original = dict(self.sizes)
+        self.resizes = 0
+        self.reset()
+
+    # Count from here, clearing the trace buffer resets the kernel's counters
+    # so this wants calling after that
+    def reset(self):
+        self.start = dict((cpu, readCpuStats(cpu)) for cpu in self.cpus)
+        self.last = dict(self.start)
+        self.lastTime = time.time()
+        self.rates = dict((cpu, 0.0) for cpu in self.cpus)
+        self.totals = dict((name, 0) for name in overrun_counters)
+
+    def resize(self, kb):
+        for cpu in self.cpus:
+            if setBufferSizeKb(kb, cpu):
+                self.sizes[cpu] = kb
+
+    # Events written to a buffer so far, whether they're still in there, got
+    # read or got overwritten
+    @staticmethod
+    def written(stats):
+        return stats.get("entries", 0) + stats.get("overrun", 0) + stats.get("read events", 0)
+
+    def sample(self):
+        now = time.time()
+        elapsed = now - self.lastTime
+        for cpu in self.cpus:
+            stats = readCpuStats(cpu)
+            last = self.last[cpu]
+            self.last[cpu] = stats
+            if elapsed <= 0:
+                continue
+            self.rates[cpu] = max(0, self.written(stats) - self.written(last)) / elapsed
+            if self.auto:
+                lost = stats.get("overrun", 0) > last.get("overrun", 0)
+                self.grow(cpu, stats, lost)
+        self.lastTime = now
+        self.totals = self.overruns()
+        return self.totals
+
+    def grow(self, cpu, stats, lost):
+        size = self.sizes[cpu]
+        if not size:
+            return
+        perEvent = 64.0
+        if stats.get("entries"):
+            perEvent = float(stats.get("bytes", 0)) / stats["entries"] or perEvent
+        want = self.rates[cpu] * perEvent * self.headroom / 1024
+        if lost:
+            want = max(want, size * 2)
+        if want <= size:
+            return
+        kb = size
+        while kb < want:
+            kb *= 2
+        kb = min(kb, self.maxKb)
+        if kb > size and setBufferSizeKb(kb, cpu):
+            self.sizes[cpu] = kb
+            self.resizes += 1
+
+    # Totals of overrun_counters across every cpu
+    def overruns(self):
+        totals = dict((name, 0) for name in overrun_counters)
+        for cpu in self.cpus:
+            for name in overrun_counters:
+                totals[name] += max(0, self.last[cpu].get(name, 0) -
+                                    self.start[cpu].get(name, 0))
+        return totals
+
+    def lost(self):
+        return sum(self.totals.values())
+
+    def restore(self):
+        for cpu, kb in self.original.items():
+            if kb and self.sizes[cpu] != kb:
+                setBufferSizeKb(kb, cpu)
+                self.sizes[cpu] = kb
+
+    def summary(self):
+        totals = self.totals
+        line = ("Ring buffer: %d overwritten, %d commit overruns, %d dropped events" %
+                (totals["overrun"], totals["commit overrun"], totals["dropped events"]))
+        if self.resizes:
+            line += ", resized %d times, now %s kb" % \
+                    (self.resizes, ",".join(str(self.sizes[cpu]) for cpu in self.cpus))
+        return line
+
+# Read lines from one of the trace pipes.  We poll so we can notice when stop()
+# says we're done, at that point we drain whatever is left and return.  Every
+# time the pipe goes quiet we yield an empty line, which is enough for
+# traceline.readEvents() to finish off a pending stack trace, and then let
+# idle() know.
+def readPipe(path, stop=None, idle=None, timeout=100):
+    fd = os.open(path, os.O_RDONLY|os.O_NONBLOCK)
+    poll = select.poll()
+    poll.register(fd, select.POLLIN)
+    buf = ""
+    try:
+        while True:
+            if not poll.poll(timeout):
+                yield ""
+                if idle:
+                    idle()
+                if stop and stop():
+                    break
+                continue
+            try:
+                chunk = os.read(fd, 65536)
+            except OSError:
+                continue
+            if not chunk:
+                break
+            lines = (buf + chunk.decode("utf-8", "replace")).split("\n")
+            buf = lines.pop()
+            for line in lines:
+                yield line + "\n"
+    finally:
+        os.close(fd)
+    if buf:
+        yield buf
+
+# tracefs lives at /sys/kernel/tracing on anything recent, older kernels only
+# have it under debugfs.  Either one will do, we prefer a tracefs mount.
+def findTraceDir():
+    debugfs = ""
+    try:
+        f = open("/proc/mounts", "r")
+    except IOError:
+        return ""
     for line in f:
-        m = mounts_re.match(line)
-        if not m:
+        fields = line.split()
+        if len(fields) < 3:
             continue
-        if m.group(3) == "debugfs":
-            __m.traceDir = m.group(2) + "/tracing/"
+        if fields[2] == "tracefs":
+            debugfs = fields[1] + "/"
             break
+        if fields[2] == "debugfs" and not debugfs:
+            debugfs = fields[1] + "/tracing/"
     f.close()
+    return debugfs
+
+def getTraceDir():
+    if __m.traceDir != "":
+        return __m.traceDir
+    setTraceDir(findTraceDir())
     return __m.traceDir
 
+# Point everything at another tracing dir, an instance of rootDir if that's
+# given
+def setTraceDir(traceDir, rootDir=None):
+    if traceDir and not traceDir.endswith("/"):
+        traceDir += "/"
+    if rootDir is None:
+        rootDir = traceDir
+    __m.traceDir = traceDir
+    __m.rootDir = rootDir
+
+# The top level tracing dir, some files like saved_cmdlines only live there
+def getTraceRoot():
+    traceDir = getTraceDir()
+    return __m.rootDir or traceDir
+
+def traceDirs():
+    return (__m.traceDir, __m.rootDir)
+
+def setSession(session):
+    __m.session = session
+
+# What a setting reads back as, in the form we'd write it.  None if it's
+# something we can't write back.
+def normalizeSetting(name, value):
+    value = value.strip()
+    base = os.path.basename(name)
+    if base == "filter":
+        if value in ("", "none"):
+            return "0"
+        # A filter the kernel didn't like reads back with the error after it
+        return value.split("\n")[0]
+    if base == "enable":
+        # A soft disabled event has a * on the end
+        return value.rstrip("*")
+    if base == "buffer_size_kb":
+        m = re.search(r"expanded: (\d+)", value)
+        if m:
+            return m.group(1)
+        if value == "X":
+            # The cpus differ, the per_cpu files say by how much
+            return None
+        return value
+    if base in ("set_event_pid", "set_ftrace_pid"):
+        if value == "no pid":
+            return ""
+        return " ".join(value.split())
+    return value
+
+# A set of changes to the tracing dir that we can take back.  Between start()
+# and apply() everything the helpers above write is queued up, apply() then
+# goes through it in one go, skipping anything that's already set the way we
+# want it and turning tracing_on on last.  After that writes go straight
+# through.  Either way the first time we touch a file we keep what it said,
+# and restore() puts all of it back, in the reverse order, on the way out.
+#
+# With an instance we get our own instances/<name> buffers and settings so we
+# don't trample on anybody else tracing, and if we made the instance restore()
+# removes it again.
+class TraceSession:
+    def __init__(self, instance=None, traceDir=None):
+        self.instance = instance
+        self.rootDir = traceDir
+        self.traceDir = None
+        self.created = False
+        self.active = False
+        self.batching = False
+        self.pending = []
+        # name -> what it said before we touched it, and the names in the
+        # order we first touched them
+        self.original = {}
+        self.touched = []
+        self.failed = []
+        self.previous = None
+        self.registered = False
+
+    def start(self):
+        if self.active:
+            return self
+        if self.rootDir is None:
+            self.rootDir = getTraceRoot()
+        self.traceDir = self.rootDir
+        if self.instance:
+            self.traceDir = self.rootDir + "instances/" + self.instance + "/"
+            if not os.path.isdir(self.traceDir):
+                os.mkdir(self.traceDir)
+                self.created = True
+        self.previous = traceDirs()
+        setTraceDir(self.traceDir, self.rootDir)
+        setSession(self)
+        self.active = True
+        self.batching = True
+        if not self.registered:
+            atexit.register(self.restore)
+            self.registered = True
+        return self
+
+    def read(self, name):
+        try:
+            f = open(self.traceDir+name, 'r')
+            value = f.read()
+            f.close()
+        except (IOError, OSError):
+            return None
+        return normalizeSetting(name, value)
+
+    def set(self, name, value):
+        self.pending.append((name, value))
+        if self.batching:
+            return True
+        return not self.apply()
+
+    # Returns the names of the files we couldn't write
+    def apply(self):
+        self.batching = False
+        pending = self.pending
+        self.pending = []
+        # Only start tracing once everything else is in place
+        pending.sort(key=lambda setting: setting[0] == "tracing_on")
+        failed = []
+        for name, value in pending:
+            # Writing trace clears the buffer, there's nothing to compare or
+            # put back
+            if os.path.basename(name) != "trace":
+                current = self.read(name)
+                if name not in self.original:
+                    self.original[name] = current
+                    self.touched.append(name)
+                if current is not None and current == normalizeSetting(name, value):
+                    continue
+            if not writeFile(self.traceDir+name, value):
+                failed.append(name)
+        self.failed.extend(failed)
+        return failed
+
+    def clear(self):
+        return writeFile(self.traceDir+"trace", "")
+
+    # Safe to call more than once, from a signal handler and from atexit
+    def restore(self):
+        if not self.active:
+            return
+        self.active = False
+        self.batching = False
+        self.pending = []
+        setSession(None)
+        removed = False
+        if self.created:
+            try:
+                os.rmdir(self.traceDir)
+                removed = True
+            except OSError:
+                # Somebody still has one of its pipes open
+                pass
+        if not removed:
+            for name in reversed(self.touched):
+                value = self.original[name]
+                if value is None or self.read(name) == value:
+                    continue
+                writeFile(self.traceDir+name, value)
+        setTraceDir(*self.previous)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.restore()
+        return False
+
+# A set of disjoint [start, end] ranges kept as two sorted lists.  Adding a
+# range bisects to the ranges it overlaps (or touches) and collapses them into
+# one, so the common case of adding ranges in time order is just an append.
+# Once we have a lot of ranges inserting in the middle means moving a lot of
+# memory around, so out of order ranges are buffered and merged in one pass
+# when there are enough of them or somebody looks at us.
 class TimeRange():
-    def __init__(self, start, end):
-        self._range = { start : end }
-        self.total = end - start
+    maxDirectInsert = 1024
 
-    def __inRange(self, w, x, y, z):
-        if z < w:
-            return False
-        if y > x:
-            return False
-        return True
+    def __init__(self, start=None, end=None):
+        self._starts = []
+        self._ends = []
+        self._pending = []
+        self._total = 0.0
+        if start is not None:
+            self.addRange(start, end)
+
+    @property
+    def total(self):
+        if self._pending:
+            self._flush()
+        return self._total
+
+    def __len__(self):
+        if self._pending:
+            self._flush()
+        return len(self._starts)
+
+    def __iter__(self):
+        if self._pending:
+            self._flush()
+        return zip(self._starts, self._ends)
 
     def addRange(self, newstart, newend):
-        key = None
-        for start,end in self._range.iteritems():
-            if self.__inRange(start, end, newstart, newend):
-                key = start
-                break
-        if not key:
-            self._range[newstart] = newend
-            self.total += newend - newstart
+        starts = self._starts
+        ends = self._ends
+        if not ends or newstart > ends[-1]:
+            starts.append(newstart)
+            ends.append(newend)
+            self._total += newend - newstart
+            return
+        if newstart >= starts[-1]:
+            if newend > ends[-1]:
+                self._total += newend - ends[-1]
+                ends[-1] = newend
+            return
+        if self._pending or len(starts) > self.maxDirectInsert:
+            self._pending.append((newstart, newend))
+            if len(self._pending) > max(self.maxDirectInsert, len(starts) // 4):
+                self._flush()
+            return
+        self._insert(newstart, newend)
+
+    def _insert(self, newstart, newend):
+        starts = self._starts
+        ends = self._ends
+        # Everything from lo up to hi overlaps the new range
+        lo = bisect.bisect_left(ends, newstart)
+        hi = bisect.bisect_right(starts, newend, lo)
+        if lo == hi:
+            starts.insert(lo, newstart)
+            ends.insert(lo, newend)
+            self._total += newend - newstart
             return
-        start = key
-        end = self._range[key]
-        if start <= newstart and end >= newend:
+        start = starts[lo]
+        end = ends[hi - 1]
+        if start <= newstart and end >= newend and hi - lo == 1:
             return
-        del self._range[start]
-        self.total -= end - start
-        if start > newstart:
+        for i in range(lo, hi):
+            self._total -= ends[i] - starts[i]
+        if newstart < start:
             start = newstart
         if newend > end:
             end = newend
-        self.addRange(start, end)
+        starts[lo:hi] = [start]
+        ends[lo:hi] = [end]
+        self._total += end - start
+
+    # Merge the buffered ranges in with one pass over everything
+    def _flush(self):
+        pending = self._pending
+        pending.sort()
+        starts = []
+        ends = []
+        total = 0.0
+        for start, end in heapq.merge(zip(self._starts, self._ends), pending):
+            if ends and start <= ends[-1]:
+                if end > ends[-1]:
+                    total += end - ends[-1]
+                    ends[-1] = end
+                continue
+            starts.append(start)
+            ends.append(end)
+            total += end - start
+        self._starts = starts
+        self._ends = ends
+        self._pending = []
+        self._total = total
+
+    def union(self, other):
+        ret = TimeRange()
+        for start, end in self:
+            ret.addRange(start, end)
+        for start, end in other:
+            ret.addRange(start, end)
+        return ret
+
+    def intersection(self, other):
+        ret = TimeRange()
+        if self._pending:
+            self._flush()
+        if other._pending:
+            other._flush()
+        i = 0
+        j = 0
+        while i < len(self._starts) and j < len(other._starts):
+            start = max(self._starts[i], other._starts[j])
+            end = min(self._ends[i], other._ends[j])
+            if start < end:
+                ret.addRange(start, end)
+            if self._ends[i] < other._ends[j]:
+                i += 1
+            else:
+                j += 1
+        return ret
+
+    # How much of [start, end] is covered by our ranges
+    def totalInWindow(self, start, end):
+        if self._pending:
+            self._flush()
+        starts = self._starts
+        ends = self._ends
+        total = 0.0
+        i = bisect.bisect_right(ends, start)
+        while i < len(starts) and starts[i] < end:
+            total += min(ends[i], end) - max(starts[i], start)
+            i += 1
+        return total
+
+# The layout of an event as described by events/<system>/<event>/format
+#
+#	field:unsigned short common_type;	offset:0;	size:2;	signed:0;
+#	field:char prev_comm[16];	offset:8;	size:16;	signed:1;
+#	field:__data_loc char[] name;	offset:8;	size:4;	signed:1;
+format_field_re = re.compile(r"\s*field:(.+);\s*offset:(\d+);\s*size:(\d+);\s*signed:(\d+);")
+
+class EventFormat:
+    def __init__(self, name, id, fields, endian="="):
+        self.name = name
+        self.id = id
+        # (name, offset, size, signed, count, kind)
+        self.fields = fields
+        self.endian = endian
+        self.size = 0
+        for f in fields:
+            self.size = max(self.size, f[1] + f[2])
+
+    def _int(self, size, signed):
+        c = { 1 : "b", 2 : "h", 4 : "i", 8 : "q" }[size]
+        if not signed:
+            c = c.upper()
+        return c
+
+    # Turn the raw record into a dict of field name -> value
+    def decode(self, buf, start, length):
+        values = {}
+        for name, offset, size, signed, count, kind in self.fields:
+            if offset + size > length:
+                continue
+            pos = start + offset
+            if kind == "str":
+                values[name] = _cstring(buf[pos:pos+size])
+            elif kind in ("dynstr", "relstr"):
+                loc = struct.unpack_from(self.endian + "I", buf, pos)[0]
+                dynoff = loc & 0xffff
+                if kind == "relstr":
+                    dynoff += offset + size
+                dynlen = loc >> 16
+                values[name] = _cstring(buf[start+dynoff:start+dynoff+dynlen])
+            elif kind == "array":
+                # Variable sized arrays (kernel_stack's caller[]) are size 0
+                # here, whoever wants them has to work out the length
+                if not count or not size or size % count:
+                    continue
+                esize = size // count
+                if esize not in (1, 2, 4, 8):
+                    continue
+                values[name] = struct.unpack_from(self.endian + "%d%s" %
+                                                  (count, self._int(esize, signed)),
+                                                  buf, pos)
+            else:
+                values[name] = struct.unpack_from(self.endian + self._int(size, signed),
+                                                  buf, pos)[0]
+        return values
+
+def _cstring(b):
+    return bytes(b).split(b"\0", 1)[0].decode("utf-8", "replace")
+
+def parseEventFormat(text, endian="="):
+    name = None
+    id = None
+    fields = []
+    for line in text.splitlines():
+        if line.startswith("name: "):
+            name = line[6:].strip()
+        elif line.startswith("ID: "):
+            id = int(line[4:])
+        m = format_field_re.match(line)
+        if not m:
+            continue
+        decl = m.group(1).strip()
+        offset = int(m.group(2))
+        size = int(m.group(3))
+        signed = m.group(4) == "1"
+        fname = decl.split()[-1]
+        count = 1
+        kind = "int"
+        if "[" in fname:
+            fname, n = fname.split("[", 1)
+            n = n.rstrip("]")
+            count = int(n) if n else 0
+            kind = "array"
+        if decl.startswith("__data_loc"):
+            kind = "dynstr"
+        elif decl.startswith("__rel_loc"):
+            kind = "relstr"
+        elif kind == "array" and decl.split()[0] == "char":
+            kind = "str"
+        if kind not in ("str", "dynstr", "relstr", "array") and size not in (1, 2, 4, 8):
+            continue
+        fields.append((fname, offset, size, signed, count, kind))
+    if name is None or id is None:
+        return None
+    return EventFormat(name, id, fields, endian)
+
+def readEventFormat(event, traceDir=None):
+    if traceDir is None:
+        traceDir = getTraceDir()
+    f = open(traceDir+"events/"+event+"/format", "r")
+    text = f.read()
+    f.close()
+    return parseEventFormat(text)
+
+# Ring buffer event types, see include/linux/ring_buffer.h
+RINGBUF_TYPE_DATA_TYPE_LEN_MAX = 28
+RINGBUF_TYPE_PADDING = 29
+RINGBUF_TYPE_TIME_EXTEND = 30
+RINGBUF_TYPE_TIME_STAMP = 31
+RB_MISSED_EVENTS = 1 << 31
+RB_MISSED_STORED = 1 << 30
+
+# Reads the binary per-cpu ring buffer pages (per_cpu/cpuN/trace_pipe_raw) and
+# turns the records into the same traceline.TraceEvent objects parseLine()
+# gives us for the text trace_pipe.  Only events we have a format for and a
+# raw decoder registered with traceline.registerRawDecoder() get fields, the
+# kernel_stack event is turned into a "<stack trace>" event whose fields are
+# the tuple of function names.
+class RawTraceReader:
+    def __init__(self, cpu, events, traceDir=None, infile=None, endian="=",
+                 stop=None, idle=None):
+        if traceDir is None:
+            traceDir = getTraceDir()
+        self.cpu = cpu
+        self.traceDir = traceDir
+        # saved_cmdlines is only at the top, even when we're in an instance
+        self.rootDir = traceDir
+        current, root = traceDirs()
+        if traceDir == current and root:
+            self.rootDir = root
+        self.endian = endian
+        self.formats = {}
+        self.comms = { 0 : "<idle>" }
+        self.symbols = None
+        self.missed = 0
+        self.unknown = 0
+        self.pages = 0
+        self.commitSize = 8
+        self.dataOffset = 16
+        self.pageSize = 4096
+        self._readHeaderPage()
+        for event in events + ["ftrace/kernel_stack"]:
+            try:
+                fmt = readEventFormat(event, traceDir)
+            except IOError:
+                continue
+            if fmt:
+                fmt.endian = endian
+                self.formats[fmt.id] = fmt
+        self.readSavedCmdlines()
+        self.infile = infile
+        self.stop = stop
+        self.idle = idle
+        self.fd = None
+        if infile is None:
+            self.fd = os.open(traceDir+"per_cpu/cpu%d/trace_pipe_raw" % cpu,
+                              os.O_RDONLY|os.O_NONBLOCK)
+            self.poll = select.poll()
+            self.poll.register(self.fd, select.POLLIN)
+
+    def _readHeaderPage(self):
+        try:
+            f = open(self.traceDir+"events/header_page", "r")
+        except IOError:
+            return
+        for line in f:
+            m = format_field_re.match(line)
+            if not m:
+                continue
+            decl = m.group(1).strip()
+            if decl.endswith(" commit"):
+                self.commitSize = int(m.group(3))
+            elif decl.endswith(" data"):
+                self.dataOffset = int(m.group(2))
+                self.pageSize = self.dataOffset + int(m.group(3))
+        f.close()
+
+    def readSavedCmdlines(self):
+        try:
+            f = open(self.rootDir+"saved_cmdlines", "r")
+        except IOError:
+            return
+        for line in f:
+            pid, sep, comm = line.rstrip("\n").partition(" ")
+            if sep:
+                self.comms[int(pid)] = comm
+        f.close()
+
+    def _symbolize(self, addr):
+        if self.symbols is None:
+            self.symbols = loadKallsyms()
+        return lookupSymbol(self.symbols, addr)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    # Returns "" once we hit EOF or stop() tells us to quit and nothing is left
+    def readPage(self):
+        if self.infile is not None:
+            return self.infile.read(self.pageSize)
+        while True:
+            if not self.poll.poll(100):
+                if self.idle:
+                    self.idle()
+                if self.stop and self.stop():
+                    try:
+                        return os.read(self.fd, self.pageSize)
+                    except OSError:
+                        return ""
+                continue
+            try:
+                return os.read(self.fd, self.pageSize)
+            except OSError:
+                continue
+
+    # Yields TraceEvents until we hit EOF
+    def __iter__(self):
+        while True:
+            page = self.readPage()
+            if not page:
+                break
+            for event in self.decodePage(page):
+                yield event
+
+    def decodePage(self, page):
+        endian = self.endian
+        self.pages += 1
+        timestamp = struct.unpack_from(endian + "Q", page, 0)[0]
+        if self.commitSize == 8:
+            commit = struct.unpack_from(endian + "Q", page, 8)[0]
+        else:
+            commit = struct.unpack_from(endian + "I", page, 8)[0]
+        size = commit & ~(RB_MISSED_EVENTS | RB_MISSED_STORED) & 0xffffffff
+        pos = self.dataOffset
+        end = min(pos + size, len(page))
+        if commit & RB_MISSED_EVENTS:
+            if commit & RB_MISSED_STORED and end + 8 <= len(page):
+                self.missed += struct.unpack_from(endian + "Q", page, end)[0]
+            else:
+                self.missed += 1
+        while pos + 4 <= end:
+            header = struct.unpack_from(endian + "I", page, pos)[0]
+            pos += 4
+            typeLen = header & 0x1f
+            delta = header >> 5
+            if typeLen == RINGBUF_TYPE_PADDING:
+                if delta == 0:
+                    break
+                timestamp += delta
+                pos += struct.unpack_from(endian + "I", page, pos)[0]
+                continue
+            if typeLen == RINGBUF_TYPE_TIME_EXTEND:
+                timestamp += (struct.unpack_from(endian + "I", page, pos)[0] << 27) + delta
+                pos += 4
+                continue
+            if typeLen == RINGBUF_TYPE_TIME_STAMP:
+                timestamp = (struct.unpack_from(endian + "I", page, pos)[0] << 27) | delta
+                pos += 4
+                continue
+            if typeLen == 0:
+                length = struct.unpack_from(endian + "I", page, pos)[0] - 4
+                pos += 4
+            else:
+                length = typeLen * 4
+            start = pos
+            pos += (length + 3) & ~3
+            timestamp += delta
+            event = self.decodeRecord(page, start, length, timestamp)
+            if event is not None:
+                yield event
+
+    def decodeRecord(self, buf, start, length, timestamp):
+        if length < 8:
+            return None
+        id = struct.unpack_from(self.endian + "H", buf, start)[0]
+        fmt = self.formats.get(id)
+        if fmt is None:
+            self.unknown += 1
+            return None
+        values = fmt.decode(buf, start, length)
+        pid = values.get("common_pid", 0)
+        if fmt.name == "kernel_stack":
+            callers = self._stackCallers(buf, start, length, fmt, values)
+            frames = tuple(self._symbolize(addr) for addr in callers)
+            data = "<stack trace>"
+            fields = frames
+            event = data
+        else:
+            decoder = traceline.findRawDecoder(fmt.name)
+            if decoder is None:
+                event = data = fmt.name
+                fields = None
+            else:
+                # Per-syscall events are sys_enter_read in the format but
+                # sys_read in the text output, so go by what we printed
+                data, fields = decoder(fmt.name, values)
+                event = traceline.eventName(data)
+                if fields is not None:
+                    self._learnComms(event, fields)
+        comm = self.comms.get(pid, "<...>")
+        return traceline.TraceEvent(comm, pid, self.cpu, timestamp / 1000000000.0,
+                                    event, data, fields)
+
+    def _stackCallers(self, buf, start, length, fmt, values):
+        for name, offset, size, signed, count, kind in fmt.fields:
+            if name != "caller":
+                continue
+            esize = size // max(count, 1)
+            if esize not in (4, 8):
+                esize = 8
+            n = (length - offset) // esize
+            nr = values.get("size", n)
+            if 0 < nr < n:
+                n = nr
+            callers = struct.unpack_from(self.endian + "%d%s" % (n, "Q" if esize == 8 else "I"),
+                                         buf, start + offset)
+            ret = []
+            for addr in callers:
+                # The unused slots are filled with ULONG_MAX or 0
+                if addr == 0 or addr == (1 << (esize * 8)) - 1:
+                    break
+                ret.append(addr)
+            return ret
+        return []
+
+    def _learnComms(self, event, fields):
+        if event == "sched_switch":
+            self.comms[fields.prev_pid] = fields.prev_comm
+            self.comms[fields.next_pid] = fields.next_comm
+        elif event == "sched_wakeup":
+            self.comms[fields.pid] = fields.comm
+
+def loadKallsyms(path="/proc/kallsyms"):
+    symbols = []
+    try:
+        f = open(path, "r")
+    except IOError:
+        return ([], [])
+    for line in f:
+        parts = line.split()
+        if len(parts) < 3 or parts[1] not in "tTwW":
+            continue
+        symbols.append((int(parts[0], 16), parts[2]))
+    f.close()
+    symbols.sort()
+    return ([s[0] for s in symbols], [s[1] for s in symbols])
+
+def lookupSymbol(symbols, addr):
+    addrs, names = symbols
+    i = bisect.bisect_right(addrs, addr) - 1
+    if i < 0 or addrs[i] == 0:
+        return "0x%x" % addr
+    return names[i]
@@ -0,0 +1,332 @@
+import copy
+import heapq
+import operator
+import ftrace
+import report
+import sched
+import stacks
+import stats
+
+# latencytop's analysis as something we can drive ourselves.  An Analyzer is
+# fed sched_switch, sched_wakeup and <stack trace> events, from a live pipe, a
+# trace file or a chunk of one, and aggregates sleep time per stack trace per
+# process.  Analyzers over consecutive pieces of a trace can be merged into one,
+# which gives the same answer as running a single Analyzer over the whole thing.
+
+# We want to keep track of total sleep time per stacktrace per process, so heres
+# a basic class to aggregate all of this stuff in one place
+class Process:
+    def __init__(self, event, collapsed):
+        if collapsed:
+            self.pid = 0
+        else:
+            self.pid = event.trace["pid"]
+        self.comm = event.trace["comm"]
+        # stack id -> TimeRange of the sleeps with that stack
+        self.stacks = { event.stacktrace : event.sleepRanges }
+        self.wakeups = { event.wakeupStacktrace : 1 }
+        self.numEvents = 1
+        # Time from the sched_wakeup to getting on the cpu, and how long every
+        # sleep lasted
+        self.waketime = stats.Histogram()
+        if event.hadWakeEvent:
+            self.waketime.add(event.timeToWake)
+        self.sleeptime = stats.Histogram()
+        self.sleeptime.add(event.woken - event.trace["timestamp"])
+        self.cpuChanges = 0
+        if event.changeCpu:
+            self.cpuChanges += 1
+        self.collapsed = collapsed
+        self.sleepRanges = ftrace.TimeRange(event.trace["timestamp"], event.woken)
+
+    def addEvent(self, event):
+        if event.stacktrace in self.stacks:
+            self.stacks[event.stacktrace].addRange(event.trace["timestamp"], event.woken)
+        else:
+            self.stacks[event.stacktrace] = event.sleepRanges
+        if event.wakeupStacktrace in self.wakeups:
+            self.wakeups[event.wakeupStacktrace] += 1
+        else:
+            self.wakeups[event.wakeupStacktrace] = 1
+        self.sleepRanges.addRange(event.trace["timestamp"], event.woken)
+        self.sleeptime.add(event.woken - event.trace["timestamp"])
+        if event.changeCpu:
+            self.cpuChanges += 1
+        if event.hadWakeEvent:
+            self.waketime.add(event.timeToWake)
+        self.numEvents += 1
+
+    # Switch our stack ids over to another StackTable, stackIds maps the old
+    # ids to the new ones
+    def remap(self, stackIds):
+        self.stacks = dict((stackIds[s], r) for s, r in self.stacks.items())
+        self.wakeups = dict((stackIds[s], n) for s, n in self.wakeups.items())
+
+    # Fold in other, whose stack ids map to ours through stackIds
+    def merge(self, other, stackIds):
+        for stack, ranges in other.stacks.items():
+            stack = stackIds[stack]
+            if stack in self.stacks:
+                mine = self.stacks[stack]
+                for start, end in ranges:
+                    mine.addRange(start, end)
+            else:
+                self.stacks[stack] = ranges
+        for stack, n in other.wakeups.items():
+            stack = stackIds[stack]
+            self.wakeups[stack] = self.wakeups.get(stack, 0) + n
+        for start, end in other.sleepRanges:
+            self.sleepRanges.addRange(start, end)
+        self.sleeptime.merge(other.sleeptime)
+        self.waketime.merge(other.waketime)
+        self.cpuChanges += other.cpuChanges
+        self.numEvents += other.numEvents
+
+    # So the report can order processes like any other stats
+    @property
+    def total(self):
+        return self.sleepRanges.total
+
+    @property
+    def count(self):
+        return self.numEvents
+
+    @property
+    def average(self):
+        return self.sleeptime.average
+
+    def percentile(self, p):
+        return self.sleeptime.percentile(p)
+
+class Analyzer:
+    # collapse aggregates by comm instead of pid, pid and name only record
+    # sleeps for that pid or for comms containing name
+    def __init__(self, collapse=False, pid=None, name=None):
+        self.collapse = collapse
+        self.pid = pid
+        self.name = name
+        self.stackTable = stacks.StackTable()
+        self.reset()
+
+    # Throw away everything aggregated and everything in flight, the stacks we
+    # interned stay around.
+    def reset(self):
+        self.processes = {}
+        # pid -> SchedSwitchEvent for the tasks that are asleep, and for the
+        # tasks that just woke one of those up and whose stack trace we're
+        # waiting for
+        self.sleeping = {}
+        self.waking = {}
+        # Events that may finish a sleep that started before the first event
+        # we saw, merge() replays them on the Analyzer that saw the start of
+        # those sleeps.  seen is the pids we've seen switch in or out, so we
+        # know if they're asleep, and wakersSeen the pids we've seen wake
+        # somebody up, so we know who their next stack trace goes to.  Anything
+        # we can't tell without the events that came before goes in early.
+        self.early = []
+        self.seen = set()
+        self.wakersSeen = set()
+        self.firstTime = 0.0
+        self.lastTime = 0.0
+
+    # Only count what happens from timestamp on.  Sleeps that were already
+    # going carry on, counted from timestamp.
+    def startWindow(self, timestamp):
+        self.processes = {}
+        for e in self.sleeping.values():
+            if e.trace["timestamp"] < timestamp:
+                e.trace["timestamp"] = timestamp
+        self.firstTime = timestamp
+        self.lastTime = timestamp
+
+    @property
+    def totalTime(self):
+        return self.lastTime - self.firstTime
+
+    def addEvents(self, events):
+        events = iter(events)
+        if self.firstTime == 0.0:
+            for trace in events:
+                self.addEvent(trace)
+                break
+        stackTrace = self.stackTrace
+        wakeEvent = self.wakeEvent
+        switch = self.switch
+        trace = None
+        for trace in events:
+            if trace.event == "sched_switch":
+                if trace.fields:
+                    switch(trace, trace.fields)
+            elif trace.event == "<stack trace>":
+                stackTrace(trace)
+            elif trace.event == "sched_wakeup":
+                if trace.fields:
+                    wakeEvent(trace, trace.fields)
+        if trace is not None:
+            self.lastTime = trace.timestamp
+
+    def addEvent(self, trace):
+        if self.firstTime == 0.0:
+            self.firstTime = trace.timestamp
+        else:
+            self.lastTime = trace.timestamp
+        if trace.event == "<stack trace>":
+            self.stackTrace(trace)
+        elif trace.event == "sched_wakeup":
+            if trace.fields:
+                self.wakeEvent(trace, trace.fields)
+        elif trace.event == "sched_switch" and trace.fields:
+            self.switch(trace, trace.fields)
+
+    # We can get a couple of sched events before we start to spit out the
+    # stack trace so we need to pay attention to the pid in the stack trace
+    # line and pick out the right event
+    def stackTrace(self, trace):
+        pid = trace.pid
+        if pid in self.sleeping:
+            # Sometimes we can miss wakeup messages, and we've already
+            # gotten a stacktrace for this event, if this is the case just
+            # skip this stacktrace and delete this event
+            e = self.sleeping[pid]
+            if e.stacktrace == stacks.EMPTY:
+                e.stacktrace = self.stackTable.intern(trace.fields)
+            else:
+                del self.sleeping[pid]
+        elif pid in self.waking:
+            e = self.waking.pop(pid)
+            e.wakeupStacktrace = self.stackTable.concat(e.wakeupStacktrace,
+                                                        self.stackTable.intern(trace.fields))
+        elif pid not in self.seen or pid not in self.wakersSeen:
+            self.early.append(trace)
+
+    # Wakeup actions are going to happen from a different PID for a given
+    # PID so we just want to find the sleeper and start the wakeup timer and
+    # then setup a pending waker so we can scrape it's stacktrace
+    def wakeEvent(self, trace, event):
+        if event.pid in self.sleeping:
+            e = self.sleeping[event.pid]
+            e.wakeEvent(trace)
+            self.waking[trace.pid] = e
+            self.wakersSeen.add(trace.pid)
+        elif event.pid not in self.seen:
+            self.early.append(trace)
+            # The waker's next stack trace may be for this one
+            self.waking.pop(trace.pid, None)
+            self.wakersSeen.discard(trace.pid)
+
+    # Still need to track the sched_switch wakeup part since that is when we
+    # actually load the process onto the CPU and make it do shit.  Only then
+    # we can remove it from our sleeping dict and add it to the process
+    def switchIn(self, trace, event):
+        if event.next_pid in self.sleeping:
+            e = self.sleeping.pop(event.next_pid)
+            e.wakeup(trace)
+            key = e.trace["pid"]
+            if self.collapse:
+                key = e.trace["comm"]
+            if key in self.processes:
+                self.processes[key].addEvent(e)
+            else:
+                self.processes[key] = Process(e, self.collapse)
+        elif event.next_pid not in self.seen:
+            self.early.append(trace)
+            self.seen.add(event.next_pid)
+
+    def switch(self, trace, event):
+        self.switchIn(trace, event)
+        self.seen.add(event.prev_pid)
+
+        # Nobody cares about you idle processes
+        if event.prev_pid == 0:
+            return
+
+        if self.pid and event.prev_pid != self.pid:
+            return
+
+        # Don't record events about processes we don't care about
+        if self.name and event.prev_comm.find(self.name) == -1:
+            return
+
+        self.sleeping[event.prev_pid] = sched.SchedSwitchEvent(trace, event)
+
+    # A copy of everything so far that we can report on or merge while this
+    # one carries on
+    def snapshot(self):
+        return copy.deepcopy(self)
+
+    # Fold in other, an Analyzer that was fed the events that came after ours.
+    # other is taken apart to do this, so snapshot() it first if you still need
+    # it.
+    def merge(self, other):
+        # Finish off the sleeps that started with us and ended with them
+        for trace in other.early:
+            if trace.event == "<stack trace>":
+                self.stackTrace(trace)
+            elif trace.event == "sched_wakeup":
+                self.wakeEvent(trace, trace.fields)
+            else:
+                self.switchIn(trace, trace.fields)
+        stackIds = self.stackTable.merge(other.stackTable)
+        for key, process in other.processes.items():
+            if key in self.processes:
+                self.processes[key].merge(process, stackIds)
+            else:
+                process.remap(stackIds)
+                self.processes[key] = process
+        pending = dict((id(e), e) for e in
+                       list(other.sleeping.values()) + list(other.waking.values()))
+        for e in pending.values():
+            e.stacktrace = stackIds[e.stacktrace]
+            e.wakeupStacktrace = stackIds[e.wakeupStacktrace]
+        for pid in other.seen:
+            self.sleeping.pop(pid, None)
+        for pid in other.wakersSeen:
+            self.waking.pop(pid, None)
+        self.sleeping.update(other.sleeping)
+        self.waking.update(other.waking)
+        self.seen |= other.seen
+        self.wakersSeen |= other.wakersSeen
+        if other.firstTime != 0.0:
+            if self.firstTime == 0.0:
+                self.firstTime = other.firstTime
+                self.lastTime = other.lastTime
+            else:
+                self.lastTime = other.lastTime or other.firstTime
+
+def printStackTrace(stackTable, stacktrace):
+    tracelist = stackTable.frames(stacktrace)
+    if not tracelist:
+        tracelist = [""]
+    for v in tracelist:
+        print("\t\t" + v)
+
+# top limits the number of processes and the number of stacks we print for
+# each of them
+def printSummary(analyzer, sort="total", top=None):
+    totalTime = analyzer.totalTime
+    print("Total time run %f seconds" % totalTime)
+    for p, process in report.topItems(analyzer.processes, sort, top):
+        print("Process %s-%d" % (process.comm, process.pid))
+        print("=> Time asleep:\t\t\t%f" % process.sleepRanges.total)
+        print("=> Cpu changes:\t\t\t%d" % process.cpuChanges)
+        print("=> Num sleep/wake cycles:\t%d" % process.numEvents)
+        if process.waketime.count:
+            print("=> Wake latency min,avg,max:\t%f, %f, %f" %
+                  (process.waketime.min, process.waketime.average, process.waketime.max))
+            print("=> Wake latency p50,p90,p99,p99.9:\t%f, %f, %f, %f" %
+                  tuple(process.waketime.percentiles()))
+        print("=> Sleep time p50,p90,p99,p99.9:\t%f, %f, %f, %f" %
+              tuple(process.sleeptime.percentiles()))
+        print("=> Percentage of total:\t\t%f" % ((process.sleepRanges.total / totalTime) * 100))
+        for e, ranges in report.topItems(process.stacks, "total", top):
+            print("\tSpent %f seconds in here, %f percentage of sleep time" %
+                    (ranges.total, ((ranges.total / process.sleepRanges.total) * 100)))
+            printStackTrace(analyzer.stackTable, e)
+        wakeups = [(trace, n) for trace, n in process.wakeups.items() if trace != stacks.EMPTY]
+        if top:
+            wakeups = heapq.nlargest(top, wakeups, key=operator.itemgetter(1))
+        else:
+            wakeups.sort(key=operator.itemgetter(1), reverse=True)
+        for trace, n in wakeups:
+            print("\tWoken up %d times like this" % n)
+            printStackTrace(analyzer.stackTable, trace)
@@ -1,135 +1,55 @@
 #!/bin/python
 
 import argparse
+import asyncio
+import aiocapture
 import traceline
-import operator
 import ftrace
 import signal
 import sys
-import sched
 import time
 from subprocess import Popen
 import os
 import shlex
-import select
+import percpu
+import tracecache
+import traceinput
+import latency
+import parallel
+import report
+import flamegraph
+import wakegraph
+import traceindex
 
-# We want to keep track of total sleep time per stacktrace per process, so heres
-# a basic class to aggregate all of this stuff in one place
-class Process:
-    def __init__(self, event, collapsed):
-        if collapsed:
-            self.pid = 0
-        else:
-            self.pid = event.trace["pid"]
-        self.comm = event.trace["comm"]
-        self.events = { event.stacktrace : event }
-        self.wakeups = { event.wakeupStacktrace : 1 }
-        self.numEvents = 1
-        if event.hadWakeEvent:
-            self.waketime = { "avg" : event.timeToWake, "min" : event.timeToWake, "max" : event.timeToWake }
-        else:
-            self.waketime = { "avg" : 0.0, "min" : 1000000000.0, "max" : 0.0 }
-        self.cpuChanges = 0
-        self.collapsed = collapsed
-        self.sleepRanges = ftrace.TimeRange(event.trace["timestamp"], event.woken)
-
-    def addEvent(self, event):
-        if event.stacktrace in self.events:
-            self.events[event.stacktrace].sleepRanges.addRange(event.trace["timestamp"], event.woken)
-        else:
-            self.events[event.stacktrace] = event
-        if event.wakeupStacktrace in self.wakeups:
-            self.wakeups[event.wakeupStacktrace] += 1
-        else:
-            self.wakeups[event.wakeupStacktrace] = 1
-        self.sleepRanges.addRange(event.trace["timestamp"], event.woken)
-        if event.changeCpu:
-            self.cpuChanges += 1
-        if event.hadWakeEvent:
-            if self.waketime["avg"] > 0.0:
-                self.waketime["avg"] += event.timeToWake
-                self.waketime["avg"] /= 2
-            else:
-                self.waketime["avg"] = event.timeToWake
-            if event.timeToWake > self.waketime["max"]:
-                self.waketime["max"] = event.timeToWake
-            if event.timeToWake < self.waketime["min"]:
-                self.waketime["min"] = event.timeToWake
-        self.numEvents += 1
-
-def toggleEvents(toggle, wakeups=False, command=None):
-    if toggle:
-        ftrace.enableEvent("sched/sched_switch")
-        if wakeups:
-            ftrace.enableEvent("sched/sched_wakeup")
-        if command:
-            ftrace.filterPid(os.getpid())
-        ftrace.enableStackTrace()
-        ftrace.clearTraceBuffer()
-        ftrace.enableFtrace()
+# Push what we can of the pid/name filtering down into the kernel so we don't
+# have to read and parse events just to drop them.  The checks in the main
+# loop stay, the kernel may not have taken the filters.
+def setFilters(pid=None, name=None, command=False):
+    if command:
+        # Our child doesn't exist yet, trace us and whatever we fork
+        ftrace.filterSchedEvents(os.getpid(), name, fork=True)
     else:
-        ftrace.disableFtrace()
-        ftrace.disableEvent("sched/sched_switch")
-        ftrace.disableEvent("sched/sched_wakeup")
-        ftrace.disableStackTrace()
-        ftrace.clearFilterPid()
+        ftrace.filterSchedEvents(pid, name)
+
+# Everything goes into the session in one batch, what we changed gets put back
+# by session.restore()
+def startTracing(session, wakeups=False, command=None, pid=None, name=None):
+    setFilters(pid, name, command is not None)
+    ftrace.enableEvent("sched/sched_switch")
+    if wakeups:
+        ftrace.enableEvent("sched/sched_wakeup")
+    ftrace.enableStackTrace()
+    ftrace.clearTraceBuffer()
+    ftrace.enableFtrace()
+    return session.apply()
 
 def signalHandler(signal, frame):
-    toggleEvents(False)
+    if session:
+        session.restore()
     sys.exit(0)
 
-def findSleepiestProcess(processes):
-    maxSleep = 0.0
-    key = 0
-    for process in processes.keys():
-        if processes[process].sleepRanges.total > maxSleep:
-            maxSleep = processes[process].sleepRanges.total
-            key = process
-    return key
-
-def findSleepiestEvent(events):
-    maxSleep = 0.0
-    key = ""
-    for e in events.keys():
-        if events[e].sleepRanges.total > maxSleep:
-            maxSleep = events[e].sleepRanges.total
-            key = e
-    return key
-
-def printStackTrace(stacktrace):
-    tracelist = stacktrace.split(':')
-    for v in tracelist:
-        print("\t\t" + v)
-
-def printSummary(processes, totalTime):
-    print("Total time run %f seconds" % totalTime)
-    while processes:
-        p = findSleepiestProcess(processes)
-        process = processes[p]
-        print("Process %s-%d" % (process.comm, process.pid))
-        print("=> Time asleep:\t\t\t%f" % process.sleepRanges.total)
-        print("=> Cpu changes:\t\t\t%d" % process.cpuChanges)
-        print("=> Num sleep/wake cycles:\t%d" % process.numEvents)
-        if process.waketime["avg"] > 0.0:
-            print("=> Wake latency min,avg,max:\t%f, %f, %f" %
-                  (process.waketime["min"], process.waketime["avg"], process.waketime["max"]))
-        print("=> Percentage of total:\t\t%f" % ((process.sleepRanges.total / totalTime) * 100))
-        while process.events:
-            e = findSleepiestEvent(process.events)
-            event = process.events[e]
-            print("\tSpent %f seconds in here, %f percentage of sleep time" %
-                    (event.sleepRanges.total, ((event.sleepRanges.total / process.sleepRanges.total) * 100)))
-            printStackTrace(event.stacktrace)
-            del process.events[e]
-        for trace in sorted(process.wakeups, key=process.wakeups.get, reverse=True):
-            if trace == "":
-                continue
-            print("\tWoken up %d times like this" % process.wakeups[trace])
-            printStackTrace(trace)
-        del processes[p]
-
 parser = argparse.ArgumentParser(description="Track top latency reason")
-parser.add_argument('infile', nargs='?', help='Process a tracefile')
+parser.add_argument('infile', nargs='*', help='Process a tracefile, or a set of per-cpu trace dumps')
 parser.add_argument('-w', action='store_true')
 parser.add_argument('-t', '--time', type=float, help="Only run for the given amount of seconds")
 parser.add_argument('-n', '--name', type=str, help="Only pay attention to processes with this name")
@@ -137,178 +57,297 @@ parser.add_argument('-o', '--output', type=str, help="Write all trace data to th
 parser.add_argument('-c', '--collapse', action='store_true', help="Collapse all comms into one big event")
 parser.add_argument('-r', '--run', type=str, help="Run and profile this command")
 parser.add_argument('-p', '--pid', type=int, help="Profile a specific pid")
+parser.add_argument('--top', type=int, help="Only print the top N processes and stacks")
+parser.add_argument('--sort', choices=report.sort_choices, default="total",
+                    help="What to order processes by, total sleep time or the count, average or percentiles of sleeps")
+parser.add_argument('--no-cache', action='store_true', help="Don't read or write the parsed trace cache next to the trace file")
+parser.add_argument('-j', '--jobs', type=int, default=1,
+                    help="Split the trace file up and process it with this many processes")
+parser.add_argument('--percpu', action='store_true', help="Read every cpu's buffer separately and merge them")
+parser.add_argument('--raw', action='store_true', help="Read the binary per-cpu buffers, implies --percpu")
+parser.add_argument('--queue', type=int, default=256,
+                    help="Chunks of trace data we buffer between reading the pipes and the analysis")
+parser.add_argument('--drop', action='store_true',
+                    help="Drop trace data when the queue is full instead of leaving it in the kernel buffer")
+parser.add_argument('--buffer-size', type=int,
+                    help="Set every cpu's ring buffer to this many kb while we trace")
+parser.add_argument('--auto-buffer', action='store_true',
+                    help="Grow the ring buffers to keep up with the event rate we see")
+parser.add_argument('--folded', type=str,
+                    help="Write the stacks out folded for flame graph tools to this file")
+parser.add_argument('--flamegraph', type=str, help="Write an SVG flame graph to this file")
+parser.add_argument('--weight', choices=flamegraph.weight_choices, default="sleep",
+                    help="Weigh the stacks by time asleep in them, or by how many wakeups came from them")
+parser.add_argument('--chains', action='store_true',
+                    help="Follow who woke who and put every process's time asleep on the chain of tasks it waited on, implies -w")
+traceindex.addArguments(parser)
+parser.add_argument('--instance', type=str,
+                    help="Trace in our own tracing instance with this name, made for us if it doesn't exist")
 
 args = parser.parse_args()
-infile = None
+if args.chains:
+    args.w = True
+if traceindex.windowed(args) and len(args.infile) != 1:
+    parser.error("--from/--to need a single trace file")
+events = None
+capturePaths = None
+capture = None
+monitor = None
+session = None
 continual = False
 runTime = 5
 liveSystem = False
 traceFile = None
-poll = select.poll()
+splitFile = False
+window = None
+schedEvents = ["sched/sched_switch", "sched/sched_wakeup"]
+
+def captureDone():
+    return exited
 
 if not args.infile:
-    traceDir = ftrace.getTraceDir()
-    if traceDir == "":
-        print("Please mount debugfs to use this feature")
+    if ftrace.getTraceDir() == "":
+        print("Please mount tracefs or debugfs to use this feature")
         sys.exit(1)
-    infd = os.open(traceDir+"trace_pipe", os.O_RDONLY|os.O_NONBLOCK)
-    poll.register(infd, select.POLLIN)
-    infile = os.fdopen(infd)
+    session = ftrace.TraceSession(args.instance)
+    try:
+        session.start()
+    except OSError as e:
+        print("Couldn't create tracing instance %s: %s" % (args.instance, e))
+        sys.exit(1)
+    traceDir = ftrace.getTraceDir()
+    if args.raw:
+        events = percpu.PerCpuCapture(events=schedEvents, raw=True,
+                                      stop=captureDone)
+    else:
+        if args.percpu:
+            capturePaths = dict((cpu, traceDir+"per_cpu/cpu%d/trace_pipe" % cpu)
+                                for cpu in ftrace.getCpus())
+        else:
+            capturePaths = { "trace_pipe" : traceDir+"trace_pipe" }
     if args.output:
         traceFile = open(args.output, "w+")
-    toggleEvents(True, args.w, args.run)
+    monitor = ftrace.BufferMonitor(auto=args.auto_buffer)
+    if args.buffer_size:
+        monitor.resize(args.buffer_size)
     signal.signal(signal.SIGINT, signalHandler)
+    signal.signal(signal.SIGTERM, signalHandler)
+    if args.chains:
+        # The chains go through whoever does the waking, so we need everybody
+        failed = startTracing(session, True)
+    else:
+        failed = startTracing(session, args.w, args.run, args.pid, args.name)
+    for name in failed:
+        print("Couldn't set %s" % name, file=sys.stderr)
+    if "tracing_on" in failed or "events/sched/sched_switch/enable" in failed:
+        session.restore()
+        sys.exit(1)
+    monitor.reset()
     liveSystem = True
     if args.time:
         runTime = args.time
     else:
         continual = True
+elif len(args.infile) > 1:
+    events = percpu.mergeEvents(percpu.openPerCpuFiles(args.infile, schedEvents))
+elif traceindex.windowed(args):
+    window = traceindex.Window(traceindex.readWindow(args.infile[0], args.start, args.end,
+                                                     args.lookback), args.start)
+    events = window.inside()
+elif (args.jobs > 1 and not args.chains and not traceinput.isCompressed(args.infile[0]) and
+      (args.no_cache or not tracecache.hasCache(args.infile[0]))):
+    splitFile = True
+elif args.no_cache:
+    events = traceinput.readFile(args.infile[0])
 else:
-    infile = open(args.infile, 'r')
+    # The cache can hand us just the rows for the pid/name we're after
+    pids = None
+    name = None
+    if not args.chains:
+        if args.pid:
+            pids = [args.pid]
+        name = args.name
+    wanted = ("sched_switch", "sched_wakeup", "<stack trace>")
+    events = tracecache.readEvents(args.infile[0], pids=pids, name=name,
+                                   wantEvent=lambda event: event in wanted)
 
-processes = {}
-sleeping = {}
-waking = {}
-stacktrace = 0
 start = time.time()
-curEvent = None
-firstTime = 0.0
-lastTime = 0.0
 commandP = None
 exited = False
 devNull = None
 
-if args.run:
+if args.run and not capturePaths:
     devNull = open("/dev/null", 'w')
     commandP = Popen(shlex.split(args.run), stdout=devNull, stderr=devNull)
 
-while 1:
-    results = poll.poll(100)
-    if not results:
-        if exited:
-            break
-        continue
-    while 1:
-        try:
-            line = infile.readline()
-        except:
-            break
-        if traceFile:
-            traceFile.write(line)
-        trace = traceline.traceParseLine(line)
-        if not trace:
-            if stacktrace > 0:
-                func = traceline.parseStacktraceLine(line)
-                if not func:
-                    stacktrace = 0
-                    curEvent = None
-                    continue
-                if not curEvent:
-                    continue
-                if stacktrace == 1:
-                    if curEvent.stacktrace == "":
-                        curEvent.stacktrace = func
-                    else:
-                        curEvent.stacktrace += ":" + func
-                else:
-                    if curEvent.wakeupStacktrace == "":
-                        curEvent.wakeupStacktrace = func
-                    else:
-                        curEvent.wakeupStacktrace += ":" + func
-            continue
-        if firstTime == 0.0:
-            firstTime = trace["timestamp"]
-        else:
-            lastTime = trace["timestamp"]
-        stacktrace = 0
-        curEvent = None
+analyzer = latency.Analyzer(args.collapse, args.pid, args.name)
+graph = None
+if args.chains:
+    graph = wakegraph.WakeGraph(args.collapse, args.pid, args.name)
+if commandP:
+    analyzer.pid = commandP.pid
+    if graph:
+        graph.pid = commandP.pid
 
-        # We can get a couple of sched events before we start to spit out the
-        # stack trace so we need to pay attention to the pid in the stack trace
-        # line and pick out the right event
-        if traceline.isStackTrace(trace["data"]):
-            if trace["pid"] in sleeping:
-                # Sometimes we can miss wakeup messages, and we've already
-                # gotten a stacktrace for this event, if this is the case just
-                # skip this stacktrace and delete this event
-                curEvent = sleeping[trace["pid"]]
-                if curEvent.stacktrace == "":
-                    stacktrace = 1
-                else:
-                    curEvent = None
-                    del sleeping[trace["pid"]]
-            elif trace["pid"] in waking:
-                stacktrace = 2
-                curEvent = waking[trace["pid"]]
-                del waking[trace["pid"]]
-            continue
+# The lookback only tells us what was in flight when the window started
+if window:
+    for trace in window.lookback():
+        analyzer.addEvent(trace)
+        if graph:
+            graph.addEvent(trace)
+    if args.start is not None:
+        analyzer.startWindow(args.start)
+        if graph:
+            graph.startWindow(args.start)
 
-        # Wakeup actions are going to happen from a different PID for a given
-        # PID so we just want to find the sleeper and start the wakeup timer and
-        # then setup a pending waker so we can scrape it's stacktrace
-        eventDict = sched.schedWakeupParse(trace["data"])
-        if eventDict:
-            if eventDict["pid"] in sleeping:
-                e = sleeping[eventDict["pid"]]
-                e.wakeEvent(trace)
-                waking[trace["pid"]] = e
-            continue
+def handleEvents(batch):
+    if traceFile:
+        for trace in batch:
+            traceFile.write(traceline.formatEvent(trace))
+    analyzer.addEvents(batch)
+    if graph:
+        graph.addEvents(batch)
 
-        # Still need to track the sched_switch wakeup part since that is when we
-        # actually load the process onto the CPU and make it do shit.  Only then
-        # we can remove it from our sleeping dict and add it to the process
-        eventDict = sched.schedSwitchParse(trace["data"])
-        if eventDict["next_pid"] in sleeping:
-            e = sleeping[eventDict["next_pid"]]
-            e.wakeup(trace)
-            key = e.trace["pid"]
-            if args.collapse:
-                key = e.trace["comm"]
-            if key in processes:
-                processes[key].addEvent(e)
-            else:
-                processes[key] = Process(e, args.collapse)
-            del sleeping[eventDict["next_pid"]]
+if capturePaths:
+    capture = aiocapture.AsyncCapture(capturePaths, handleEvents,
+                                      maxChunks=args.queue, drop=args.drop)
 
-        # Nobody cares about you idle processes
-        if eventDict["prev_pid"] == 0:
-            continue
+async def watchCommand(process):
+    await process.wait()
+    # trace_pipe will stop once we've gotten the rest of the stuff in the
+    # buffer
+    ftrace.disableFtrace()
+    capture.stop()
 
-        if commandP and eventDict["prev_pid"] != commandP.pid:
-            continue
+async def stopAfter(seconds):
+    await asyncio.sleep(seconds)
+    ftrace.disableFtrace()
+    capture.stop()
 
-        if args.pid and eventDict["prev_pid"] != args.pid:
-            continue
+def printCaptureStats():
+    if capture:
+        print(capture.summary())
+    if monitor:
+        print(monitor.summary())
 
-        # Don't record events about processes we don't care about
-        if args.name and eventDict["prev_comm"].find(args.name) == -1:
-            continue
+def printChains():
+    if graph:
+        print("")
+        wakegraph.printCriticalPaths(graph, args.top)
+        print("")
+        wakegraph.printEdges(graph, args.top)
 
-        e = sched.SchedSwitchEvent(trace, eventDict)
-        sleeping[eventDict["prev_pid"]] = e
-        if not commandP and liveSystem and (time.time() - start) >= runTime:
-            if not continual:
-                toggleEvents(False, args.w)
-                exited = True
-                break
-            printSummary(processes, lastTime - firstTime)
-            firstTime = 0.0
-            processes = {}
-            sleeping = {}
-            waking = {}
-            start = time.time()
+def printAndReset():
+    latency.printSummary(analyzer, args.sort, args.top)
+    printChains()
+    printCaptureStats()
+    analyzer.reset()
+    if graph:
+        graph.reset()
 
-        # Check to see if our command exited, if it did disable polling and
-        # trace_pipe will return EOF once we've gotten the rest of the stuff in
-        # the buffer.
-        if commandP and not exited:
-            retval = commandP.poll()
-            if retval is not None:
-                exited = True
-                ftrace.disableFtrace()
+# Keep an eye on the ring buffers, with --auto-buffer this is what grows them.
+# The monitor is only ever sampled from the event loop, the summaries run on
+# the analysis thread and print what the last sample saw.
+async def sampleBuffers(seconds=1.0):
+    while True:
+        await asyncio.sleep(seconds)
+        monitor.sample()
 
-printSummary(processes, lastTime - firstTime)
+async def summaries(seconds):
+    while True:
+        await asyncio.sleep(seconds)
+        monitor.sample()
+        await capture.call(printAndReset)
+
+async def liveCapture():
+    if args.run:
+        process = await asyncio.create_subprocess_exec(*shlex.split(args.run),
+                                                       stdout=asyncio.subprocess.DEVNULL,
+                                                       stderr=asyncio.subprocess.DEVNULL)
+        analyzer.pid = process.pid
+        if graph:
+            graph.pid = process.pid
+        task = asyncio.ensure_future(watchCommand(process))
+    elif continual:
+        task = asyncio.ensure_future(summaries(runTime))
+    else:
+        task = asyncio.ensure_future(stopAfter(runTime))
+    sampler = asyncio.ensure_future(sampleBuffers())
+    try:
+        await capture.run()
+    finally:
+        task.cancel()
+        sampler.cancel()
+
+if capture:
+    events = []
+    asyncio.run(liveCapture())
+elif splitFile:
+    analyzer = parallel.analyzeLatencyFile(args.infile[0], args.jobs,
+                                           collapse=args.collapse, pid=args.pid,
+                                           name=args.name)
+    events = []
+elif not traceFile and not liveSystem and not graph:
+    # Nothing to do between events, hand them over in one go
+    analyzer.addEvents(events)
+    events = []
+
+sampled = start
+for trace in events:
+    if traceFile:
+        traceFile.write(traceline.formatEvent(trace))
+    analyzer.addEvent(trace)
+    if graph:
+        graph.addEvent(trace)
+    if not liveSystem or exited:
+        continue
+
+    now = time.time()
+    if now - sampled >= 1.0:
+        monitor.sample()
+        sampled = now
+
+    if not commandP and now - start >= runTime:
+        if not continual:
+            # The pipe will give us what's left in the buffer and then stop
+            ftrace.disableFtrace()
+            exited = True
+            continue
+        printAndReset()
+        start = time.time()
+
+    # Check to see if our command exited, if it did disable tracing and
+    # trace_pipe will stop once we've gotten the rest of the stuff in the
+    # buffer.
+    if commandP:
+        retval = commandP.poll()
+        if retval is not None:
+            exited = True
+            ftrace.disableFtrace()
+
+if monitor:
+    # Nothing else is sampling it any more
+    monitor.sample()
+latency.printSummary(analyzer, args.sort, args.top)
+printChains()
+printCaptureStats()
+if args.folded or args.flamegraph:
+    folded = flamegraph.foldStacks(analyzer, args.weight)
+    if args.folded:
+        f = open(args.folded, "w")
+        flamegraph.writeFolded(f, folded)
+        f.close()
+    if args.flamegraph:
+        f = open(args.flamegraph, "w")
+        if args.weight == "sleep":
+            title = "Off-CPU Time"
+        else:
+            title = "Wakeups"
+        flamegraph.writeSvg(f, folded, title, flamegraph.weight_units[args.weight])
+        f.close()
+if session:
+    session.restore()
 if traceFile:
     traceFile.close()
-if args.run:
+if devNull:
     devNull.close()
@@ -0,0 +1,144 @@
+import multiprocessing
+import os
+import latency
+import stats
+import syscall
+import traceinput
+
+# Offline analysis of one big trace file spread over a pool of processes.  The
+# file is cut into byte ranges on line boundaries, every chunk is parsed and
+# aggregated on its own, and the syscalls that were entered in one chunk and
+# exited in a later one are paired back up when we merge the results in file
+# order.
+
+# Find the start of the first trace line at or after offset.  We skip over the
+# " => func" lines of a stack trace so that they stay with their event.
+def lineStart(f, offset, size):
+    if offset <= 0:
+        return 0
+    f.seek(offset - 1)
+    f.readline()
+    while True:
+        pos = f.tell()
+        if pos >= size:
+            return size
+        line = f.readline()
+        if not line.startswith(b" => "):
+            return pos
+
+def splitFile(path, chunks):
+    size = os.path.getsize(path)
+    f = open(path, "rb")
+    offsets = []
+    for i in range(chunks):
+        offsets.append(lineStart(f, size * i // chunks, size))
+    f.close()
+    offsets.append(size)
+    ranges = []
+    for i in range(chunks):
+        if offsets[i] < offsets[i+1]:
+            ranges.append((offsets[i], offsets[i+1]))
+    return ranges
+
+class ChunkResult(object):
+    def __init__(self):
+        # syscall name and pid -> stats.RunningStats for the calls we could
+        # pair up
+        self.calls = stats.StatsTable()
+        self.pidCalls = stats.StatsTable()
+        # (pid, trace, event) for exits of pids we hadn't seen yet in this
+        # chunk, their enter may be pending in an earlier chunk
+        self.exits = []
+        # Every pid we saw a syscall for, and the calls still pending at the
+        # end of the chunk
+        self.pids = set()
+        self.pending = {}
+        self.unmatched = []
+
+    def addCall(self, pid, call):
+        self.calls.add(call.syscall, call.runtime)
+        self.pidCalls.add(pid, call.runtime)
+
+# This mirrors the loop in pytrace.py, except that a pid we haven't seen in this
+# chunk may have an enter pending from an earlier chunk.
+def analyzeChunk(task):
+    path, start, end = task
+    result = ChunkResult()
+    pending = result.pending
+    seen = result.pids
+    for trace in traceinput.readFile(path, result.unmatched.append, start, end):
+        event = trace.fields
+        if isinstance(event, syscall.SyscallEnter):
+            pending[trace.pid] = syscall.Syscall(trace, event)
+            seen.add(trace.pid)
+        elif isinstance(event, syscall.SyscallExit):
+            if trace.pid not in seen:
+                result.exits.append((trace.pid, trace, event))
+                seen.add(trace.pid)
+                continue
+            if trace.pid in pending:
+                call = pending[trace.pid]
+                try:
+                    call.syscallExit(trace.data, trace.timestamp, event)
+                    result.addCall(trace.pid, call)
+                except ValueError:
+                    pass
+                del pending[trace.pid]
+    return result
+
+# Fold the chunk results together in file order, pairing up the exits at the
+# start of every chunk with whatever was still pending for that pid.
+def mergeChunks(results):
+    merged = ChunkResult()
+    pending = {}
+    for result in results:
+        for pid, trace, event in result.exits:
+            if pid not in pending:
+                continue
+            call = pending.pop(pid)
+            try:
+                call.syscallExit(trace.data, trace.timestamp, event)
+                merged.addCall(pid, call)
+            except ValueError:
+                pass
+        for pid in result.pids:
+            pending.pop(pid, None)
+        pending.update(result.pending)
+        merged.calls.merge(result.calls)
+        merged.pidCalls.merge(result.pidCalls)
+        merged.unmatched.extend(result.unmatched)
+    merged.pending = pending
+    return merged
+
+# Run func over every chunk of path, the results come back in file order.
+# The workers have to be forked: pytrace and latencytop do all their work at
+# import time, so a spawned worker would run the whole tool again, and it
+# wouldn't have the syscall table --arch/--syscall-header set up either.
+def mapChunks(func, path, jobs, chunks=None, *extra):
+    if not chunks:
+        chunks = jobs * 4
+    tasks = [(path, start, end) + extra for start, end in splitFile(path, chunks)]
+    pool = multiprocessing.get_context("fork").Pool(jobs)
+    try:
+        return pool.map(func, tasks, 1)
+    finally:
+        pool.close()
+        pool.join()
+
+def analyzeFile(path, jobs, chunks=None):
+    return mergeChunks(mapChunks(analyzeChunk, path, jobs, chunks))
+
+# latencytop's sleeps, every chunk gets its own latency.Analyzer and they
+# sort out the sleeps that span chunks between themselves when merged
+def analyzeLatencyChunk(task):
+    path, start, end, options = task
+    analyzer = latency.Analyzer(**options)
+    analyzer.addEvents(traceinput.readFile(path, None, start, end))
+    return analyzer
+
+def analyzeLatencyFile(path, jobs, chunks=None, **options):
+    results = mapChunks(analyzeLatencyChunk, path, jobs, chunks, options)
+    merged = results[0]
+    for result in results[1:]:
+        merged.merge(result)
+    return merged
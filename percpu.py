@@ -0,0 +1,189 @@
+import heapq
+import os
+import re
+import threading
+import ftrace
+import traceinput
+import traceline
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# Reading trace_pipe makes the kernel merge every CPU's buffer for us under one
+# reader, which can't keep up on big boxes.  Instead we read every
+# per_cpu/cpuN buffer in its own worker and merge the streams back together in
+# timestamp order ourselves.
+
+cpu_file_re = re.compile(r".*cpu(\d+)")
+
+# Workers queue this up when their cpu has nothing more to say for now
+IDLE = "idle"
+
+def timestampKey(trace):
+    return trace.timestamp
+
+# k-way merge of already sorted event streams, this is what we use for the
+# per-cpu dump files where every stream is finite.
+def mergeEvents(streams):
+    return heapq.merge(*streams, key=timestampKey)
+
+def isRawFile(path):
+    f = open(path, "rb")
+    head = f.read(64)
+    f.close()
+    try:
+        head.decode("ascii")
+    except UnicodeDecodeError:
+        return True
+    return b"\0" in head
+
+# Open a set of per-cpu dumps, either the text per_cpu/cpuN/trace files or the
+# binary trace_pipe_raw pages.  For the raw ones we need the event formats, so
+# they have to come from the tracing dir of the box they were captured on.
+def openPerCpuFiles(paths, events=None, traceDir=None):
+    streams = []
+    for i, path in enumerate(paths):
+        m = cpu_file_re.match(os.path.basename(path))
+        cpu = i
+        if m:
+            cpu = int(m.group(1))
+        if not traceinput.isCompressed(path) and isRawFile(path):
+            streams.append(iter(ftrace.RawTraceReader(cpu, events or [],
+                                                      traceDir=traceDir,
+                                                      infile=open(path, "rb"))))
+        else:
+            streams.append(traceinput.readFile(path))
+    return streams
+
+# Live capture from every CPU.  Each worker thread reads its CPU's pipe, parses
+# it and hands batches of events to us through one queue, and an EventMerger
+# puts them back in order.  The workers tell us when their pipe runs dry so an
+# idle CPU doesn't hold up the merge.
+class PerCpuCapture:
+    def __init__(self, cpus=None, events=None, raw=False, stop=None,
+                 batch=256, maxBatches=1024):
+        if cpus is None:
+            cpus = ftrace.getCpus()
+        self.cpus = cpus
+        self.events = events or []
+        self.raw = raw
+        self.stop = stop
+        self.batch = batch
+        self.queue = queue.Queue(maxBatches)
+        self.threads = []
+        self.readers = {}
+        self.reordered = 0
+
+    def _stream(self, cpu, idle):
+        traceDir = ftrace.getTraceDir()
+        if self.raw:
+            reader = ftrace.RawTraceReader(cpu, self.events, traceDir=traceDir,
+                                           stop=self.stop, idle=idle)
+            self.readers[cpu] = reader
+            return iter(reader)
+        path = traceDir+"per_cpu/cpu%d/trace_pipe" % cpu
+        return traceline.readEvents(ftrace.readPipe(path, self.stop, idle))
+
+    def _worker(self, cpu):
+        batch = []
+        # Called when our pipe has nothing left to give us, so everything this
+        # cpu has logged so far is in the queue.
+        def idle():
+            if batch:
+                self.queue.put((cpu, batch[:]))
+                del batch[:]
+            self.queue.put((cpu, IDLE))
+        try:
+            for trace in self._stream(cpu, idle):
+                batch.append(trace)
+                if len(batch) >= self.batch:
+                    self.queue.put((cpu, batch[:]))
+                    del batch[:]
+        finally:
+            if batch:
+                self.queue.put((cpu, batch))
+            self.queue.put((cpu, None))
+
+    def start(self):
+        for cpu in self.cpus:
+            t = threading.Thread(target=self._worker, args=(cpu,))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def missed(self):
+        return sum(r.missed for r in self.readers.values())
+
+    def __iter__(self):
+        if not self.threads:
+            self.start()
+        merger = EventMerger(self.cpus)
+        while merger.running():
+            cpu, batch = self.queue.get()
+            if batch is None:
+                merger.done(cpu)
+            elif batch is IDLE:
+                merger.idle(cpu)
+            else:
+                merger.add(cpu, batch)
+            for trace in merger.ready():
+                yield trace
+            self.reordered = merger.reordered
+
+# Timestamp order merge of batches of events from a set of live sources.  Since
+# an idle CPU may not say anything for a long time we can't wait for every
+# source to have something before we emit an event, so the sources tell us
+# when they run dry and one that is idle stops holding up the merge.  Events
+# that still show up out of order are passed through and counted in reordered.
+class EventMerger:
+    def __init__(self, sources):
+        # Number of events each running source has sitting in the heap, and
+        # the sources that told us they have nothing more for now.
+        self.pending = dict((source, 0) for source in sources)
+        self.idles = set()
+        self.heap = []
+        self.seq = 0
+        self.reordered = 0
+        self.lastTimestamp = 0.0
+
+    def running(self):
+        return bool(self.pending)
+
+    def add(self, source, batch):
+        heap = self.heap
+        seq = self.seq
+        for trace in batch:
+            heapq.heappush(heap, (trace.timestamp, seq, source, trace))
+            seq += 1
+        self.seq = seq
+        self.pending[source] += len(batch)
+        self.idles.discard(source)
+
+    def idle(self, source):
+        self.idles.add(source)
+
+    def done(self, source):
+        del self.pending[source]
+        self.idles.discard(source)
+
+    # The events that are safe to hand out, the oldest event is safe once every
+    # source either has something queued up behind it or is idle.
+    def ready(self):
+        pending = self.pending
+        idles = self.idles
+        heap = self.heap
+        out = []
+        waiting = set(s for s in pending if not pending[s] and s not in idles)
+        while heap and not waiting:
+            timestamp, seq, source, trace = heapq.heappop(heap)
+            if source in pending:
+                pending[source] -= 1
+                if not pending[source] and source not in idles:
+                    waiting.add(source)
+            if timestamp < self.lastTimestamp:
+                self.reordered += 1
+            else:
+                self.lastTimestamp = timestamp
+            out.append(trace)
+        return out
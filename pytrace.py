@@ -1,71 +1,288 @@
 #!/bin/python
 
 import argparse
-import traceline
+import asyncio
+import aiocapture
+import collections
+import ftrace
+import os
+import shlex
+import signal
+import sys
+import time
 import syscall
-import operator
-
-def isLargest(key, haystack):
-    oursum = sum(haystack[key])
-    for item in haystack:
-        if item == key:
-            continue
-        if sum(haystack[item]) > oursum:
-            return False
-    return True 
+import percpu
+import parallel
+import stats
+import report
+import columnar
+import tracecache
+import traceinput
+import traceindex
 
 parser = argparse.ArgumentParser(description="Parse trace files")
-parser.add_argument('infile', metavar='file', help='Trace file to process')
+parser.add_argument('infile', metavar='file', nargs='*',
+                    help='Trace file to process, or a set of per-cpu trace dumps, trace the live system if not given')
+parser.add_argument('-j', '--jobs', type=int, default=1,
+                    help="Split the trace file up and process it with this many processes")
+parser.add_argument('--chunks', type=int,
+                    help="Number of pieces to split the trace file into with --jobs, defaults to 4 per job")
+parser.add_argument('--pids', action='store_true',
+                    help="Also print syscall latencies per pid")
+parser.add_argument('--top', type=int,
+                    help="Only print the top N syscalls (and pids)")
+parser.add_argument('--sort', choices=report.sort_choices, default="total",
+                    help="What to order the report by, defaults to total latency")
+parser.add_argument('--backend', choices=["python", "numpy"], default="python",
+                    help="Aggregate event by event in Python, or load the trace into NumPy arrays first")
+parser.add_argument('--no-cache', action='store_true',
+                    help="Don't read or write the parsed trace cache next to the trace file")
+parser.add_argument('--arch', type=str,
+                    help="Architecture the trace was captured on, for syscall numbers, defaults to ours")
+parser.add_argument('--syscall-header', type=str,
+                    help="unistd header to read syscall numbers from instead of the built in tables")
+parser.add_argument('--no-syscall-cache', action='store_true',
+                    help="Don't read or write the on disk syscall table cache")
+traceindex.addArguments(parser)
+parser.add_argument('-t', '--time', type=float, help="Only trace the live system for this many seconds")
+parser.add_argument('-i', '--interval', type=float,
+                    help="Print a report every this many seconds while tracing the live system")
+parser.add_argument('--window', type=int, default=1,
+                    help="Intervals every report covers, the last one and the ones before it")
+parser.add_argument('-p', '--pid', type=int, help="Only trace this pid")
+parser.add_argument('-r', '--run', type=str, help="Run this command and trace it and its children")
+parser.add_argument('--syscalls', type=str,
+                    help="Comma separated syscalls to trace with their own events instead of raw_syscalls")
+parser.add_argument('--percpu', action='store_true', help="Read every cpu's buffer separately and merge them")
+parser.add_argument('--queue', type=int, default=256,
+                    help="Chunks of trace data we buffer between reading the pipes and the analysis")
+parser.add_argument('--drop', action='store_true',
+                    help="Drop trace data when the queue is full instead of leaving it in the kernel buffer")
+parser.add_argument('--instance', type=str,
+                    help="Trace in our own tracing instance with this name, made for us if it doesn't exist")
 
 args = parser.parse_args()
+if args.backend == "numpy" and not columnar.available():
+    parser.error("--backend numpy needs numpy installed")
+if traceindex.windowed(args):
+    if len(args.infile) != 1:
+        parser.error("--from/--to need a single trace file")
+
+try:
+    syscall.setArch(args.arch, not args.no_syscall_cache, args.syscall_header)
+except IOError as e:
+    parser.error("can't read --syscall-header: %s" % e)
+if not syscall.syscall_table.table:
+    print("No syscall table for %s, raw syscalls show up as NR_<n>, pass --syscall-header "
+          "with its unistd header for names" % syscall.syscall_table.arch, file=sys.stderr)
+
+def noMatch(line):
+    print("no match for '%s'" % line.rstrip())
+
+# Everything is aggregated as soon as a call exits, so we only ever hold on to
+# the calls that are still in flight, one per pid.
+call_times = stats.StatsTable()
+pid_times = stats.StatsTable()
+
+def openEvents():
+    if len(args.infile) > 1:
+        return percpu.mergeEvents(percpu.openPerCpuFiles(args.infile,
+                                  ["raw_syscalls/sys_enter", "raw_syscalls/sys_exit"]))
+    if args.no_cache:
+        return traceinput.readFile(args.infile[0], noMatch)
+    return tracecache.readEvents(args.infile[0], noMatch,
+                                 wantEvent=lambda event: event.startswith("sys_"))
+
+def printStats(title, table):
+    report.printTable(report.latencyRows(title, table, args.sort, args.top))
+
+def printReport(calls, pids):
+    printStats("Call", calls)
+    if args.pids:
+        print("")
+        printStats("Pid", pids)
 
-infile = open(args.infile, "r")
-
-calls = []
-pending_calls = {}
-
-for line in infile:
-    trace = traceline.traceParseLine(line)
-    if not trace:
-        print("no match for '%s'" % line.rstrip())
-        continue
-    if syscall.isSyscall(trace["data"]):
-        if syscall.isSyscallEnter(trace["data"]):
-            call = syscall.Syscall(trace)
-            pending_calls[trace["pid"]] = call
-        elif syscall.isSyscallExit(trace["data"]):
-            if trace["pid"] in pending_calls:
-                call = pending_calls[trace["pid"]]
-                try:
-                    call.syscallExit(trace["data"], trace["timestamp"])
-                    calls.append(call)
-                except ValueError:
-                    # do nothing, we just didn't have a match
-                    pass
-                del pending_calls[trace["pid"]]
-
-call_times = {}
-for call in calls:
-    if call.syscall in call_times:
-        call_times[call.syscall].append(call.runtime)
+# Live tracing
+session = None
+
+def signalHandler(signal, frame):
+    if session:
+        session.restore()
+    sys.exit(0)
+
+def traceEvents():
+    if not args.syscalls:
+        return ["raw_syscalls/sys_enter", "raw_syscalls/sys_exit"]
+    events = []
+    for name in args.syscalls.split(","):
+        events += ["syscalls/sys_enter_" + name.strip(), "syscalls/sys_exit_" + name.strip()]
+    return events
+
+# Push the pid filtering down into the kernel.  Returns the pid we still have
+# to check for ourselves, the kernel may not have taken the filters.  With fork
+# we can only do that for the command itself, not whatever it starts, so we
+# leave it to the kernel if it has set_event_pid.
+def setFilters(events, pid=None, fork=False):
+    if pid is None:
+        # Don't watch ourselves reading the trace
+        for event in events:
+            ftrace.setEventFilter(event, ftrace.fieldFilter(["common_pid"], "!=", [os.getpid()]))
+        return None
+    if ftrace.filterEventPids([pid], fork):
+        if fork:
+            return None
+    elif not fork:
+        for event in events:
+            ftrace.setEventFilter(event, ftrace.pidFilter(["common_pid"], [pid]))
+    return pid
+
+def alive(pid):
+    return os.path.exists("/proc/%d" % pid)
+
+def live():
+    global session
+    if ftrace.getTraceDir() == "":
+        print("Please mount tracefs or debugfs to use this feature")
+        sys.exit(1)
+    session = ftrace.TraceSession(args.instance)
+    try:
+        session.start()
+    except OSError as e:
+        print("Couldn't create tracing instance %s: %s" % (args.instance, e))
+        sys.exit(1)
+    signal.signal(signal.SIGINT, signalHandler)
+    signal.signal(signal.SIGTERM, signalHandler)
+    traceDir = ftrace.getTraceDir()
+    if args.percpu:
+        paths = dict((cpu, traceDir+"per_cpu/cpu%d/trace_pipe" % cpu)
+                     for cpu in ftrace.getCpus())
     else:
-        call_times[call.syscall] = [ call.runtime ]
-
-output = [["Call", "Average lat", "Min lat", "Max lat", "Total Lat", "Num of calls"]]
-while call_times:
-    for k in call_times.keys():
-        if not isLargest(k, call_times):
-            continue
-        row = []
-        row.append(k)
-        row.append("%f" % (sum(call_times[k]) / len(call_times[k])))
-        row.append("%f" % min(call_times[k]))
-        row.append("%f" % max(call_times[k]))
-        row.append("%f" % sum(call_times[k]))
-        row.append("%d" % len(call_times[k]))
-        output.append(row)
-        del call_times[k]
-    
-col_width = max(len(word) for row in output for word in row) + 2
-for row in output:
-    print "".join(word.ljust(col_width)  for word in row)
+        paths = { "trace_pipe" : traceDir+"trace_pipe" }
+    events = traceEvents()
+    calls = stats.RollingTable(args.window)
+    pids = stats.RollingTable(args.window)
+    aggregator = syscall.SyscallAggregator(calls, pids)
+    wanted = [None]
+
+    def handleEvents(batch):
+        pid = wanted[0]
+        if pid is not None:
+            batch = [trace for trace in batch if trace.pid == pid]
+        aggregator.addEvents(batch)
+
+    capture = aiocapture.AsyncCapture(paths, handleEvents, maxChunks=args.queue,
+                                      drop=args.drop)
+
+    def startTracing(pid=None, fork=False):
+        wanted[0] = setFilters(events, pid, fork)
+        for event in events:
+            ftrace.enableEvent(event)
+        ftrace.clearTraceBuffer()
+        ftrace.enableFtrace()
+        failed = session.apply()
+        for name in failed:
+            print("Couldn't set %s" % name, file=sys.stderr)
+        if "tracing_on" in failed or [name for name in failed if name.endswith("/enable")]:
+            session.restore()
+            sys.exit(1)
+
+    # When every interval in the window started
+    starts = collections.deque([time.time()], maxlen=args.window)
+    def printAndRotate():
+        now = time.time()
+        print("Syscall latencies over the last %.1f seconds" % (now - starts[0]))
+        printReport(calls.window(), pids.window())
+        aggregator.evict(alive)
+        print(capture.summary())
+        print("%d calls in flight, %d dropped for pids that exited" %
+              (len(aggregator.pending), aggregator.evicted))
+        print("")
+        calls.rotate()
+        pids.rotate()
+        starts.append(now)
+
+    async def stopAfter(seconds):
+        await asyncio.sleep(seconds)
+        ftrace.disableFtrace()
+        capture.stop()
+
+    async def reports(seconds):
+        while True:
+            await asyncio.sleep(seconds)
+            await capture.call(printAndRotate)
+
+    async def runCommand():
+        # The shell waits for us to let it go on fd 3, so the command doesn't
+        # get to do anything before we're tracing it
+        gate, release = os.pipe()
+        process = await asyncio.create_subprocess_exec(
+            "sh", "-c", 'read _ <&%d; exec "$@"' % gate, "sh", *shlex.split(args.run),
+            pass_fds=(gate,), stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL)
+        os.close(gate)
+        startTracing(process.pid, fork=True)
+        os.write(release, b"\n")
+        os.close(release)
+        await process.wait()
+        # trace_pipe will stop once we've gotten the rest of the stuff in the
+        # buffer
+        ftrace.disableFtrace()
+        capture.stop()
+
+    async def main():
+        tasks = []
+        if args.run:
+            tasks.append(asyncio.ensure_future(runCommand()))
+        else:
+            startTracing(args.pid)
+        if args.time:
+            tasks.append(asyncio.ensure_future(stopAfter(args.time)))
+        interval = args.interval
+        if not interval and not args.time and not args.run:
+            # We'll run until we're killed, so say something now and then
+            interval = 5
+        if interval:
+            tasks.append(asyncio.ensure_future(reports(interval)))
+        try:
+            await capture.run()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    asyncio.run(main())
+    printAndRotate()
+    session.restore()
+
+if not args.infile:
+    live()
+    sys.exit(0)
+
+if traceindex.windowed(args):
+    window = traceindex.Window(traceindex.readWindow(args.infile[0], args.start, args.end,
+                                                     args.lookback, noMatch), args.start)
+    # The lookback only tells us what was in flight when the window started
+    if args.backend == "numpy":
+        cols = columnar.loadSyscalls(window.lookback())
+        first = len(cols)
+        columnar.loadSyscalls(window.inside(), cols)
+        call_times, pid_times = columnar.syscallStats(cols, first)
+    else:
+        aggregator = syscall.SyscallAggregator(stats.StatsTable(), stats.StatsTable())
+        aggregator.addEvents(window.lookback())
+        aggregator.calls = call_times
+        aggregator.pids = pid_times
+        aggregator.addEvents(window.inside())
+elif args.backend == "numpy":
+    call_times, pid_times = columnar.syscallStats(columnar.loadSyscalls(openEvents()))
+elif (args.jobs > 1 and len(args.infile) == 1 and
+      not traceinput.isCompressed(args.infile[0]) and
+      (args.no_cache or not tracecache.hasCache(args.infile[0]))):
+    result = parallel.analyzeFile(args.infile[0], args.jobs, args.chunks)
+    for line in result.unmatched:
+        noMatch(line)
+    call_times = result.calls
+    pid_times = result.pidCalls
+else:
+    syscall.aggregateSyscalls(openEvents(), call_times, pid_times)
+
+printReport(call_times, pid_times)
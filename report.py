@@ -0,0 +1,51 @@
+import heapq
+
+# Shared bits for ordering and printing the tables the tools spit out.  Rows
+# are anything that looks like a stats.Histogram, they need total, count,
+# average and percentile().
+
+sort_choices = ["total", "count", "avg", "p50", "p90", "p99", "p99.9"]
+
+def sortKey(sort):
+    if sort == "total":
+        return lambda s: s.total
+    if sort == "count":
+        return lambda s: s.count
+    if sort == "avg":
+        return lambda s: s.average
+    if sort.startswith("p"):
+        p = float(sort[1:])
+        return lambda s: s.percentile(p)
+    raise ValueError("unknown sort key '%s'" % sort)
+
+# The (key, stats) pairs of table, biggest first.  With top we only want the
+# first few, so keep a heap of those rather than sorting the lot.  Ties keep
+# the table's order either way.
+def topItems(table, sort="total", top=None):
+    key = sortKey(sort)
+    itemKey = lambda item: key(item[1])
+    if top:
+        return heapq.nlargest(top, table.items(), key=itemKey)
+    return sorted(table.items(), key=itemKey, reverse=True)
+
+def printTable(rows):
+    col_width = max(len(word) for row in rows for word in row) + 2
+    for row in rows:
+        print("".join(word.ljust(col_width)  for word in row))
+
+# pytrace's latency table, a header and a row per key of table
+def latencyRows(title, table, sort="total", top=None):
+    output = [[title, "Average lat", "Min lat", "Max lat", "p50 lat", "p90 lat",
+               "p99 lat", "p99.9 lat", "Total Lat", "Num of calls"]]
+    for k, s in topItems(table, sort, top):
+        row = []
+        row.append(str(k))
+        row.append("%f" % s.average)
+        row.append("%f" % s.min)
+        row.append("%f" % s.max)
+        for value in s.percentiles():
+            row.append("%f" % value)
+        row.append("%f" % s.total)
+        row.append("%d" % s.count)
+        output.append(row)
+    return output
@@ -0,0 +1,279 @@
+#!/bin/python
+
+import argparse
+import json
+import sys
+import percpu
+import report
+# For the sched_switch/sched_wakeup decoders
+import sched
+import stats
+import tracecache
+import traceindex
+import traceinput
+
+# The scheduler from the cpus' point of view.  From sched_switch we get how
+# long every cpu was busy and how long it sat in the idle task (pid 0), from a
+# sched_wakeup to the sched_switch that puts the task on a cpu how long it
+# waited in that cpu's runqueue, and from the cpu a task last ran on to the
+# one it runs on next which cpu moved work to which.
+#
+# Per cpu state is a handful of lists indexed by cpu, and the per task state
+# is a pending wakeup and the last cpu, which go when the task exits.  So this
+# stays small with hundreds of cpus and however many events we throw at it.
+# Runqueue waits go into a stats.Histogram per cpu, the migrations into a
+# sparse matrix.
+
+class RunqueueAnalyzer:
+    def __init__(self):
+        self.cpus = 0
+        # Per cpu, when it last switched (None until we've seen it switch),
+        # what's on it now, and the totals
+        self.since = []
+        self.current = []
+        self.busy = []
+        self.idle = []
+        self.switches = []
+        self.wakeups = []
+        self.rqWait = []
+        self.migratedIn = []
+        self.migratedOut = []
+        # (from cpu, to cpu) -> migrations
+        self.migrations = {}
+        # pid -> when it was woken, pid -> the cpu it last ran on
+        self.waking = {}
+        self.lastCpu = {}
+        self.firstTime = None
+        self.lastTime = 0.0
+
+    def addCpus(self, cpus):
+        while self.cpus < cpus:
+            self.since.append(None)
+            self.current.append(None)
+            self.busy.append(0.0)
+            self.idle.append(0.0)
+            self.switches.append(0)
+            self.wakeups.append(0)
+            self.rqWait.append(stats.Histogram())
+            self.migratedIn.append(0)
+            self.migratedOut.append(0)
+            self.cpus += 1
+
+    def addEvents(self, events):
+        events = iter(events)
+        if self.firstTime is None:
+            for trace in events:
+                self.addEvent(trace)
+                break
+        switch = self.switch
+        wakeEvent = self.wakeEvent
+        trace = None
+        for trace in events:
+            if trace.event == "sched_switch":
+                if trace.fields:
+                    switch(trace, trace.fields)
+            elif trace.event == "sched_wakeup":
+                if trace.fields:
+                    wakeEvent(trace, trace.fields)
+        if trace is not None:
+            self.lastTime = trace.timestamp
+
+    def addEvent(self, trace):
+        if self.firstTime is None:
+            self.firstTime = trace.timestamp
+        self.lastTime = trace.timestamp
+        if trace.event == "sched_switch":
+            if trace.fields:
+                self.switch(trace, trace.fields)
+        elif trace.event == "sched_wakeup":
+            if trace.fields:
+                self.wakeEvent(trace, trace.fields)
+
+    def wakeEvent(self, trace, event):
+        if event.cpu >= self.cpus:
+            self.addCpus(event.cpu + 1)
+        self.wakeups[event.cpu] += 1
+        self.waking[event.pid] = trace.timestamp
+
+    def switch(self, trace, event):
+        cpu = trace.cpu
+        now = trace.timestamp
+        if cpu >= self.cpus:
+            self.addCpus(cpu + 1)
+        since = self.since[cpu]
+        if since is not None:
+            if event.prev_pid == 0:
+                self.idle[cpu] += now - since
+            else:
+                self.busy[cpu] += now - since
+        self.since[cpu] = now
+        self.switches[cpu] += 1
+        if event.prev_state[:1] in ("X", "Z"):
+            self.lastCpu.pop(event.prev_pid, None)
+            self.waking.pop(event.prev_pid, None)
+        pid = event.next_pid
+        self.current[cpu] = pid
+        if pid == 0:
+            return
+        woken = self.waking.pop(pid, None)
+        if woken is not None:
+            self.rqWait[cpu].add(now - woken)
+        last = self.lastCpu.get(pid)
+        if last != cpu:
+            if last is not None:
+                key = (last, cpu)
+                self.migrations[key] = self.migrations.get(key, 0) + 1
+                self.migratedOut[last] += 1
+                self.migratedIn[cpu] += 1
+            self.lastCpu[pid] = cpu
+
+    # Only count what happens from timestamp on, what's running and waiting
+    # carries on from there
+    def startWindow(self, timestamp):
+        for cpu in range(self.cpus):
+            self.busy[cpu] = 0.0
+            self.idle[cpu] = 0.0
+            self.switches[cpu] = 0
+            self.wakeups[cpu] = 0
+            self.rqWait[cpu] = stats.Histogram()
+            self.migratedIn[cpu] = 0
+            self.migratedOut[cpu] = 0
+            if self.since[cpu] is not None:
+                self.since[cpu] = max(self.since[cpu], timestamp)
+        self.migrations = {}
+        for pid, woken in self.waking.items():
+            if woken < timestamp:
+                self.waking[pid] = timestamp
+        self.firstTime = timestamp
+        self.lastTime = timestamp
+
+    # Busy and idle seconds of cpu, counting whatever it's running now up to
+    # the last event we saw
+    def cpuTimes(self, cpu):
+        busy = self.busy[cpu]
+        idle = self.idle[cpu]
+        since = self.since[cpu]
+        if since is not None and self.lastTime > since:
+            if self.current[cpu] == 0:
+                idle += self.lastTime - since
+            else:
+                busy += self.lastTime - since
+        return busy, idle
+
+    @property
+    def totalTime(self):
+        if self.firstTime is None:
+            return 0.0
+        return self.lastTime - self.firstTime
+
+    # Everything as plain dicts and lists, for json
+    def toDict(self):
+        cpus = []
+        for cpu in range(self.cpus):
+            busy, idle = self.cpuTimes(cpu)
+            wait = self.rqWait[cpu]
+            cpus.append({
+                "cpu" : cpu,
+                "busy" : busy,
+                "idle" : idle,
+                "switches" : self.switches[cpu],
+                "wakeups" : self.wakeups[cpu],
+                "runqueue_wait" : {
+                    "count" : wait.count,
+                    "total" : wait.total,
+                    "average" : wait.average,
+                    "max" : wait.max or 0.0,
+                    "p50" : wait.percentile(50),
+                    "p90" : wait.percentile(90),
+                    "p99" : wait.percentile(99),
+                    "p99.9" : wait.percentile(99.9),
+                },
+                "migrated_in" : self.migratedIn[cpu],
+                "migrated_out" : self.migratedOut[cpu],
+            })
+        return {
+            "total_time" : self.totalTime,
+            "cpus" : cpus,
+            "migrations" : [[src, dst, n] for (src, dst), n in sorted(self.migrations.items())],
+        }
+
+# Anything wider than this gets the busiest pairs instead of a full matrix
+MATRIX_CPUS = 16
+
+def printReport(analyzer, top=None):
+    totalTime = analyzer.totalTime
+    print("Total time run %f seconds" % totalTime)
+    rows = [["CPU", "Busy", "Idle", "Util %", "Switches", "Wakeups", "RQ wait avg",
+             "RQ p50", "RQ p90", "RQ p99", "RQ max", "Migr in", "Migr out"]]
+    for cpu in range(analyzer.cpus):
+        busy, idle = analyzer.cpuTimes(cpu)
+        wait = analyzer.rqWait[cpu]
+        util = 0.0
+        if busy + idle:
+            util = busy * 100.0 / (busy + idle)
+        rows.append(["%d" % cpu, "%f" % busy, "%f" % idle, "%.2f" % util,
+                     "%d" % analyzer.switches[cpu], "%d" % analyzer.wakeups[cpu],
+                     "%f" % wait.average]
+                    + ["%f" % v for v in wait.percentiles((50, 90, 99))]
+                    + ["%f" % (wait.max or 0.0), "%d" % analyzer.migratedIn[cpu],
+                       "%d" % analyzer.migratedOut[cpu]])
+    report.printTable(rows)
+    print("")
+    if not analyzer.migrations:
+        print("No migrations")
+        return
+    if analyzer.cpus <= MATRIX_CPUS and not top:
+        print("Migrations, from cpu (rows) to cpu (columns)")
+        rows = [["from\\to"] + ["%d" % cpu for cpu in range(analyzer.cpus)]]
+        for src in range(analyzer.cpus):
+            rows.append(["%d" % src] + ["%d" % analyzer.migrations.get((src, dst), 0)
+                                        for dst in range(analyzer.cpus)])
+        report.printTable(rows)
+        return
+    print("Migrations")
+    rows = [["From", "To", "Count"]]
+    pairs = sorted(analyzer.migrations.items(), key=lambda item: item[1], reverse=True)
+    for (src, dst), n in pairs[:top or 20]:
+        rows.append(["%d" % src, "%d" % dst, "%d" % n])
+    report.printTable(rows)
+
+def openEvents(args):
+    wanted = ("sched_switch", "sched_wakeup")
+    if len(args.infile) > 1:
+        return percpu.mergeEvents(percpu.openPerCpuFiles(args.infile,
+                                  ["sched/sched_switch", "sched/sched_wakeup"]))
+    if args.no_cache:
+        return traceinput.readFile(args.infile[0])
+    return tracecache.readEvents(args.infile[0], wantEvent=lambda event: event in wanted)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Per cpu busy time, runqueue waits and migrations")
+    parser.add_argument('infile', nargs='+', help='Trace file to process, or a set of per-cpu trace dumps')
+    parser.add_argument('--top', type=int, help="Only print the top N migration pairs")
+    parser.add_argument('--json', type=str, help="Write the results as JSON to this file, - for stdout")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="Don't read or write the parsed trace cache next to the trace file")
+    traceindex.addArguments(parser)
+    args = parser.parse_args()
+    analyzer = RunqueueAnalyzer()
+    if traceindex.windowed(args):
+        if len(args.infile) != 1:
+            parser.error("--from/--to need a single trace file")
+        window = traceindex.Window(traceindex.readWindow(args.infile[0], args.start, args.end,
+                                                         args.lookback), args.start)
+        # The lookback only tells us what was running and waiting
+        analyzer.addEvents(window.lookback())
+        if args.start is not None:
+            analyzer.startWindow(args.start)
+        analyzer.addEvents(window.inside())
+    else:
+        analyzer.addEvents(openEvents(args))
+    if args.json == "-":
+        json.dump(analyzer.toDict(), sys.stdout, indent=2)
+        print("")
+    else:
+        printReport(analyzer, args.top)
+        if args.json:
+            f = open(args.json, "w")
+            json.dump(analyzer.toDict(), f, indent=2)
+            f.close()
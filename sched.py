@@ -1,5 +1,8 @@
 import re
-from traceline import TraceLine
+from sys import intern
+import traceline
+import stacks
+from traceline import TraceLine, Record
 from ftrace import TimeRange
 
 # 3.14
@@ -37,7 +40,98 @@ def schedWakeupParse(trace):
     event["cpu"] = int(m.group(3))
     return event
 
+# prev_state is the state letters the way the kernel prints them, "R+", "D",
+# "X" for a task that just exited...
+class SchedSwitch(Record):
+    __slots__ = ("prev_comm", "prev_pid", "next_comm", "next_pid", "prev_state")
+
+    def __init__(self, prev_comm, prev_pid, next_comm, next_pid, prev_state=""):
+        self.prev_comm = intern(prev_comm)
+        self.prev_pid = prev_pid
+        self.next_comm = intern(next_comm)
+        self.next_pid = next_pid
+        self.prev_state = intern(prev_state)
+
+class SchedWakeup(Record):
+    __slots__ = ("comm", "pid", "cpu")
+
+    def __init__(self, comm, pid, cpu):
+        self.comm = intern(comm)
+        self.pid = pid
+        self.cpu = cpu
+
+# Fast versions of schedSwitchParse/schedWakeupParse for traceline.parseLine,
+# these split on the field names instead of running the REs.
+def decodeSchedSwitch(event, data):
+    prev, sep, next = data.partition(" ==> ")
+    if not sep or not prev.startswith("sched_switch: prev_comm="):
+        return None
+    i = prev.rfind(" prev_pid=")
+    j = next.rfind(" next_pid=")
+    if i == -1 or j == -1 or not next.startswith("next_comm="):
+        return None
+    try:
+        prev_pid = int(prev[i+10:].split(" ", 1)[0])
+        next_pid = int(next[j+10:].split(" ", 1)[0])
+    except ValueError:
+        return None
+    k = prev.find(" prev_state=", i)
+    state = ""
+    if k != -1:
+        state = prev[k+12:]
+    return SchedSwitch(prev[24:i], prev_pid, next[10:j], next_pid, state)
+
+def decodeSchedWakeup(event, data):
+    if not data.startswith("sched_wakeup: comm="):
+        return None
+    i = data.rfind(" pid=")
+    j = data.rfind(" target_cpu=")
+    if i == -1 or j == -1:
+        return None
+    try:
+        pid = int(data[i+5:j].split(" ", 1)[0])
+        cpu = int(data[j+12:])
+    except ValueError:
+        return None
+    return SchedWakeup(data[19:i], pid, cpu)
+
+# Task state letters as the kernel prints them for prev_state
+task_state_chars = "SDTtXZPI"
+
+def taskStateString(state):
+    if state == 0:
+        return "R"
+    ret = [c for i, c in enumerate(task_state_chars) if state & (1 << i)]
+    if not ret:
+        return "R+"
+    return "|".join(ret)
+
+def rawSchedSwitch(event, values):
+    fields = SchedSwitch(values["prev_comm"], values["prev_pid"],
+                         values["next_comm"], values["next_pid"],
+                         taskStateString(values.get("prev_state", 0)))
+    data = ("sched_switch: prev_comm=%s prev_pid=%d prev_prio=%d prev_state=%s ==> next_comm=%s next_pid=%d next_prio=%d" %
+            (fields.prev_comm, fields.prev_pid, values.get("prev_prio", 0),
+             fields.prev_state, fields.next_comm, fields.next_pid,
+             values.get("next_prio", 0)))
+    return (data, fields)
+
+def rawSchedWakeup(event, values):
+    fields = SchedWakeup(values["comm"], values["pid"], values["target_cpu"])
+    data = ("sched_wakeup: comm=%s pid=%d prio=%d success=%d target_cpu=%03d" %
+            (fields.comm, fields.pid, values.get("prio", 0),
+             values.get("success", 1), fields.cpu))
+    return (data, fields)
+
+traceline.registerDecoder("sched_switch", decodeSchedSwitch)
+traceline.registerDecoder("sched_wakeup", decodeSchedWakeup)
+traceline.registerRawDecoder("sched_switch", rawSchedSwitch)
+traceline.registerRawDecoder("sched_wakeup", rawSchedWakeup)
+
 class SchedSwitchEvent(TraceLine):
+    __slots__ = ("event", "sleepRanges", "timeToWake", "stacktrace",
+                 "wakeupStacktrace", "changeCpu", "woken", "hadWakeEvent")
+
     def __init__(self, trace, event=None):
         TraceLine.__init__(self, trace)
         if not event:
@@ -49,8 +143,9 @@ class SchedSwitchEvent(TraceLine):
             raise ValueError
         self.sleepRanges = None
         self.timeToWake = 0.0
-        self.stacktrace = ""
-        self.wakeupStacktrace = ""
+        # Stack ids from a stacks.StackTable
+        self.stacktrace = stacks.EMPTY
+        self.wakeupStacktrace = stacks.EMPTY
         self.changeCpu = False
         self.woken = 0.0
         self.hadWakeEvent = False
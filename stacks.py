@@ -0,0 +1,67 @@
+# Interning for stack traces.  Every distinct function gets an int, every
+# distinct stack (a tuple of those ints) gets an int, and everything that
+# aggregates by stack keys off the stack id.  With the stacktrace option on we
+# see the same handful of stacks over and over, so this saves us building and
+# hashing the same long strings for every event and keeps one copy of every
+# stack around no matter how many times we saw it.
+
+# The id of the empty stack, for events we never got a stack trace for
+EMPTY = 0
+
+class StackTable:
+    def __init__(self):
+        self.frameIds = {}
+        self.frameNames = []
+        self.stackIds = { () : EMPTY }
+        self.stackFrames = [()]
+        # The names of a stack joined into one string -> stack id, joining is
+        # a lot cheaper than hashing a tuple of fresh strings, and we only have
+        # to look up the frames the first time we see a stack
+        self.byNames = { "" : EMPTY }
+
+    def frameId(self, name):
+        try:
+            return self.frameIds[name]
+        except KeyError:
+            i = self.frameIds[name] = len(self.frameNames)
+            self.frameNames.append(name)
+            return i
+
+    def _stackId(self, key):
+        try:
+            return self.stackIds[key]
+        except KeyError:
+            i = self.stackIds[key] = len(self.stackFrames)
+            self.stackFrames.append(key)
+            return i
+
+    # The id of a stack given as a sequence of function names
+    def intern(self, frames):
+        key = "\n".join(frames)
+        try:
+            return self.byNames[key]
+        except KeyError:
+            pass
+        i = self._stackId(tuple([self.frameId(name) for name in frames]))
+        self.byNames[key] = i
+        return i
+
+    # The id of stack a with stack b tacked on the end
+    def concat(self, a, b):
+        if a == EMPTY:
+            return b
+        if b == EMPTY:
+            return a
+        return self._stackId(self.stackFrames[a] + self.stackFrames[b])
+
+    # The function names of a stack id
+    def frames(self, stack):
+        names = self.frameNames
+        return [names[i] for i in self.stackFrames[stack]]
+
+    # Our ids for every stack in other, other's stack i is our stack ids[i]
+    def merge(self, other):
+        return [self.intern(other.frames(i)) for i in range(len(other))]
+
+    def __len__(self):
+        return len(self.stackFrames)
@@ -0,0 +1,166 @@
+import collections
+import math
+
+# Add x to a list of non-overlapping partial sums, this is the msum() recipe
+# from the Python cookbook (Shewchuk's algorithm).  math.fsum() of the partials
+# is the correctly rounded sum of everything we've added, no matter what order
+# the values came in, so stats that were built up in pieces and merged come
+# out exactly the same as stats built up in one go.
+def addPartial(partials, x):
+    i = 0
+    for y in partials:
+        if abs(x) < abs(y):
+            x, y = y, x
+        hi = x + y
+        lo = y - (hi - x)
+        if lo:
+            partials[i] = lo
+            i += 1
+        x = hi
+    partials[i:] = [x]
+
+# count/total/min/max of a series of values, mergeable with other RunningStats
+class RunningStats(object):
+    __slots__ = ("count", "min", "max", "partials")
+
+    def __init__(self):
+        self.count = 0
+        self.min = None
+        self.max = None
+        self.partials = []
+
+    def add(self, value):
+        if self.count == 0:
+            self.min = value
+            self.max = value
+        elif value < self.min:
+            self.min = value
+        elif value > self.max:
+            self.max = value
+        self.count += 1
+        addPartial(self.partials, value)
+
+    def merge(self, other):
+        if not other.count:
+            return
+        if self.count == 0 or other.min < self.min:
+            self.min = other.min
+        if self.count == 0 or other.max > self.max:
+            self.max = other.max
+        self.count += other.count
+        for value in other.partials:
+            addPartial(self.partials, value)
+
+    @property
+    def total(self):
+        return math.fsum(self.partials)
+
+    @property
+    def average(self):
+        if not self.count:
+            return 0.0
+        return self.total / self.count
+
+# Log bucketed histogram in the spirit of HdrHistogram.  Every power of two
+# gets subBuckets linear buckets, so a bucket is never wider than
+# 1/subBuckets of the values in it and percentiles come back within that
+# relative error no matter how many values we add.  Buckets live in a dict and
+# only the ones we use exist, and values below lowest (1ns, we are dealing in
+# seconds) all count as zero, so the size is bounded by the range of values
+# rather than how many of them there are.  Histograms merge exactly by adding
+# up bucket counts.
+SUB_BUCKET_BITS = 6
+
+class Histogram(RunningStats):
+    __slots__ = ("buckets", "zeros")
+    subBuckets = 1 << SUB_BUCKET_BITS
+    lowest = 1e-9
+
+    def __init__(self):
+        RunningStats.__init__(self)
+        self.buckets = {}
+        self.zeros = 0
+
+    def bucketIndex(self, value):
+        m, e = math.frexp(value)
+        return e * self.subBuckets + int((m - 0.5) * 2 * self.subBuckets)
+
+    def bucketStart(self, index):
+        e, s = divmod(index, self.subBuckets)
+        return math.ldexp(0.5 + s / (2.0 * self.subBuckets), e)
+
+    def add(self, value):
+        RunningStats.add(self, value)
+        if value < self.lowest:
+            self.zeros += 1
+            return
+        i = self.bucketIndex(value)
+        self.buckets[i] = self.buckets.get(i, 0) + 1
+
+    def merge(self, other):
+        RunningStats.merge(self, other)
+        self.zeros += other.zeros
+        for i, n in other.buckets.items():
+            self.buckets[i] = self.buckets.get(i, 0) + n
+
+    # The value at the given percentile (0-100), the middle of the bucket it
+    # falls in, but never outside of the min and max we actually saw.
+    def percentile(self, p):
+        if not self.count:
+            return 0.0
+        if p >= 100:
+            return self.max
+        want = max(1, int(math.ceil(self.count * p / 100.0)))
+        seen = self.zeros
+        if seen >= want:
+            return max(self.min, 0.0)
+        value = self.max
+        for i in sorted(self.buckets):
+            seen += self.buckets[i]
+            if seen >= want:
+                value = (self.bucketStart(i) + self.bucketStart(i + 1)) / 2
+                break
+        return min(max(value, self.min), self.max)
+
+    def percentiles(self, ps=(50, 90, 99, 99.9)):
+        return [self.percentile(p) for p in ps]
+
+# Histogram per key (syscall name, pid...), created as we first see a key
+class StatsTable(dict):
+    def add(self, key, value):
+        try:
+            s = self[key]
+        except KeyError:
+            s = self[key] = Histogram()
+        s.add(value)
+
+    def merge(self, other):
+        for key in other:
+            if key not in self:
+                self[key] = Histogram()
+            self[key].merge(other[key])
+
+# StatsTables for the last few intervals of a live trace, for reports over a
+# sliding window.  Values go into the newest table, rotate() starts the next
+# interval and forgets the oldest, and window() is everything still in the
+# window.  Nothing gets re-added, a report is at most a merge of intervals
+# tables.
+class RollingTable:
+    def __init__(self, intervals=1):
+        self.tables = collections.deque(maxlen=intervals)
+        self.rotate()
+
+    def rotate(self):
+        self.current = StatsTable()
+        self.tables.append(self.current)
+
+    def add(self, key, value):
+        self.current.add(key, value)
+
+    def window(self):
+        if len(self.tables) == 1:
+            return self.current
+        merged = StatsTable()
+        for table in self.tables:
+            merged.merge(table)
+        return merged
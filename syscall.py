@@ -1,6 +1,7 @@
-from traceline import TraceLine
+import traceline
+from traceline import TraceLine, Record
 import re
-import subprocess
+import syscalltable
 
 sys_enter_re = re.compile("sys_.*\(.*\)")
 raw_sys_enter_re = re.compile("sys_enter: .*")
@@ -13,6 +14,7 @@ match_sys_enter_re = re.compile("(sys_.*)\((.*)\)")
 match_raw_sys_exit_re = re.compile("sys_exit: NR (-*\d+) = (-*\d+)")
 match_sys_exit_re = re.compile("(sys_.*) -> 0x(\d+)")
 syscall_dict = {}
+syscall_table = None
 
 def isSyscall(trace):
     return trace.find("sys_") != -1
@@ -35,50 +37,186 @@ def isSyscallExit(trace):
         return True
     return False
 
+# Pick the syscall table to use for raw sys_enter/sys_exit numbers, the trace
+# may well have come from a different arch than the one we're running on.
+def setArch(arch=None, cache=True, header=None):
+    global syscall_table
+    syscall_table = syscalltable.SyscallTable(arch, cache, header)
+    syscall_dict.clear()
+
 def getSyscallName(sysnr):
     if sysnr not in syscall_dict:
-        output = subprocess.Popen(['ausyscall', sysnr], stdout=subprocess.PIPE).communicate()[0]
-        syscall_dict[sysnr] = output.rstrip()
+        if syscall_table is None:
+            setArch()
+        syscall_dict[sysnr] = syscall_table.name(int(sysnr))
     return syscall_dict[sysnr]
 
+# The raw_syscalls events give us a syscall number, the per-syscall events
+# give us a name, so exactly one of nr/name is set.
+class SyscallEnter(Record):
+    __slots__ = ("nr", "name", "args")
+
+    def __init__(self, nr, name, args):
+        self.nr = nr
+        self.name = name
+        self.args = args
+
+class SyscallExit(Record):
+    __slots__ = ("nr", "name", "ret")
+
+    def __init__(self, nr, name, ret):
+        self.nr = nr
+        self.name = name
+        self.ret = ret
+
+#   sys_enter: NR 13 (3, 7fff, 0, 8, 0, 0)
+def decodeRawEnter(event, data):
+    nr, sep, args = data[14:].partition(" (")
+    if not sep or not data.startswith("sys_enter: NR "):
+        return None
+    try:
+        return SyscallEnter(int(nr), None, args[:-1])
+    except ValueError:
+        return None
+
+#   sys_exit: NR 13 = 0
+def decodeRawExit(event, data):
+    nr, sep, ret = data[13:].partition(" = ")
+    if not sep or not data.startswith("sys_exit: NR "):
+        return None
+    try:
+        return SyscallExit(int(nr), None, int(ret))
+    except ValueError:
+        return None
+
+#   sys_read(fd: 3, buf: 7fff, count: 2000)
+#   sys_read -> 0x0
+def decodeSyscall(event, data):
+    i = len(event)
+    c = data[i:i+1]
+    if c == "(" and data.endswith(")"):
+        return SyscallEnter(None, event, data[i+1:-1])
+    if c == " " and data.startswith(" -> 0x", i):
+        try:
+            return SyscallExit(None, event, int(data[i+6:], 16))
+        except ValueError:
+            pass
+    return None
+
+def rawSysEnter(event, values):
+    args = ", ".join("%x" % (a & 0xffffffffffffffff) for a in values["args"])
+    return ("sys_enter: NR %d (%s)" % (values["id"], args),
+            SyscallEnter(values["id"], None, args))
+
+def rawSysExit(event, values):
+    return ("sys_exit: NR %d = %d" % (values["id"], values["ret"]),
+            SyscallExit(values["id"], None, values["ret"]))
+
+# The per-syscall events, sys_enter_read and friends
+def rawSyscall(event, values):
+    if event.startswith("sys_enter_"):
+        name = "sys_" + event[10:]
+        args = ", ".join("%s: %x" % (k, v & 0xffffffffffffffff)
+                         for k, v in values.items()
+                         if not k.startswith("common_") and k != "__syscall_nr")
+        return ("%s(%s)" % (name, args), SyscallEnter(None, name, args))
+    name = "sys_" + event[9:]
+    ret = values.get("ret", 0) & 0xffffffffffffffff
+    return ("%s -> 0x%x" % (name, ret), SyscallExit(None, name, ret))
+
+traceline.registerDecoder("sys_enter", decodeRawEnter)
+traceline.registerDecoder("sys_exit", decodeRawExit)
+traceline.registerPrefixDecoder("sys_", decodeSyscall)
+traceline.registerRawDecoder("sys_enter", rawSysEnter)
+traceline.registerRawDecoder("sys_exit", rawSysExit)
+traceline.registerRawPrefixDecoder("sys_", rawSyscall)
+
+def decodeEvent(data):
+    event = traceline.eventName(data)
+    decoder = traceline.findDecoder(event)
+    if decoder is None:
+        return None
+    return decoder(event, data)
+
 class Syscall(TraceLine):
-    def __init__(self, trace):
+    __slots__ = ("raw_format", "sysnr", "syscall", "args", "runtime", "retval")
+
+    def __init__(self, trace, event=None):
         TraceLine.__init__(self, trace)
-        m = match_raw_sys_enter_re.match(trace["data"])
-        if m:
-            self.sysnr = m.group(1)
-            self.raw_format = True
-        else:
-            m = match_sys_enter_re.match(trace["data"])
-            if m is None:
+        if event is None:
+            event = decodeEvent(trace["data"])
+            if not isinstance(event, SyscallEnter):
                 raise ValueError
-            self.raw_format = False
+        self.raw_format = event.nr is not None
         if self.raw_format:
+            self.sysnr = event.nr
             self.syscall = getSyscallName(self.sysnr)
         else:
-            self.syscall = m.group(1)
-        self.args = m.group(2)
+            self.syscall = event.name
+        self.args = event.args
         self.runtime = 0
 
-    def syscallExit(self, trace, timestamp):
-        if not isSyscallExit(trace):
-            raise TypeError
+    def syscallExit(self, trace, timestamp, event=None):
+        if event is None:
+            if not isSyscallExit(trace):
+                raise TypeError
+            event = decodeEvent(trace)
+            if not isinstance(event, SyscallExit):
+                raise TypeError
         if self.raw_format:
-            m = match_raw_sys_exit_re.match(trace)
-            if m is None:
+            if event.nr is None:
                 raise TypeError
-            if m.group(1) != self.sysnr:
+            if event.nr != self.sysnr:
                 # rt_sigreturn will show -1 for the syscall nr on return
-                if m.group(1) != "-1" or self.sysnr != "15":
+                if event.nr != -1 or self.syscall != "rt_sigreturn":
                     raise ValueError
         else:
-            m = match_sys_exit_re.match(trace)
-            if m is None:
+            if event.name is None:
                 raise TypeError
-            if m.group(1) != self.syscall:
+            if event.name != self.syscall:
                 raise ValueError
         self.runtime = float(timestamp) - self.trace["timestamp"]
-        if self.raw_format:
-            self.retval = int(m.group(2))
-        else:
-            self.retval = int(m.group(2), 16)
+        self.retval = event.ret
+
+# Pair up enters and exits from an event stream and add the latency of every
+# completed call to the calls (by syscall name) and pids tables as it exits.
+# pending holds the calls still in flight, by pid, between batches of events.
+class SyscallAggregator:
+    def __init__(self, calls, pids):
+        self.calls = calls
+        self.pids = pids
+        self.pending = {}
+        self.evicted = 0
+
+    def addEvents(self, events):
+        pending_calls = self.pending
+        calls = self.calls
+        pids = self.pids
+        for trace in events:
+            event = trace.fields
+            if isinstance(event, SyscallEnter):
+                pending_calls[trace.pid] = Syscall(trace, event)
+            elif isinstance(event, SyscallExit):
+                if trace.pid in pending_calls:
+                    call = pending_calls[trace.pid]
+                    try:
+                        call.syscallExit(trace.data, trace.timestamp, event)
+                        calls.add(call.syscall, call.runtime)
+                        pids.add(trace.pid, call.runtime)
+                    except ValueError:
+                        # do nothing, we just didn't have a match
+                        pass
+                    del pending_calls[trace.pid]
+
+    # Forget the calls of pids that alive(pid) says are gone, they're never
+    # going to exit and a long running trace would collect them forever
+    def evict(self, alive):
+        for pid in [pid for pid in self.pending if not alive(pid)]:
+            del self.pending[pid]
+            self.evicted += 1
+
+# The whole of events in one go, returns the calls still in flight at the end
+def aggregateSyscalls(events, calls, pids):
+    aggregator = SyscallAggregator(calls, pids)
+    aggregator.addEvents(events)
+    return aggregator.pending
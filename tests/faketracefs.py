@@ -0,0 +1,52 @@
+import os
+import shutil
+import tempfile
+
+# A tracing dir made out of plain files holding what the kernel shows on a
+# box nobody is tracing on.  Writing a file just replaces what's in it, which
+# is close enough to check what we write and what we put back.  eventPid
+# False makes it a kernel from before set_event_pid.
+def makeTraceDir(events=("sched/sched_switch", "sched/sched_wakeup"), eventPid=True):
+    traceDir = tempfile.mkdtemp() + "/"
+    files = {
+        "tracing_on" : "1\n",
+        "trace" : "",
+        "buffer_size_kb" : "1408\n",
+        "set_ftrace_pid" : "no pid\n",
+        "options/stacktrace" : "0\n",
+        "instances/.keep" : "",
+    }
+    if eventPid:
+        files["set_event_pid"] = ""
+        files["options/event-fork"] = "0\n"
+    for event in events:
+        files["events/"+event+"/enable"] = "0\n"
+        files["events/"+event+"/filter"] = "none\n"
+    for name, value in files.items():
+        writeFile(traceDir+name, value)
+    return traceDir
+
+def removeTraceDir(traceDir):
+    shutil.rmtree(traceDir)
+
+def readFile(path):
+    f = open(path, "r")
+    value = f.read()
+    f.close()
+    return value
+
+def writeFile(path, value):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    f = open(path, "w")
+    f.write(value)
+    f.close()
+
+# name -> contents of every file under traceDir
+def snapshot(traceDir):
+    files = {}
+    for root, dirs, names in os.walk(traceDir):
+        for name in names:
+            path = os.path.join(root, name)
+            files[os.path.relpath(path, traceDir)] = readFile(path)
+    return files
@@ -0,0 +1,60 @@
+import io
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import columnar
+import stats
+import syscall
+import tracegen
+import traceindex
+import traceline
+
+def summary(table):
+    return [(name, h.count, h.min, h.max, h.total, sorted(h.buckets.items()))
+            for name, h in table.items()]
+
+@unittest.skipUnless(columnar.available(), "needs numpy")
+class ColumnarTest(unittest.TestCase):
+    def setUp(self):
+        out = io.StringIO()
+        tracegen.generate(out, 20000, pids=16, cpus=4, seed=5)
+        self.events = list(traceline.readEvents(io.StringIO(out.getvalue())))
+        syscall.setArch("x86_64", cache=False)
+
+    def assertSameTables(self, python, numpy):
+        self.assertEqual(summary(python[0]), summary(numpy[0]))
+        self.assertEqual(summary(python[1]), summary(numpy[1]))
+
+    def test_whole_trace(self):
+        calls, pids = stats.StatsTable(), stats.StatsTable()
+        syscall.aggregateSyscalls(self.events, calls, pids)
+        self.assertSameTables((calls, pids),
+                              columnar.syscallStats(columnar.loadSyscalls(self.events)))
+
+    # The lookback only pairs up the calls that exit inside the window
+    def test_window(self):
+        start = self.events[len(self.events) // 2].timestamp
+        python = traceindex.Window(self.events, start)
+        aggregator = syscall.SyscallAggregator(stats.StatsTable(), stats.StatsTable())
+        aggregator.addEvents(python.lookback())
+        calls, pids = stats.StatsTable(), stats.StatsTable()
+        aggregator.calls = calls
+        aggregator.pids = pids
+        aggregator.addEvents(python.inside())
+
+        window = traceindex.Window(self.events, start)
+        cols = columnar.loadSyscalls(window.lookback())
+        first = len(cols)
+        self.assertTrue(first)
+        columnar.loadSyscalls(window.inside(), cols)
+        self.assertSameTables((calls, pids), columnar.syscallStats(cols, first))
+        # Calls that started before the window are in there
+        whole = columnar.syscallStats(columnar.loadSyscalls(self.events))
+        self.assertLess(sum(h.count for h in calls.values()),
+                        sum(h.count for h in whole[0].values()))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,127 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import ftrace
+import faketracefs
+
+class FilterStringTest(unittest.TestCase):
+    def test_pid_filter(self):
+        self.assertEqual(ftrace.pidFilter(["prev_pid", "next_pid"], [42]),
+                         "prev_pid == 42 || next_pid == 42")
+        self.assertEqual(ftrace.pidFilter(["pid"], [1, 2]), "pid == 1 || pid == 2")
+
+    def test_comm_filter(self):
+        self.assertEqual(ftrace.commFilter(["prev_comm", "next_comm"], "fsstress"),
+                         'prev_comm ~ "*fsstress*" || next_comm ~ "*fsstress*"')
+
+    def test_field_filter(self):
+        self.assertEqual(ftrace.fieldFilter(["common_pid"], "!=", [7]), "common_pid != 7")
+
+    def test_and_filters(self):
+        self.assertEqual(ftrace.andFilters(["pid == 1"]), "pid == 1")
+        self.assertEqual(ftrace.andFilters(["pid == 1 || pid == 2", 'comm ~ "*a*"']),
+                         '(pid == 1 || pid == 2) && (comm ~ "*a*")')
+
+class FilterFilesTest(unittest.TestCase):
+    def setUp(self):
+        self.traceDir = None
+
+    def tearDown(self):
+        ftrace.setTraceDir("")
+        if self.traceDir:
+            faketracefs.removeTraceDir(self.traceDir)
+
+    def useTraceDir(self, eventPid=True):
+        self.traceDir = faketracefs.makeTraceDir(eventPid=eventPid)
+        ftrace.setTraceDir(self.traceDir)
+
+    def read(self, name):
+        return faketracefs.readFile(self.traceDir+name)
+
+    def test_set_event_filter(self):
+        self.useTraceDir()
+        self.assertTrue(ftrace.setEventFilter("sched/sched_switch", "prev_pid == 1"))
+        self.assertEqual(self.read("events/sched/sched_switch/filter"), "prev_pid == 1")
+        self.assertTrue(ftrace.clearEventFilter("sched/sched_switch"))
+        self.assertEqual(self.read("events/sched/sched_switch/filter"), "0")
+        # No such event, the caller has to filter itself
+        self.assertFalse(ftrace.setEventFilter("sched/sched_nope", "pid == 1"))
+
+    def test_event_pids(self):
+        self.useTraceDir()
+        self.assertTrue(ftrace.filterEventPids([10, 20]))
+        self.assertEqual(self.read("set_event_pid"), "10 20")
+        self.assertEqual(self.read("options/event-fork"), "0\n")
+        self.assertTrue(ftrace.filterEventPids([10], fork=True))
+        self.assertEqual(self.read("options/event-fork"), "1")
+        ftrace.clearEventPids()
+        self.assertEqual(self.read("set_event_pid"), "")
+        self.assertEqual(self.read("options/event-fork"), "0")
+
+    def test_event_pids_missing(self):
+        self.useTraceDir(eventPid=False)
+        before = faketracefs.snapshot(self.traceDir)
+        self.assertFalse(ftrace.filterEventPids([10]))
+        self.assertFalse(ftrace.filterEventPids([10], fork=True))
+        ftrace.clearEventPids()
+        self.assertEqual(faketracefs.snapshot(self.traceDir), before)
+
+    def test_sched_pid(self):
+        self.useTraceDir()
+        ftrace.filterSchedEvents(pid=42)
+        self.assertEqual(self.read("set_event_pid"), "42")
+        # set_event_pid took it, the event filters stay alone
+        self.assertEqual(self.read("events/sched/sched_switch/filter"), "none\n")
+        self.assertEqual(self.read("events/sched/sched_wakeup/filter"), "none\n")
+
+    def test_sched_pid_fallback(self):
+        self.useTraceDir(eventPid=False)
+        ftrace.filterSchedEvents(pid=42)
+        self.assertFalse(os.path.exists(self.traceDir+"set_event_pid"))
+        self.assertEqual(self.read("events/sched/sched_switch/filter"),
+                         "prev_pid == 42 || next_pid == 42")
+        self.assertEqual(self.read("events/sched/sched_wakeup/filter"), "pid == 42")
+
+    def test_sched_pid_and_name_fallback(self):
+        self.useTraceDir(eventPid=False)
+        ftrace.filterSchedEvents(pid=42, name="fio")
+        self.assertEqual(self.read("events/sched/sched_switch/filter"),
+                         '(prev_pid == 42 || next_pid == 42) && '
+                         '(prev_comm ~ "*fio*" || next_comm ~ "*fio*")')
+        self.assertEqual(self.read("events/sched/sched_wakeup/filter"),
+                         '(pid == 42) && (comm ~ "*fio*")')
+
+    # The children don't exist yet, so there's no pid filter to fall back to
+    def test_sched_fork_fallback(self):
+        self.useTraceDir(eventPid=False)
+        ftrace.filterSchedEvents(pid=42, fork=True)
+        self.assertEqual(self.read("events/sched/sched_switch/filter"), "none\n")
+        ftrace.filterSchedEvents(pid=42, name="make", fork=True)
+        self.assertEqual(self.read("events/sched/sched_switch/filter"),
+                         'prev_comm ~ "*make*" || next_comm ~ "*make*"')
+
+    def test_sched_fork(self):
+        self.useTraceDir()
+        ftrace.filterSchedEvents(pid=42, fork=True)
+        self.assertEqual(self.read("set_event_pid"), "42")
+        self.assertEqual(self.read("options/event-fork"), "1")
+
+    # Inside a session the filters are queued up until apply()
+    def test_sched_session(self):
+        self.useTraceDir(eventPid=False)
+        session = ftrace.TraceSession(traceDir=self.traceDir).start()
+        try:
+            ftrace.filterSchedEvents(pid=42)
+            self.assertEqual(self.read("events/sched/sched_switch/filter"), "none\n")
+            self.assertEqual(session.apply(), [])
+            self.assertEqual(self.read("events/sched/sched_switch/filter"),
+                             "prev_pid == 42 || next_pid == 42")
+        finally:
+            session.restore()
+        self.assertEqual(self.read("events/sched/sched_switch/filter"), "0")
+
+if __name__ == "__main__":
+    unittest.main()
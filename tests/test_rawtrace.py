@@ -0,0 +1,191 @@
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import ftrace
+# For the sched_switch/sched_wakeup raw decoders
+import sched
+import traceline
+
+# fixtures/rawpages is a tracing dir with the formats, header_page and
+# saved_cmdlines of the box the pages were captured on, a kallsyms with the
+# functions in the stacks, and per_cpu/cpu0/trace_pipe_raw dumps of one cpu
+# (the .raw files) next to what the trace file said about the same buffer
+# (the .txt files).
+#
+# stack was sched_switch and sched_wakeup with the stacktrace option on, with
+# a task sleeping long enough in between to need a time extend record.
+# missed was a 8kb buffer in overwrite mode with lots of forks, so the first
+# page we read says how many events were overwritten before it.
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "rawpages", "")
+EVENTS = ["sched/sched_switch", "sched/sched_wakeup"]
+
+PAGE_SIZE = 4096
+DATA_OFFSET = 16
+
+def readPages(name):
+    f = open(os.path.join(FIXTURES, name + ".raw"), "rb")
+    data = f.read()
+    f.close()
+    return [data[i:i+PAGE_SIZE] for i in range(0, len(data), PAGE_SIZE)]
+
+def decodePages(pages, traceDir=FIXTURES):
+    reader = ftrace.RawTraceReader(0, EVENTS, traceDir=traceDir,
+                                   infile=open(os.devnull, "rb"), endian="<")
+    reader.symbols = ftrace.loadKallsyms(os.path.join(FIXTURES, "kallsyms"))
+    events = []
+    for page in pages:
+        events.extend(reader.decodePage(page))
+    return reader, events
+
+def textEvents(name):
+    f = open(os.path.join(FIXTURES, name + ".txt"), "r")
+    events = list(traceline.readEvents(f))
+    f.close()
+    return events
+
+def summary(trace):
+    fields = trace.fields
+    if trace.event == "sched_switch":
+        fields = (fields.prev_comm, fields.prev_pid, fields.next_comm, fields.next_pid)
+    elif trace.event == "sched_wakeup":
+        fields = (fields.comm, fields.pid, fields.cpu)
+    return (trace.pid, trace.cpu, "%.6f" % trace.timestamp, trace.event, fields)
+
+# The records of a page as (type_len, delta, bytes), and back into a page
+def pageRecords(page):
+    commit = struct.unpack_from("<Q", page, 8)[0]
+    end = DATA_OFFSET + (commit & 0xfffff)
+    records = []
+    pos = DATA_OFFSET
+    while pos < end:
+        header = struct.unpack_from("<I", page, pos)[0]
+        typeLen = header & 0x1f
+        if typeLen == ftrace.RINGBUF_TYPE_PADDING:
+            length = 4 + struct.unpack_from("<I", page, pos + 4)[0]
+        elif typeLen in (ftrace.RINGBUF_TYPE_TIME_EXTEND, ftrace.RINGBUF_TYPE_TIME_STAMP):
+            length = 8
+        elif typeLen == 0:
+            length = 4 + ((struct.unpack_from("<I", page, pos + 4)[0] + 3) & ~3)
+        else:
+            length = 4 + typeLen * 4
+        records.append((typeLen, header >> 5, page[pos:pos+length]))
+        pos += length
+    return records
+
+def buildPage(page, records, flags=0):
+    data = b"".join(r[2] for r in records)
+    header = page[:8] + struct.pack("<Q", len(data) | flags)
+    return (header + data).ljust(PAGE_SIZE, b"\0")
+
+def setDelta(record, delta):
+    typeLen, old, data = record
+    return (typeLen, delta, struct.pack("<I", (delta << 5) | typeLen) + data[4:])
+
+class RawPagesTest(unittest.TestCase):
+    def test_matches_text(self):
+        for name in ("stack", "missed"):
+            reader, events = decodePages(readPages(name))
+            text = textEvents(name)
+            self.assertEqual(reader.unknown, 0)
+            self.assertEqual([summary(e) for e in events], [summary(e) for e in text])
+
+    def test_time_extend(self):
+        pages = readPages("stack")
+        types = [r[0] for page in pages for r in pageRecords(page)]
+        self.assertIn(ftrace.RINGBUF_TYPE_TIME_EXTEND, types)
+        reader, events = decodePages(pages)
+        stamps = [e.timestamp for e in events]
+        self.assertEqual(stamps, sorted(stamps))
+        self.assertTrue(max(b - a for a, b in zip(stamps, stamps[1:])) > (1 << 27) / 1e9)
+
+    def test_stack_frames(self):
+        reader, events = decodePages(readPages("stack"))
+        stacks = [e for e in events if e.event == "<stack trace>"]
+        self.assertTrue(stacks)
+        # The stacks are deeper than the caller[8] in the format says
+        self.assertTrue(max(len(e.fields) for e in stacks) > 8)
+        self.assertEqual(stacks[0].fields[:3], ("trace_event_raw_event_sched_switch",
+                                                "__traceiter_sched_switch", "__schedule"))
+
+    # Newer kernels describe kernel_stack as caller[], size 0
+    def test_variable_stack_array(self):
+        traceDir = tempfile.mkdtemp()
+        try:
+            shutil.rmtree(traceDir)
+            shutil.copytree(FIXTURES, traceDir)
+            path = os.path.join(traceDir, "events", "ftrace", "kernel_stack", "format")
+            f = open(path, "r")
+            text = f.read()
+            f.close()
+            text = text.replace("caller[8];\toffset:16;\tsize:64;", "caller[];\toffset:16;\tsize:0;")
+            f = open(path, "w")
+            f.write(text)
+            f.close()
+            fmt = ftrace.readEventFormat("ftrace/kernel_stack", traceDir + "/")
+            self.assertIn(("caller", 16, 0, False, 0, "array"), fmt.fields)
+            reader, events = decodePages(readPages("stack"), traceDir + "/")
+        finally:
+            shutil.rmtree(traceDir)
+        reader, expected = decodePages(readPages("stack"))
+        self.assertEqual([summary(e) for e in events], [summary(e) for e in expected])
+
+    def test_missed_events(self):
+        pages = readPages("missed")
+        commit = struct.unpack_from("<Q", pages[0], 8)[0]
+        self.assertTrue(commit & ftrace.RB_MISSED_EVENTS)
+        self.assertTrue(commit & ftrace.RB_MISSED_STORED)
+        reader, events = decodePages(pages)
+        self.assertEqual(reader.missed, 1935)
+        # Without the count stored we only know something went missing
+        page = buildPage(pages[0], pageRecords(pages[0]), ftrace.RB_MISSED_EVENTS)
+        reader, events = decodePages([page])
+        self.assertEqual(reader.missed, 1)
+        reader, events = decodePages(pages[1:])
+        self.assertEqual(reader.missed, 0)
+
+    # A discarded event is left behind as padding that still carries its
+    # time delta, and a padding record with no delta ends the page.  The
+    # kernel didn't leave us either, so put them into a page we did get.
+    def test_padding(self):
+        page = readPages("stack")[-1]
+        reader, expected = decodePages([page])
+        records = pageRecords(page)
+        i = [n for n, r in enumerate(records)
+             if n and 0 < r[0] <= ftrace.RINGBUF_TYPE_DATA_TYPE_LEN_MAX and r[1] > 1][0]
+        typeLen, delta, data = records[i]
+        padding = (ftrace.RINGBUF_TYPE_PADDING, 1,
+                   struct.pack("<II", (1 << 5) | ftrace.RINGBUF_TYPE_PADDING, 12) + b"\xff" * 8)
+        records = records[:i] + [padding, setDelta(records[i], delta - 1)] + records[i+1:]
+        end = (ftrace.RINGBUF_TYPE_PADDING, 0,
+               struct.pack("<I", ftrace.RINGBUF_TYPE_PADDING) + b"\xff" * 12)
+        reader, events = decodePages([buildPage(page, records + [end])])
+        self.assertEqual([summary(e) for e in events], [summary(e) for e in expected])
+
+    # Absolute timestamps only show up with hist triggers and the like, turn
+    # the time extend of a captured page into one
+    def test_absolute_timestamp(self):
+        page = readPages("stack")[-1]
+        reader, expected = decodePages([page])
+        timestamp = struct.unpack_from("<Q", page, 0)[0]
+        records = []
+        for typeLen, delta, data in pageRecords(page):
+            if typeLen == ftrace.RINGBUF_TYPE_TIME_EXTEND:
+                timestamp += (struct.unpack_from("<I", data, 4)[0] << 27) + delta
+                stamp = struct.pack("<II", ((timestamp & ((1 << 27) - 1)) << 5) |
+                                    ftrace.RINGBUF_TYPE_TIME_STAMP, timestamp >> 27)
+                records.append((ftrace.RINGBUF_TYPE_TIME_STAMP, 0, stamp))
+                continue
+            timestamp += delta
+            records.append((typeLen, delta, data))
+        self.assertIn(ftrace.RINGBUF_TYPE_TIME_STAMP, [r[0] for r in records])
+        reader, events = decodePages([buildPage(page, records)])
+        self.assertEqual([summary(e) for e in events], [summary(e) for e in expected])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import runqueue
+import sched
+import traceline
+
+IDLE = ("swapper", 0)
+A = ("a", 1)
+B = ("b", 2)
+C = ("c", 3)
+
+def switch(t, cpu, prev, next, state="S"):
+    return traceline.TraceEvent(prev[0], prev[1], cpu, t, "sched_switch", "",
+                                sched.SchedSwitch(prev[0], prev[1], next[0], next[1], state))
+
+def wakeup(t, cpu, waker, task, target):
+    return traceline.TraceEvent(waker[0], waker[1], cpu, t, "sched_wakeup", "",
+                                sched.SchedWakeup(task[0], task[1], target))
+
+# a runs on cpu 0 and b on cpu 1, a sleeps, b wakes it onto cpu 1 where it
+# waits half a second for b to get off, b goes over to cpu 0, and a exits
+# with a wakeup still pending
+EVENTS = [
+    switch(0, 0, IDLE, A),
+    switch(0, 1, IDLE, B),
+    switch(1, 0, A, IDLE),
+    wakeup(2, 1, B, A, 1),
+    switch(2.5, 1, B, A, "R"),
+    switch(3, 0, IDLE, B),
+    wakeup(3.5, 0, B, A, 1),
+    switch(4, 1, A, IDLE, "X"),
+]
+
+class RunqueueTest(unittest.TestCase):
+    def test_cpus(self):
+        analyzer = runqueue.RunqueueAnalyzer()
+        analyzer.addEvents(EVENTS)
+        self.assertEqual(analyzer.cpus, 2)
+        self.assertEqual(analyzer.totalTime, 4.0)
+        self.assertEqual(analyzer.busy, [1.0, 4.0])
+        self.assertEqual(analyzer.idle, [2.0, 0.0])
+        # b is still on cpu 0 at the end
+        self.assertEqual(analyzer.cpuTimes(0), (2.0, 2.0))
+        self.assertEqual(analyzer.cpuTimes(1), (4.0, 0.0))
+        self.assertEqual(analyzer.current, [2, 0])
+        self.assertEqual(analyzer.switches, [3, 3])
+        self.assertEqual(analyzer.wakeups, [0, 2])
+
+    def test_runqueue_wait(self):
+        analyzer = runqueue.RunqueueAnalyzer()
+        analyzer.addEvents(EVENTS)
+        self.assertEqual(analyzer.rqWait[0].count, 0)
+        self.assertEqual(analyzer.rqWait[1].count, 1)
+        self.assertEqual(analyzer.rqWait[1].total, 0.5)
+
+    def test_migrations(self):
+        analyzer = runqueue.RunqueueAnalyzer()
+        analyzer.addEvents(EVENTS)
+        self.assertEqual(analyzer.migrations, {(0, 1): 1, (1, 0): 1})
+        self.assertEqual(analyzer.migratedIn, [1, 1])
+        self.assertEqual(analyzer.migratedOut, [1, 1])
+        self.assertEqual(analyzer.toDict()["migrations"], [[0, 1, 1], [1, 0, 1]])
+
+    # Exited tasks don't hang around in the per task state
+    def test_exit(self):
+        analyzer = runqueue.RunqueueAnalyzer()
+        analyzer.addEvents(EVENTS)
+        self.assertEqual(analyzer.lastCpu, {2: 0})
+        self.assertEqual(analyzer.waking, {})
+        analyzer.addEvents([
+            wakeup(5, 0, B, C, 0),
+            switch(6, 0, B, C, "R"),
+            switch(7, 0, C, B, "Z"),
+        ])
+        self.assertEqual(analyzer.lastCpu, {2: 0})
+        self.assertEqual(analyzer.waking, {})
+
+    # Only what happens from the start of the window counts, c's wait and
+    # cpu 0's busy time go from there
+    def test_window(self):
+        analyzer = runqueue.RunqueueAnalyzer()
+        analyzer.addEvents(EVENTS + [wakeup(5, 0, B, C, 0)])
+        analyzer.startWindow(6)
+        analyzer.addEvents([
+            switch(7, 0, B, C, "R"),
+            switch(8, 1, IDLE, B),
+        ])
+        self.assertEqual(analyzer.totalTime, 2.0)
+        self.assertEqual(analyzer.busy, [1.0, 0.0])
+        self.assertEqual(analyzer.idle, [0.0, 2.0])
+        self.assertEqual(analyzer.switches, [1, 1])
+        self.assertEqual(analyzer.wakeups, [0, 0])
+        self.assertEqual(analyzer.rqWait[0].count, 1)
+        self.assertEqual(analyzer.rqWait[0].total, 1.0)
+        self.assertEqual(analyzer.rqWait[1].count, 0)
+        self.assertEqual(analyzer.migrations, {(0, 1): 1})
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+import gzip
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# For their decoders
+import sched
+import syscall
+import tracegen
+import traceinput
+import traceline
+
+def summary(trace):
+    return (trace.comm, trace.pid, trace.cpu, trace.timestamp, trace.event,
+            trace.data, repr(trace.fields))
+
+# Generated events in both header formats with stack traces, and the sorts of
+# lines that aren't events mixed in
+def mixedTrace():
+    new = io.StringIO()
+    tracegen.generate(new, 3000, pids=8, cpus=2, seed=1, header="new")
+    old = io.StringIO()
+    tracegen.generate(old, 3000, pids=8, cpus=2, seed=2, header="old", syscalls="named")
+    lines = ["# tracer: nop\n", "#\n", "\n"]
+    noise = [
+        "not a trace line at all\n",
+        " => orphan_frame_with_no_stack\n",
+        "\n",
+        "            fish-1000  [001] .... 1500.000000: block_rq_issue: 8,0 W 4096 () 123 + 8 [fish]\n",
+        "  kworker/u16:3-2001  [003] d..2. 1500.000001: <stack trace>\n",
+        " => first\n",
+        " => second\n",
+        "CPU 1 buffer overrun\n",
+        "            fish-1000  [001] .... 1500.000002: <stack trace>\n",
+        "            fish-1000  [001] .... 1500.000003: sched_wakeup: comm=fish pid=1001 prio=120 target_cpu=002\n",
+    ]
+    for i, line in enumerate(new.getvalue().splitlines(True) + old.getvalue().splitlines(True)):
+        lines.append(line)
+        if i % 500 == 0:
+            lines.extend(noise)
+    lines.append("  kworker/u16:3-2001  [003] d..2. 2500.000001: <stack trace>\n")
+    lines.append(" => last_frame")
+    return "".join(lines)
+
+class ScanEventsTest(unittest.TestCase):
+    def setUp(self):
+        self.text = mixedTrace()
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "mixed.trace")
+        f = open(self.path, "w")
+        f.write(self.text)
+        f.close()
+        self.window = traceinput.WINDOW
+        unmatched = []
+        self.expected = [summary(e) for e in
+                         traceline.readEvents(io.StringIO(self.text), unmatched.append)]
+        self.unmatched = [line.rstrip("\n") for line in unmatched]
+
+    def tearDown(self):
+        traceinput.WINDOW = self.window
+        shutil.rmtree(self.dir)
+
+    def scan(self, path):
+        unmatched = []
+        events = [summary(e) for e in traceinput.readFile(path, unmatched.append)]
+        return events, [line.rstrip("\n") for line in unmatched]
+
+    def assertSame(self, path):
+        events, unmatched = self.scan(path)
+        self.assertEqual(len(events), len(self.expected))
+        self.assertEqual(events, self.expected)
+        self.assertEqual(unmatched, self.unmatched)
+
+    def test_sanity(self):
+        events = [e[4] for e in self.expected]
+        self.assertIn("<stack trace>", events)
+        self.assertIn("sys_enter", events)
+        self.assertIn("block_rq_issue", events)
+        self.assertEqual(self.expected[-1][4:6], ("<stack trace>", "<stack trace>"))
+        self.assertEqual(self.expected[-1][6], repr(("last_frame",)))
+        self.assertIn("not a trace line at all", self.unmatched)
+        self.assertIn(" => orphan_frame_with_no_stack", self.unmatched)
+
+    def test_mapped(self):
+        self.assertSame(self.path)
+
+    # Small windows split stacks and lines up between findall() calls
+    def test_small_windows(self):
+        for window in (4096, 1000, 97):
+            traceinput.WINDOW = window
+            self.assertSame(self.path)
+
+    def test_stream(self):
+        path = self.path + ".gz"
+        f = gzip.open(path, "wb")
+        f.write(self.text.encode("utf-8"))
+        f.close()
+        traceinput.WINDOW = 1000
+        self.assertSame(path)
+
+if __name__ == "__main__":
+    unittest.main()
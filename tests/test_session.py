@@ -0,0 +1,181 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import ftrace
+import faketracefs
+
+class TraceSessionTest(unittest.TestCase):
+    def setUp(self):
+        self.traceDir = faketracefs.makeTraceDir()
+        ftrace.setTraceDir(self.traceDir)
+        self.before = faketracefs.snapshot(self.traceDir)
+
+    def tearDown(self):
+        ftrace.setTraceDir("")
+        faketracefs.removeTraceDir(self.traceDir)
+
+    def read(self, name, traceDir=None):
+        return faketracefs.readFile((traceDir or self.traceDir)+name)
+
+    # Everything reads back the way it did before, give or take how the kernel
+    # would show what we wrote back
+    def assertRestored(self, traceDir=None):
+        after = faketracefs.snapshot(traceDir or self.traceDir)
+        self.assertEqual(sorted(after), sorted(self.before))
+        for name, value in self.before.items():
+            self.assertEqual(ftrace.normalizeSetting(name, after[name]),
+                             ftrace.normalizeSetting(name, value), name)
+
+    def startTracing(self):
+        ftrace.enableEvent("sched/sched_switch")
+        ftrace.enableEvent("sched/sched_wakeup")
+        ftrace.setEventFilter("sched/sched_switch", "prev_pid == 1")
+        ftrace.filterEventPids([1], fork=True)
+        ftrace.enableStackTrace()
+        ftrace.setBufferSizeKb(4096)
+        ftrace.clearTraceBuffer()
+        ftrace.enableFtrace()
+
+    def test_batched(self):
+        session = ftrace.TraceSession(traceDir=self.traceDir).start()
+        self.startTracing()
+        # Nothing is written until apply()
+        self.assertEqual(faketracefs.snapshot(self.traceDir), self.before)
+        self.assertEqual(session.apply(), [])
+        self.assertEqual(self.read("events/sched/sched_switch/enable"), "1")
+        self.assertEqual(self.read("events/sched/sched_switch/filter"), "prev_pid == 1")
+        self.assertEqual(self.read("set_event_pid"), "1")
+        self.assertEqual(self.read("options/event-fork"), "1")
+        self.assertEqual(self.read("options/stacktrace"), "1")
+        self.assertEqual(self.read("buffer_size_kb"), "4096")
+        # tracing_on was already on, so it's left alone, not turned off
+        # and back on again
+        self.assertEqual(self.read("tracing_on"), "1\n")
+        session.restore()
+        self.assertRestored()
+
+    def test_tracing_on_last(self):
+        faketracefs.writeFile(self.traceDir+"tracing_on", "0\n")
+        self.before = faketracefs.snapshot(self.traceDir)
+        session = ftrace.TraceSession(traceDir=self.traceDir).start()
+        ftrace.enableFtrace()
+        ftrace.enableEvent("sched/sched_switch")
+        self.assertEqual([name for name, value in session.pending][0], "tracing_on")
+        session.apply()
+        self.assertEqual(session.touched, ["events/sched/sched_switch/enable", "tracing_on"])
+        session.restore()
+        self.assertRestored()
+
+    # Once applied writes go straight through, and still get put back
+    def test_after_apply(self):
+        session = ftrace.TraceSession(traceDir=self.traceDir).start()
+        session.apply()
+        self.assertTrue(ftrace.enableEvent("sched/sched_wakeup"))
+        self.assertEqual(self.read("events/sched/sched_wakeup/enable"), "1")
+        self.assertTrue(ftrace.disableFtrace())
+        self.assertEqual(self.read("tracing_on"), "0")
+        session.restore()
+        self.assertRestored()
+
+    def test_partial_failure(self):
+        session = ftrace.TraceSession(traceDir=self.traceDir).start()
+        ftrace.enableEvent("sched/sched_switch")
+        ftrace.enableEvent("sched/sched_nope")
+        ftrace.setEventFilter("sched/sched_nope", "pid == 1")
+        ftrace.enableStackTrace()
+        ftrace.enableFtrace()
+        failed = session.apply()
+        self.assertEqual(sorted(failed), ["events/sched/sched_nope/enable",
+                                          "events/sched/sched_nope/filter"])
+        # What did go in stays in until restore()
+        self.assertEqual(self.read("events/sched/sched_switch/enable"), "1")
+        self.assertEqual(self.read("options/stacktrace"), "1")
+        session.restore()
+        self.assertRestored()
+        self.assertFalse(os.path.exists(self.traceDir+"events/sched/sched_nope"))
+
+    # A failed write through doesn't keep the ones after it from being put back
+    def test_failure_after_apply(self):
+        session = ftrace.TraceSession(traceDir=self.traceDir).start()
+        session.apply()
+        self.assertTrue(ftrace.enableStackTrace())
+        self.assertFalse(ftrace.enableEvent("sched/sched_nope"))
+        self.assertTrue(ftrace.setEventFilter("sched/sched_switch", "prev_pid == 2"))
+        session.restore()
+        self.assertRestored()
+
+    def test_restore_twice(self):
+        session = ftrace.TraceSession(traceDir=self.traceDir).start()
+        ftrace.enableStackTrace()
+        session.apply()
+        session.restore()
+        # Somebody else changes it after we're done, that's theirs
+        faketracefs.writeFile(self.traceDir+"options/stacktrace", "1\n")
+        session.restore()
+        self.assertEqual(self.read("options/stacktrace"), "1\n")
+        # And we stopped going through the session
+        self.assertTrue(ftrace.disableStackTrace())
+        self.assertEqual(self.read("options/stacktrace"), "0")
+
+    def test_context_manager(self):
+        with ftrace.TraceSession(traceDir=self.traceDir) as session:
+            self.startTracing()
+            session.apply()
+            self.assertEqual(ftrace.getTraceDir(), self.traceDir)
+        self.assertRestored()
+
+    def test_restore_on_exception(self):
+        try:
+            with ftrace.TraceSession(traceDir=self.traceDir) as session:
+                self.startTracing()
+                session.apply()
+                raise KeyboardInterrupt()
+        except KeyboardInterrupt:
+            pass
+        self.assertRestored()
+
+    def test_instance(self):
+        instanceDir = self.traceDir+"instances/pytrace-test/"
+        session = ftrace.TraceSession("pytrace-test", self.traceDir).start()
+        self.assertTrue(os.path.isdir(instanceDir))
+        self.assertTrue(session.created)
+        self.assertEqual(ftrace.getTraceDir(), instanceDir)
+        self.assertEqual(ftrace.getTraceRoot(), self.traceDir)
+        # What the kernel would have filled a new instance with
+        faketracefs.writeFile(instanceDir+"options/stacktrace", "0\n")
+        faketracefs.writeFile(instanceDir+"tracing_on", "1\n")
+        ftrace.enableStackTrace()
+        ftrace.enableFtrace()
+        session.apply()
+        # Our settings went into the instance, not the top level
+        self.assertEqual(self.read("options/stacktrace", instanceDir), "1")
+        self.assertEqual(self.read("options/stacktrace"), "0\n")
+        # The kernel takes the files with the instance, we have to do it by
+        # hand for our fake one
+        for name in ("options/stacktrace", "tracing_on"):
+            os.unlink(instanceDir+name)
+        os.rmdir(instanceDir+"options")
+        session.restore()
+        self.assertFalse(os.path.exists(instanceDir))
+        self.assertEqual(ftrace.getTraceDir(), self.traceDir)
+        self.assertRestored()
+
+    # We didn't make it, so we leave it there and put back what we changed
+    def test_existing_instance(self):
+        instanceDir = self.traceDir+"instances/shared/"
+        faketracefs.writeFile(instanceDir+"options/stacktrace", "0\n")
+        self.before = faketracefs.snapshot(self.traceDir)
+        session = ftrace.TraceSession("shared", self.traceDir).start()
+        self.assertFalse(session.created)
+        ftrace.enableStackTrace()
+        session.apply()
+        self.assertEqual(self.read("options/stacktrace", instanceDir), "1")
+        session.restore()
+        self.assertTrue(os.path.isdir(instanceDir))
+        self.assertRestored()
+
+if __name__ == "__main__":
+    unittest.main()
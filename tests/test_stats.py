@@ -0,0 +1,147 @@
+import math
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import stats
+
+PERCENTILES = (1, 10, 50, 90, 99, 99.9, 100)
+
+# The value at rank ceil(count * p / 100), which is what percentile() goes for
+def exactPercentile(values, p):
+    values = sorted(values)
+    want = max(1, int(math.ceil(len(values) * p / 100.0)))
+    return values[want - 1]
+
+# Latencies in seconds over a wide range, plus some below Histogram.lowest
+def randomValues(rand, count, zeros=0):
+    values = [math.exp(rand.uniform(math.log(1e-8), math.log(10.0))) for i in range(count)]
+    values.extend(rand.uniform(0, 1e-10) for i in range(zeros))
+    rand.shuffle(values)
+    return values
+
+def histogram(values, cls=stats.Histogram):
+    h = cls()
+    for value in values:
+        h.add(value)
+    return h
+
+class HistogramTest(unittest.TestCase):
+    def setUp(self):
+        self.rand = random.Random(11)
+
+    def assertWithinError(self, h, values):
+        for p in PERCENTILES:
+            exact = exactPercentile(values, p)
+            if exact < stats.Histogram.lowest:
+                # Everything below lowest is one bucket
+                self.assertLess(h.percentile(p), stats.Histogram.lowest)
+                continue
+            self.assertLessEqual(abs(h.percentile(p) - exact),
+                                 exact / stats.Histogram.subBuckets, p)
+
+    def test_percentile_error(self):
+        for count in (1, 2, 10, 1000, 20000):
+            values = randomValues(self.rand, count)
+            h = histogram(values)
+            self.assertWithinError(h, values)
+            self.assertEqual(h.percentile(100), max(values))
+            self.assertEqual(h.count, count)
+            self.assertEqual(h.min, min(values))
+            self.assertEqual(h.max, max(values))
+            self.assertEqual(h.total, math.fsum(values))
+
+    def test_zeros(self):
+        values = randomValues(self.rand, 500, zeros=200)
+        h = histogram(values)
+        self.assertEqual(h.zeros, 200)
+        self.assertWithinError(h, values)
+
+    def test_same_values(self):
+        h = histogram([0.25] * 100)
+        self.assertEqual(h.percentiles(), [0.25] * 4)
+
+    def test_empty(self):
+        h = stats.Histogram()
+        self.assertEqual(h.percentile(50), 0.0)
+        self.assertEqual(h.average, 0.0)
+
+    def test_bucket_index(self):
+        h = stats.Histogram()
+        for value in randomValues(self.rand, 2000):
+            i = h.bucketIndex(value)
+            self.assertLessEqual(h.bucketStart(i), value)
+            self.assertLess(value, h.bucketStart(i + 1))
+
+    # Merged in any number of pieces it's the same histogram as adding every
+    # value to one, down to the total
+    def test_merge(self):
+        values = randomValues(self.rand, 5000, zeros=50)
+        whole = histogram(values)
+        for pieces in (2, 3, 17):
+            merged = stats.Histogram()
+            for i in range(pieces):
+                merged.merge(histogram(values[i::pieces]))
+            merged.merge(stats.Histogram())
+            self.assertEqual(merged.count, whole.count)
+            self.assertEqual(merged.min, whole.min)
+            self.assertEqual(merged.max, whole.max)
+            self.assertEqual(merged.total, whole.total)
+            self.assertEqual(merged.zeros, whole.zeros)
+            self.assertEqual(merged.buckets, whole.buckets)
+            self.assertEqual(merged.percentiles(PERCENTILES), whole.percentiles(PERCENTILES))
+
+class RunningStatsTest(unittest.TestCase):
+    def test_add(self):
+        s = histogram([3.0, 1.0, 2.0], stats.RunningStats)
+        self.assertEqual((s.count, s.min, s.max, s.total, s.average), (3, 1.0, 3.0, 6.0, 2.0))
+
+    # Sums that lose everything to rounding when done naively
+    def test_total_exact(self):
+        values = [1e16, 1.0, -1e16, 1.0] * 100
+        self.assertEqual(histogram(values, stats.RunningStats).total, 200.0)
+
+    def test_merge(self):
+        rand = random.Random(3)
+        values = [rand.uniform(-1, 1) * 10 ** rand.randrange(-6, 6) for i in range(3000)]
+        whole = histogram(values, stats.RunningStats)
+        merged = stats.RunningStats()
+        merged.merge(stats.RunningStats())
+        for i in range(0, len(values), 700):
+            merged.merge(histogram(values[i:i+700], stats.RunningStats))
+        self.assertEqual((merged.count, merged.min, merged.max, merged.total),
+                         (whole.count, whole.min, whole.max, whole.total))
+
+class StatsTableTest(unittest.TestCase):
+    def test_merge(self):
+        a = stats.StatsTable()
+        b = stats.StatsTable()
+        whole = stats.StatsTable()
+        for i in range(100):
+            key = "read" if i % 3 else "write"
+            (a if i % 2 else b).add(key, i * 0.001)
+            whole.add(key, i * 0.001)
+        a.merge(b)
+        self.assertEqual(sorted(a), sorted(whole))
+        for key in whole:
+            self.assertEqual(a[key].buckets, whole[key].buckets)
+            self.assertEqual(a[key].total, whole[key].total)
+
+    def test_rolling(self):
+        table = stats.RollingTable(2)
+        table.add("read", 1.0)
+        table.rotate()
+        table.add("read", 2.0)
+        self.assertEqual(table.window()["read"].count, 2)
+        table.rotate()
+        table.add("write", 3.0)
+        window = table.window()
+        self.assertEqual(window["read"].count, 1)
+        self.assertEqual(window["read"].total, 2.0)
+        self.assertEqual(window["write"].count, 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import syscalltable
+
+HOST_UNISTD = "#define __NR_read 0\n#define __NR_write 1\n#define __NR_close 3\n"
+PPC_UNISTD = "#define __NR_restart_syscall 0\n#define __NR_exit 1\n#define __NR_read 3\n"
+
+class SyscallHeadersTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.headerPaths = syscalltable.header_paths
+        self.cacheHome = os.environ.get("XDG_CACHE_HOME")
+        os.environ["XDG_CACHE_HOME"] = os.path.join(self.dir, "cache")
+        syscalltable.header_paths = [
+            (os.path.join(self.dir, "asm", "unistd_64.h"), True),
+            (os.path.join(self.dir, "%(triplet)s-linux-gnu", "asm", "unistd_64.h"), False),
+        ]
+        self.writeHeader("asm", HOST_UNISTD)
+
+    def tearDown(self):
+        syscalltable.header_paths = self.headerPaths
+        if self.cacheHome is None:
+            del os.environ["XDG_CACHE_HOME"]
+        else:
+            os.environ["XDG_CACHE_HOME"] = self.cacheHome
+        shutil.rmtree(self.dir)
+
+    def writeHeader(self, where, text):
+        path = os.path.join(self.dir, where, "unistd_64.h")
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        f = open(path, "w")
+        f.write(text)
+        f.close()
+
+    def test_host_header(self):
+        host = syscalltable.normalizeArch(None)
+        self.assertEqual(syscalltable.readHeaders(host), {0: "read", 1: "write", 3: "close"})
+
+    # The host's header has the host's numbers, a ppc64le trace can't use them
+    def test_foreign_arch(self):
+        self.assertEqual(syscalltable.readHeaders("ppc64le"), {})
+        table = syscalltable.SyscallTable("ppc64le")
+        self.assertEqual(table.table, {})
+        self.assertFalse(os.path.exists(syscalltable.cachePath("ppc64le")))
+
+    def test_foreign_triplet(self):
+        self.writeHeader("powerpc64le-linux-gnu/asm", PPC_UNISTD)
+        table = syscalltable.SyscallTable("ppc64le")
+        self.assertEqual(table.name(0), "restart_syscall")
+        self.assertEqual(table.name(3), "read")
+        self.assertEqual(syscalltable.readCache("ppc64le"), table.table)
+        # And it comes out of the cache next time
+        os.unlink(os.path.join(self.dir, "powerpc64le-linux-gnu", "asm", "unistd_64.h"))
+        self.assertEqual(syscalltable.SyscallTable("ppc64le").table, table.table)
+
+    # Caches from before we said which arch they were for could have the
+    # host's numbers in them
+    def test_old_cache(self):
+        path = syscalltable.cachePath("ppc64le")
+        os.makedirs(os.path.dirname(path))
+        f = open(path, "w")
+        json.dump({"0": "read", "3": "close"}, f)
+        f.close()
+        self.assertEqual(syscalltable.readCache("ppc64le"), None)
+        self.assertEqual(syscalltable.SyscallTable("ppc64le").table, {})
+
+if __name__ == "__main__":
+    unittest.main()
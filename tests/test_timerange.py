@@ -0,0 +1,131 @@
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import ftrace
+
+# Ranges have whole number ends so we can check them one unit at a time: the
+# cells [x, x+1) that something covers
+def cells(ranges):
+    covered = set()
+    for start, end in ranges:
+        covered.update(range(start, end))
+    return covered
+
+def runs(covered):
+    ranges = []
+    for x in sorted(covered):
+        if ranges and ranges[-1][1] == x:
+            ranges[-1][1] = x + 1
+        else:
+            ranges.append([x, x + 1])
+    return [tuple(r) for r in ranges]
+
+def randomRanges(rand, count, order):
+    ranges = []
+    t = 0
+    for i in range(count):
+        if order == "random":
+            start = rand.randrange(2000)
+        else:
+            # Mostly in order, with some that go back a bit, and a lot that
+            # start right where the last one ended
+            t += rand.choice([0, 0, 1, 3, 10])
+            start = t
+            if rand.random() < 0.2:
+                start = max(0, t - rand.randrange(100))
+        end = start + rand.randrange(1, 40)
+        t = max(t, end)
+        ranges.append((start, end))
+    return ranges
+
+def makeRange(ranges):
+    r = ftrace.TimeRange()
+    sawPending = False
+    for start, end in ranges:
+        r.addRange(start, end)
+        sawPending = sawPending or bool(r._pending)
+    return r, sawPending
+
+class TimeRangeTest(unittest.TestCase):
+    def setUp(self):
+        self.rand = random.Random(7)
+        # Small enough that the pending buffer gets used
+        self.maxDirectInsert = ftrace.TimeRange.maxDirectInsert
+        ftrace.TimeRange.maxDirectInsert = 8
+
+    def tearDown(self):
+        ftrace.TimeRange.maxDirectInsert = self.maxDirectInsert
+
+    def assertMatches(self, r, covered):
+        self.assertEqual(list(r), runs(covered))
+        self.assertEqual(r.total, len(covered))
+        self.assertEqual(len(r), len(runs(covered)))
+
+    def test_add(self):
+        pending = False
+        for order in ("random", "mostly"):
+            for count in (1, 5, 50, 400):
+                ranges = randomRanges(self.rand, count, order)
+                r, sawPending = makeRange(ranges)
+                pending = pending or sawPending
+                self.assertMatches(r, cells(ranges))
+        self.assertTrue(pending)
+
+    def test_touching(self):
+        r, pending = makeRange([(10, 20), (0, 5), (20, 30), (5, 10), (40, 50), (30, 40)])
+        self.assertEqual(list(r), [(0, 50)])
+        self.assertEqual(r.total, 50)
+
+    # Reading total in the middle flushes the pending ranges, and adding
+    # more after that still comes out right
+    def test_read_while_pending(self):
+        ranges = randomRanges(self.rand, 300, "random")
+        r = ftrace.TimeRange()
+        for i, (start, end) in enumerate(ranges):
+            r.addRange(start, end)
+            if i % 37 == 0:
+                self.assertEqual(r.total, len(cells(ranges[:i+1])))
+        self.assertMatches(r, cells(ranges))
+
+    def test_union(self):
+        for count in (0, 3, 60, 300):
+            a = randomRanges(self.rand, count, "random")
+            b = randomRanges(self.rand, count // 2 + 1, "mostly")
+            ra, pending = makeRange(a)
+            rb, pending = makeRange(b)
+            self.assertMatches(ra.union(rb), cells(a) | cells(b))
+
+    def test_intersection(self):
+        for count in (1, 3, 60, 300):
+            a = randomRanges(self.rand, count, "random")
+            b = randomRanges(self.rand, count, "mostly")
+            # Left with ranges still pending on both sides
+            ra = ftrace.TimeRange()
+            rb = ftrace.TimeRange()
+            for start, end in a:
+                ra.addRange(start, end)
+            for start, end in b:
+                rb.addRange(start, end)
+            self.assertMatches(ra.intersection(rb), cells(a) & cells(b))
+            self.assertMatches(rb.intersection(ra), cells(a) & cells(b))
+
+    def test_total_in_window(self):
+        for order in ("random", "mostly"):
+            ranges = randomRanges(self.rand, 200, order)
+            covered = cells(ranges)
+            r = ftrace.TimeRange()
+            for start, end in ranges:
+                r.addRange(start, end)
+            for i in range(200):
+                start = self.rand.randrange(-10, 2100)
+                end = start + self.rand.randrange(0, 300)
+                self.assertEqual(r.totalInWindow(start, end),
+                                 len([x for x in covered if start <= x < end]),
+                                 (start, end))
+
+if __name__ == "__main__":
+    unittest.main()
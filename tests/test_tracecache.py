@@ -0,0 +1,165 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# For their decoders
+import sched
+import syscall
+import tracecache
+import tracegen
+import traceinput
+import traceline
+
+SCHED_EVENTS = ("sched_switch", "sched_wakeup", "<stack trace>")
+
+def summary(trace):
+    return (trace.comm, trace.pid, trace.cpu, trace.timestamp, trace.event,
+            repr(trace.fields))
+
+# The pids of every event the way the sidecar indexes them, stack traces go
+# with the event before them on their cpu
+def involved(events):
+    last = {}
+    for trace in events:
+        if trace.event == "<stack trace>":
+            pids = last.get(trace.cpu, (None, ()))
+            pids = pids[1] if pids[0] == trace.pid else set([trace.pid])
+        else:
+            pids = set([trace.pid])
+            if isinstance(trace.fields, traceline.Record):
+                for name, comm in tracecache.pidFields(trace.fields):
+                    pids.add(getattr(trace.fields, name))
+            last[trace.cpu] = (trace.pid, pids)
+        yield trace, pids
+
+class TraceCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "test.trace")
+        f = open(self.path, "w")
+        f.write("# tracer: nop\n")
+        tracegen.generate(f, 5000, pids=16, cpus=4, seed=3)
+        # Something nobody has a decoder for keeps its text
+        f.write("            fish-1000  [001] .... 2000.000000: block_rq_issue: 8,0 W 4096 () 123 + 8 [fish]\n")
+        f.close()
+        # Make the writer go through more than one chunk
+        self.chunkRows = tracecache.CHUNK_ROWS
+        tracecache.CHUNK_ROWS = 1000
+        self.expected = list(traceinput.readFile(self.path))
+
+    def tearDown(self):
+        tracecache.CHUNK_ROWS = self.chunkRows
+        shutil.rmtree(self.dir)
+
+    # Filtered reads always have the first and last rows
+    def withEnds(self, events):
+        if not events or events[0] is not self.expected[0]:
+            events = [self.expected[0]] + events
+        if events[-1] is not self.expected[-1]:
+            events = events + [self.expected[-1]]
+        return [summary(e) for e in events]
+
+    def read(self, **kw):
+        unmatched = []
+        events = list(tracecache.readEvents(self.path, unmatched.append, **kw))
+        return events, unmatched
+
+    def test_round_trip(self):
+        self.assertFalse(tracecache.hasCache(self.path))
+        parsed, unmatched = self.read()
+        self.assertTrue(tracecache.hasCache(self.path))
+        cached, cachedUnmatched = self.read()
+        self.assertEqual(cachedUnmatched, unmatched)
+        self.assertEqual([summary(e) for e in parsed], [summary(e) for e in self.expected])
+        self.assertEqual([summary(e) for e in cached], [summary(e) for e in self.expected])
+        # Only what has no decoder keeps its text
+        self.assertEqual(cached[-1].data, self.expected[-1].data)
+        self.assertEqual(cached[0].data, cached[0].event)
+        self.assertEqual(len(os.listdir(self.dir)), 2)
+
+    # However many there are, they stay out of memory and the header
+    def test_unmatched(self):
+        f = open(self.path, "a")
+        for i in range(3000):
+            f.write("garbage line %d \xe9\n" % i)
+        f.close()
+        parsed, unmatched = self.read()
+        cached, cachedUnmatched = self.read()
+        self.assertEqual(len(unmatched), 3001)
+        self.assertEqual(cachedUnmatched, unmatched)
+        self.assertEqual(cachedUnmatched[-1].rstrip(), "garbage line 2999 \xe9")
+        reader = tracecache.openCache(self.path)
+        self.assertNotIn("unmatched", reader.header)
+        self.assertLess(reader.base, 4096)
+        reader.close()
+
+    def test_stacks_shared(self):
+        self.read()
+        cached, unmatched = self.read()
+        stacks = {}
+        for trace in cached:
+            if trace.event == "<stack trace>":
+                stacks.setdefault(trace.fields, []).append(trace.fields)
+        self.assertTrue(max(len(s) for s in stacks.values()) > 1)
+        for same in stacks.values():
+            self.assertTrue(all(s is same[0] for s in same))
+
+    def test_pids(self):
+        self.read()
+        pid = 1005
+        events, unmatched = self.read(pids=[pid], wantEvent=lambda e: e in SCHED_EVENTS)
+        expected = [trace for trace, pids in involved(self.expected)
+                    if pid in pids and trace.event in SCHED_EVENTS]
+        self.assertEqual([summary(e) for e in events], self.withEnds(expected))
+
+    def test_pids_merged(self):
+        self.read()
+        pids = [1003, 1005, 1011]
+        events, unmatched = self.read(pids=pids)
+        expected = [trace for trace, involves in involved(self.expected)
+                    if involves.intersection(pids)]
+        self.assertEqual([summary(e) for e in events], self.withEnds(expected))
+
+    # Any pid that ran with the name, as the task or in the fields
+    def test_name(self):
+        self.read()
+        name = "mysql"
+        pids = set()
+        for trace in self.expected:
+            if name in trace.comm:
+                pids.add(trace.pid)
+            if isinstance(trace.fields, traceline.Record):
+                for pid, comm in tracecache.pidFields(trace.fields):
+                    if name in (getattr(trace.fields, comm, None) or ""):
+                        pids.add(getattr(trace.fields, pid))
+        self.assertTrue(pids)
+        events, unmatched = self.read(name=name)
+        expected = [trace for trace, involves in involved(self.expected)
+                    if involves.intersection(pids)]
+        self.assertEqual([summary(e) for e in events], self.withEnds(expected))
+
+    # A few events go through the event index, most of them get picked out of
+    # all the rows as we go, either way it's the same rows
+    def test_events(self):
+        self.read()
+        for wanted in (("sched_wakeup",), ("sched_switch", "<stack trace>", "sys_enter")):
+            events, unmatched = self.read(wantEvent=lambda e: e in wanted)
+            expected = [e for e in self.expected if e.event in wanted]
+            self.assertEqual([summary(e) for e in events], self.withEnds(expected))
+
+    def test_stale(self):
+        self.read()
+        f = open(self.path, "a")
+        f.write("            fish-1000  [001] .... 2000.000001: sched_wakeup: comm=fish pid=1001 prio=120 target_cpu=002\n")
+        f.close()
+        self.assertFalse(tracecache.hasCache(self.path))
+        parsed, unmatched = self.read()
+        self.assertEqual(parsed[-1].fields.pid, 1001)
+        self.assertTrue(tracecache.hasCache(self.path))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,120 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import sched
+import traceline
+import wakegraph
+
+IDLE = ("swapper", 0)
+A = ("a", 1)
+B = ("b", 2)
+C = ("c", 3)
+D = ("d", 4)
+E = ("e", 5)
+
+def switch(t, cpu, prev, next, state="S"):
+    return traceline.TraceEvent(prev[0], prev[1], cpu, t, "sched_switch", "",
+                                sched.SchedSwitch(prev[0], prev[1], next[0], next[1], state))
+
+def wakeup(t, cpu, waker, task):
+    return traceline.TraceEvent(waker[0], waker[1], cpu, t, "sched_wakeup", "",
+                                sched.SchedWakeup(task[0], task[1], cpu))
+
+# a sleeps from 0 until b wakes it at 5, and b was itself asleep from 1 until
+# c woke it at 3.  So of a's time off cpu, [1, 3] is on c, the rest up to the
+# wakeup on b, and from the wakeup to getting on cpu 0 at 6 it was runnable.
+CHAIN = [
+    switch(0, 0, A, IDLE),
+    switch(1, 1, B, C),
+    wakeup(3, 1, C, B),
+    switch(4, 1, C, B),
+    wakeup(5, 1, B, A),
+    switch(6, 0, IDLE, A),
+]
+
+class WakeGraphTest(unittest.TestCase):
+    def test_edges(self):
+        graph = wakegraph.WakeGraph()
+        graph.addEvents(CHAIN)
+        self.assertEqual(sorted(graph.edges), [(2, 1), (3, 2)])
+        self.assertEqual(graph.edges[(3, 2)].total, 2.0)
+        self.assertEqual(graph.edges[(2, 1)].total, 5.0)
+        self.assertEqual(graph.keyName(3), "c-3")
+
+    def test_critical_path(self):
+        graph = wakegraph.WakeGraph()
+        graph.addEvents(CHAIN)
+        self.assertEqual(graph.offCpu, {1: 6.0, 2: 3.0})
+        self.assertEqual(graph.criticalPath(1), [(2, 3.0), (3, 2.0), (wakegraph.RUNNABLE, 1.0)])
+        self.assertEqual(graph.criticalPath(2), [(3, 2.0), (wakegraph.RUNNABLE, 1.0)])
+        self.assertEqual(graph.criticalPath(1, 1), [(2, 3.0)])
+
+    # With depth 0 we don't walk down to c, it's all b's
+    def test_depth(self):
+        graph = wakegraph.WakeGraph(depth=0)
+        graph.addEvents(CHAIN)
+        self.assertEqual(graph.criticalPath(1), [(2, 5.0), (wakegraph.RUNNABLE, 1.0)])
+
+    def test_targets(self):
+        graph = wakegraph.WakeGraph(pid=1)
+        graph.addEvents(CHAIN)
+        self.assertEqual(sorted(graph.blame), [1])
+        graph = wakegraph.WakeGraph(name="b")
+        graph.addEvents(CHAIN)
+        self.assertEqual(sorted(graph.blame), [2])
+
+    def test_collapse(self):
+        graph = wakegraph.WakeGraph(collapse=True)
+        graph.addEvents(CHAIN)
+        self.assertEqual(sorted(graph.edges), [("b", "a"), ("c", "b")])
+        self.assertEqual(graph.criticalPath("a"),
+                         [("b", 3.0), ("c", 2.0), (wakegraph.RUNNABLE, 1.0)])
+        self.assertEqual(graph.reported, set())
+
+    # Tasks that exit take their state with them, and their comm unless
+    # they're in the graph
+    def test_exit(self):
+        graph = wakegraph.WakeGraph()
+        graph.addEvents(CHAIN + [
+            switch(7, 1, B, C),
+            switch(8, 1, C, IDLE, "X"),
+            switch(8.5, 0, A, D),
+            switch(9, 0, D, IDLE, "X"),
+        ])
+        self.assertEqual(sorted(graph.sleeping), [1, 2])
+        self.assertEqual(graph.waiting, {})
+        self.assertEqual(sorted(graph.blocked), [1, 2])
+        self.assertEqual(graph.comms, {1: "a", 2: "b", 3: "c"})
+        self.assertEqual(graph.reported, set([1, 2, 3]))
+
+    # e wakes a and exits before a gets on a cpu, the edge still has its name
+    def test_waker_exited(self):
+        graph = wakegraph.WakeGraph()
+        graph.addEvents(CHAIN + [
+            switch(7, 0, A, IDLE),
+            switch(9.5, 1, IDLE, E),
+            wakeup(10, 1, E, A),
+            switch(10.5, 1, E, IDLE, "Z"),
+            switch(11, 0, IDLE, A),
+        ])
+        self.assertIn((5, 1), graph.edges)
+        self.assertEqual(graph.edges[(5, 1)].total, 3.0)
+        self.assertEqual(graph.keyName(5), "e-5")
+        self.assertNotIn(5, graph.blocked)
+
+    # Sleeps going on at the start of the window count from there
+    def test_window(self):
+        graph = wakegraph.WakeGraph()
+        graph.addEvents(CHAIN[:2])
+        graph.startWindow(2)
+        graph.addEvents(CHAIN[2:])
+        self.assertEqual(graph.edges[(3, 2)].total, 1.0)
+        self.assertEqual(graph.edges[(2, 1)].total, 3.0)
+        self.assertEqual(graph.offCpu, {1: 4.0, 2: 2.0})
+        self.assertEqual(graph.criticalPath(1), [(2, 2.0), (3, 1.0), (wakegraph.RUNNABLE, 1.0)])
+
+if __name__ == "__main__":
+    unittest.main()
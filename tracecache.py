@@ -0,0 +1,620 @@
+import array
+import hashlib
+import heapq
+import importlib
+import json
+import marshal
+import mmap
+import operator
+import os
+import struct
+import sys
+import traceinput
+import traceline
+
+# Parsing a big text trace is most of what a run costs, and we tend to run
+# the same capture through the tools over and over with different filters.
+# The first time we parse a file we write what we got out to a binary sidecar
+# next to it (or in ~/.cache/pytrace if we can't write there), and later runs
+# of the same file read the events back from that instead.
+#
+# The sidecar is a small JSON header followed by one flat array per column
+# (timestamp, pid, cpu, comm, event, what kind of payload the row has and
+# where it starts), the marshalled payloads, the lines that didn't parse, and
+# two indexes: the rows for every pid and the rows for every event type.  It's all read through mmap, so
+# a filtered run only touches the rows it asked for, and the rows are pulled
+# out of the indexes as the events are read rather than all gathered up front.
+#
+# We don't keep the text of an event that has a decoder, just the values of
+# the record the decoder gave us, and build the record again when it's read.
+# The data of those events is only the event name, like the raw reader gives
+# events it has no decoder for, since whoever reads them goes by the fields
+# and only live capture writes the text back out.  A stack trace is kept as
+# the tuple of its functions, and a stack we've already written is pointed at
+# instead of written again.  Everything else keeps its text and goes back
+# through its decoder on the way out.
+#
+# Writing doesn't hold on to anything that grows with the trace other than
+# the pids, comms and event names.  The columns, the pid of every row and the
+# lines we couldn't parse go out to temporary files as we parse, and the
+# indexes are laid out from those when we're done.
+#
+# A row belongs to every pid it involves, not just the task that logged it, so
+# the sched_switch that puts a pid back on the cpu and the sched_wakeup of it
+# (and the waker's stack trace after it) show up when asking for that pid.
+
+MAGIC = b"PYTRACE\x01"
+VERSION = 3
+STACK_TRACE = "<stack trace>"
+
+# What a row's payload is.  Kinds from KIND_RECORD up are the record classes
+# in the header's "kinds" list, in order.
+KIND_TEXT = 0
+KIND_STACK = 1
+KIND_RECORD = 2
+
+# How many rows we hold on to before writing the columns out
+CHUNK_ROWS = 1 << 16
+# How many different stacks we remember so repeats can point at the first one
+MAX_STACKS = 1 << 14
+
+# column name, array typecode
+columns = [
+    ("timestamp", "d"),
+    ("pid", "i"),
+    ("cpu", "h"),
+    ("comm", "i"),
+    ("event", "i"),
+    ("kind", "B"),
+    ("dataOffset", "q"),
+]
+
+def sidecarPath(path, suffix=".ptcache"):
+    path = os.path.abspath(path)
+    if os.access(os.path.dirname(path), os.W_OK):
+        return path + suffix
+    base = os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+    name = hashlib.sha1(path.encode("utf-8")).hexdigest()
+    return os.path.join(base, "pytrace", name + suffix)
+
+def fileHash(path):
+    h = hashlib.sha1()
+    f = open(path, "rb")
+    while True:
+        buf = f.read(1 << 20)
+        if not buf:
+            break
+        h.update(buf)
+    f.close()
+    return h.hexdigest()
+
+# (attribute, comm attribute) of the pid fields of a payload record, pid goes
+# with comm and prev_pid with prev_comm
+pid_fields = {}
+
+def pidFields(record):
+    cls = record.__class__
+    try:
+        return pid_fields[cls]
+    except KeyError:
+        pass
+    fields = []
+    for name in getattr(cls, "__slots__", ()):
+        if name.endswith("pid"):
+            fields.append((name, name[:-3] + "comm"))
+    pid_fields[cls] = fields
+    return fields
+
+# The class called name in module, for the record kinds of a sidecar
+def recordClass(module, name):
+    mod = sys.modules.get(module)
+    if mod is None:
+        mod = importlib.import_module(module)
+    return getattr(mod, name)
+
+class CacheWriter:
+    def __init__(self, path):
+        self.path = path
+        self.tmpPath = path + ".%d.tmp" % os.getpid()
+        self.rows = 0
+        self.cols = dict((name, array.array(code)) for name, code in columns)
+        self.comms = []
+        self.commIds = {}
+        self.events = []
+        self.eventIds = {}
+        self.eventCounts = []
+        # pid -> how many rows involve it
+        self.pidCounts = {}
+        self.pidComms = {}
+        # pid, row for every pid a row involves, waiting to be written out
+        self.pidRows = array.array("i")
+        # record class -> (kind, what gets its values), None if we keep the text
+        self.kindIds = {}
+        self.kinds = []
+        # sha1 of a stack payload -> the offset we wrote it at
+        self.stacks = {}
+        self.unmatchedLength = 0
+        # cpu -> (pid, pids) of the last row logged on it, for its stack traces
+        self.lastPids = {}
+        self.dataLength = 0
+        self.files = {}
+        try:
+            names = [name for name, code in columns] + ["pidRows", "data", "unmatched"]
+            for name in names:
+                self.files[name] = open(self._tmp(name), "wb")
+        except (IOError, OSError):
+            self.abort()
+            raise
+
+    def _tmp(self, name):
+        return self.tmpPath + "." + name
+
+    def _id(self, ids, names, name):
+        try:
+            return ids[name]
+        except KeyError:
+            i = ids[name] = len(names)
+            names.append(name)
+            return i
+
+    def _kind(self, cls):
+        try:
+            return self.kindIds[cls]
+        except KeyError:
+            pass
+        kind = None
+        slots = getattr(cls, "__slots__", ())
+        # Only what we can find again by name when reading it back, and only as
+        # many as fit in the kind column
+        module = sys.modules.get(cls.__module__)
+        if (slots and getattr(module, cls.__name__, None) is cls and
+                KIND_RECORD + len(self.kinds) < 256):
+            getter = operator.attrgetter(*slots)
+            if len(slots) == 1:
+                getter = lambda record, get=getter: (get(record),)
+            kind = (KIND_RECORD + len(self.kinds), getter)
+            self.kinds.append(cls)
+        self.kindIds[cls] = kind
+        return kind
+
+    def _involve(self, pid, comm, row, pids):
+        if pid in pids:
+            return
+        pids.append(pid)
+        self.pidRows.append(pid)
+        self.pidRows.append(row)
+        self.pidCounts[pid] = self.pidCounts.get(pid, 0) + 1
+        if comm is not None:
+            comm = self._id(self.commIds, self.comms, comm)
+            comms = self.pidComms.setdefault(pid, set())
+            comms.add(comm)
+
+    # Lines that didn't parse, each one a 4 byte length and the line
+    def addUnmatched(self, line):
+        data = line.encode("utf-8", "surrogateescape")
+        self.files["unmatched"].write(struct.pack("<I", len(data)) + data)
+        self.unmatchedLength += 4 + len(data)
+
+    def _flush(self):
+        for name, code in columns:
+            self.cols[name].tofile(self.files[name])
+            del self.cols[name][:]
+        self.pidRows.tofile(self.files["pidRows"])
+        del self.pidRows[:]
+
+    def _payload(self, trace):
+        fields = trace.fields
+        if trace.event == STACK_TRACE:
+            data = marshal.dumps(tuple(fields or ()))
+            digest = hashlib.sha1(data).digest()
+            offset = self.stacks.get(digest)
+            if offset is not None:
+                return KIND_STACK, offset, None
+            if len(self.stacks) < MAX_STACKS:
+                self.stacks[digest] = self.dataLength
+            return KIND_STACK, None, data
+        if fields is not None and isinstance(fields, traceline.Record):
+            kind = self._kind(fields.__class__)
+            if kind is not None:
+                try:
+                    return kind[0], None, marshal.dumps(kind[1](fields))
+                except ValueError:
+                    pass
+        return KIND_TEXT, None, marshal.dumps(trace.data)
+
+    def add(self, trace):
+        cols = self.cols
+        row = self.rows
+        self.rows += 1
+        event = self._id(self.eventIds, self.events, trace.event)
+        if event == len(self.eventCounts):
+            self.eventCounts.append(0)
+        self.eventCounts[event] += 1
+        kind, offset, data = self._payload(trace)
+        if offset is None:
+            offset = self.dataLength
+            self.files["data"].write(data)
+            self.dataLength += len(data)
+        cols["timestamp"].append(trace.timestamp)
+        cols["pid"].append(trace.pid)
+        cols["cpu"].append(trace.cpu)
+        cols["comm"].append(self._id(self.commIds, self.comms, trace.comm))
+        cols["event"].append(event)
+        cols["kind"].append(kind)
+        cols["dataOffset"].append(offset)
+
+        pids = []
+        if trace.event == STACK_TRACE:
+            last = self.lastPids.get(trace.cpu)
+            if last is None or last[0] != trace.pid:
+                last = (trace.pid, [trace.pid])
+            for pid in last[1]:
+                self._involve(pid, None, row, pids)
+        else:
+            self._involve(trace.pid, trace.comm, row, pids)
+            fields = trace.fields
+            if fields is not None and isinstance(fields, traceline.Record):
+                for pidName, commName in pidFields(fields):
+                    self._involve(getattr(fields, pidName),
+                                  getattr(fields, commName, None), row, pids)
+            self.lastPids[trace.cpu] = (trace.pid, pids)
+        if len(cols["timestamp"]) >= CHUNK_ROWS:
+            self._flush()
+
+    def _removeTmp(self):
+        for name, f in self.files.items():
+            f.close()
+            try:
+                os.unlink(self._tmp(name))
+            except OSError:
+                pass
+
+    def abort(self):
+        self._removeTmp()
+        try:
+            os.unlink(self.tmpPath)
+        except OSError:
+            pass
+
+    def _copy(self, name, out):
+        f = open(self._tmp(name), "rb")
+        while True:
+            buf = f.read(1 << 20)
+            if not buf:
+                break
+            out.write(buf)
+        f.close()
+
+    # The arrays of a temporary file, a chunk at a time
+    def _chunks(self, name, code):
+        f = open(self._tmp(name), "rb")
+        while True:
+            buf = f.read(CHUNK_ROWS * 8)
+            if not buf:
+                break
+            arr = array.array(code)
+            arr.frombytes(buf)
+            yield arr
+        f.close()
+
+    # Every key's rows go back to back in out, in row order, starting at
+    # where the index says
+    def _fillPidRows(self, out, index):
+        next = dict((int(pid), offset) for pid, (offset, count) in index.items())
+        for pairs in self._chunks("pidRows", "i"):
+            for i in range(0, len(pairs), 2):
+                pid = pairs[i]
+                p = next[pid]
+                out[p] = pairs[i + 1]
+                next[pid] = p + 1
+
+    def _fillEventRows(self, out, index):
+        next = [index[str(event)][0] for event in range(len(self.events))]
+        row = 0
+        for events in self._chunks("event", "i"):
+            for event in events:
+                p = next[event]
+                out[p] = row
+                next[event] = p + 1
+                row += 1
+
+    def _index(self, counts):
+        index = {}
+        offset = 0
+        for key, count in counts:
+            index[str(key)] = (offset, count)
+            offset += count
+        return index, offset
+
+    def finish(self, key):
+        self._flush()
+        for f in self.files.values():
+            f.close()
+        pidIndex, pidRows = self._index(self.pidCounts.items())
+        eventIndex, eventRows = self._index(enumerate(self.eventCounts))
+        sections = [(name, code, self.rows) for name, code in columns]
+        sections.append(("pidRows", "i", pidRows))
+        sections.append(("eventRows", "i", eventRows))
+        sections.append(("data", "B", self.dataLength))
+        sections.append(("unmatched", "B", self.unmatchedLength))
+        header = {
+            "version" : VERSION,
+            "key" : key,
+            "byteorder" : sys.byteorder,
+            "rows" : self.rows,
+            "comms" : self.comms,
+            "events" : self.events,
+            "kinds" : [(cls.__module__, cls.__name__) for cls in self.kinds],
+            "pidComms" : dict((str(pid), sorted(comms))
+                              for pid, comms in self.pidComms.items()),
+            "pidIndex" : pidIndex,
+            "eventIndex" : eventIndex,
+            "sections" : {},
+        }
+        # Section offsets are relative to the end of the header so we can
+        # work them out before we know how long the header is
+        offset = 0
+        for name, code, count in sections:
+            header["sections"][name] = (offset, code, count)
+            offset += count * array.array(code).itemsize
+            offset += -offset % 8
+        text = json.dumps(header).encode("utf-8")
+        text += b" " * (-(len(MAGIC) + 8 + len(text)) % 8)
+        base = len(MAGIC) + 8 + len(text)
+
+        # The columns and payloads are copied in, the indexes are filled in
+        # through a mapping of the file
+        f = open(self.tmpPath, "w+b")
+        f.write(MAGIC)
+        f.write(struct.pack("<Q", len(text)))
+        f.write(text)
+        for name, code, count in sections:
+            if name in self.files:
+                f.seek(base + header["sections"][name][0])
+                self._copy(name, f)
+        f.truncate(base + offset)
+        f.flush()
+        m = mmap.mmap(f.fileno(), 0)
+        view = memoryview(m)
+        for name, fill, index in (("pidRows", self._fillPidRows, pidIndex),
+                                  ("eventRows", self._fillEventRows, eventIndex)):
+            start, code, count = header["sections"][name]
+            out = view[base + start:base + start + count * 4].cast("i")
+            fill(out, index)
+            out.release()
+        view.release()
+        m.flush()
+        m.close()
+        f.close()
+        self._removeTmp()
+        os.rename(self.tmpPath, self.path)
+
+class CacheReader:
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(MAGIC)] != MAGIC:
+            raise ValueError("%s isn't a trace cache" % path)
+        length = struct.unpack("<Q", self.map[len(MAGIC):len(MAGIC)+8])[0]
+        start = len(MAGIC) + 8
+        self.header = json.loads(self.map[start:start+length].decode("utf-8"))
+        if (self.header.get("version") != VERSION or
+                self.header.get("byteorder") != sys.byteorder):
+            raise ValueError("%s is from a different version" % path)
+        try:
+            self.kinds = [None] * KIND_RECORD + [recordClass(module, name)
+                                                 for module, name in self.header["kinds"]]
+        except (ImportError, AttributeError):
+            raise ValueError("%s has records we don't know about" % path)
+        self.base = start + length
+        self.rows = self.header["rows"]
+        self.comms = self.header["comms"]
+        self.events = self.header["events"]
+        view = memoryview(self.map)
+        self.sections = {}
+        for name, (offset, code, count) in self.header["sections"].items():
+            size = array.array(code).itemsize
+            s = view[self.base + offset:self.base + offset + count * size]
+            self.sections[name] = s.cast(code)
+
+    def close(self):
+        self.sections = {}
+        self.map.close()
+        self.file.close()
+
+    # The rows of all of keys in order, and only once if they're under more
+    # than one key
+    def _rows(self, index, section, keys):
+        found = []
+        for key in keys:
+            where = self.header[index].get(str(key))
+            if where is None:
+                continue
+            offset, count = where
+            found.append(self.sections[section][offset:offset + count])
+        if len(found) == 1:
+            return found[0]
+        return heapq.merge(*found)
+
+    def pidsForName(self, name):
+        comms = set(i for i, comm in enumerate(self.comms) if name in comm)
+        return [int(pid) for pid, ids in self.header["pidComms"].items()
+                if comms.intersection(ids)]
+
+    # The rows involving any of pids, and with an event that wantEvent() is
+    # happy with.  Filtered rows always include the first and last row, so
+    # anything that works out how long the trace ran still gets it right.
+    def selectRows(self, pids=None, wantEvent=None):
+        wanted = None
+        if wantEvent is not None:
+            wanted = [bool(wantEvent(e)) for e in self.events]
+            if all(wanted):
+                wanted = None
+        if pids is None and wanted is None:
+            return range(self.rows)
+        if pids is not None:
+            rows = self._rows("pidIndex", "pidRows", pids)
+        else:
+            index = self.header["eventIndex"]
+            events = [i for i, want in enumerate(wanted) if want]
+            # Going through the index only pays if it skips most of the rows
+            if sum(index[str(i)][1] for i in events) * 2 < self.rows:
+                rows = self._rows("eventIndex", "eventRows", events)
+                wanted = None
+            else:
+                rows = range(self.rows)
+        return self._select(rows, wanted)
+
+    def _select(self, rows, wanted):
+        if not self.rows:
+            return
+        event = self.sections["event"]
+        yield 0
+        last = 0
+        for row in rows:
+            if row <= last:
+                continue
+            if wanted is not None and not wanted[event[row]]:
+                continue
+            yield row
+            last = row
+        if last != self.rows - 1:
+            yield self.rows - 1
+
+    def unmatchedLines(self):
+        data = self.sections["unmatched"]
+        pos = 0
+        while pos < len(data):
+            length = struct.unpack_from("<I", data, pos)[0]
+            pos += 4
+            yield data[pos:pos + length].tobytes().decode("utf-8", "surrogateescape")
+            pos += length
+
+    def readEvents(self, rows=None, unmatched=None):
+        if unmatched:
+            for line in self.unmatchedLines():
+                unmatched(line)
+        if rows is None:
+            rows = range(self.rows)
+        s = self.sections
+        timestamp = s["timestamp"]
+        pid = s["pid"]
+        cpu = s["cpu"]
+        comm = s["comm"]
+        event = s["event"]
+        kind = s["kind"]
+        dataOffset = s["dataOffset"]
+        data = s["data"]
+        comms = self.comms
+        events = self.events
+        kinds = self.kinds
+        decoders = [traceline.findDecoder(e) for e in events]
+        # Repeats of a stack all point at the same payload, so they can all
+        # share one tuple
+        stacks = {}
+        for row in rows:
+            e = event[row]
+            k = kind[row]
+            name = events[e]
+            # marshal knows where the payload ends
+            offset = dataOffset[row]
+            payload = data[offset:]
+            if k == KIND_STACK:
+                fields = stacks.get(offset)
+                if fields is None:
+                    fields = marshal.loads(payload)
+                    if len(stacks) < MAX_STACKS:
+                        stacks[offset] = fields
+                text = STACK_TRACE
+            elif k >= KIND_RECORD:
+                fields = kinds[k](*marshal.loads(payload))
+                text = name
+            else:
+                text = marshal.loads(payload)
+                decoder = decoders[e]
+                fields = None
+                if decoder is not None:
+                    fields = decoder(name, text)
+            yield traceline.TraceEvent(comms[comm[row]], pid[row], cpu[row],
+                                       timestamp[row], name, text, fields)
+
+def fileKey(path):
+    st = os.stat(path)
+    return { "size" : st.st_size, "mtime" : st.st_mtime_ns }
+
+# The reader for path's sidecar if it has one that is still good.  A matching
+# size and mtime is good enough, if just the mtime moved we check the hash.
+def openCache(path):
+    cache = sidecarPath(path)
+    try:
+        reader = CacheReader(cache)
+    except (IOError, OSError, ValueError):
+        return None
+    key = fileKey(path)
+    cached = reader.header["key"]
+    if cached["size"] == key["size"]:
+        if cached["mtime"] == key["mtime"]:
+            return reader
+        if cached["hash"] == fileHash(path):
+            return reader
+    reader.close()
+    return None
+
+def hasCache(path):
+    reader = openCache(path)
+    if reader is None:
+        return False
+    reader.close()
+    return True
+
+# Parse path and write the sidecar as we go.  The sidecar is only written if
+# whoever is reading the events gets to the end of them.
+def parseAndCache(path, unmatched=None):
+    key = fileKey(path)
+    writer = None
+    try:
+        cache = sidecarPath(path)
+        if not os.path.isdir(os.path.dirname(cache)):
+            os.makedirs(os.path.dirname(cache))
+        writer = CacheWriter(cache)
+    except (IOError, OSError):
+        pass
+    def noMatch(line):
+        if writer:
+            writer.addUnmatched(line)
+        if unmatched:
+            unmatched(line)
+    done = False
+    try:
+        for trace in traceinput.readFile(path, noMatch):
+            if writer:
+                writer.add(trace)
+            yield trace
+        done = True
+    finally:
+        if writer:
+            try:
+                if done:
+                    key["hash"] = fileHash(path)
+                    writer.finish(key)
+                else:
+                    writer.abort()
+            except (IOError, OSError):
+                writer.abort()
+
+# Events of a single trace file, from its sidecar if it has a good one or from
+# the text otherwise (writing the sidecar while we're at it).  pids and
+# wantEvent only apply when reading from the sidecar, callers still need to do
+# their own filtering.  name picks the pids that ever ran with a comm
+# containing it.
+def readEvents(path, unmatched=None, pids=None, name=None, wantEvent=None):
+    reader = openCache(path)
+    if reader is None:
+        return parseAndCache(path, unmatched)
+    if name is not None:
+        named = reader.pidsForName(name)
+        if pids is None:
+            pids = named
+        else:
+            pids = set(pids).intersection(named)
+    return reader.readEvents(reader.selectRows(pids, wantEvent), unmatched)
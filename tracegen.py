@@ -0,0 +1,242 @@
+#!/bin/python
+
+import argparse
+import random
+import sys
+import syscalltable
+
+# Deterministic synthetic ftrace text for benchmarking.  We simulate a set of
+# tasks on a set of cpus: they make syscalls, block in some of them, wake each
+# other up and get preempted, and we log what ftrace would have shown us for
+# that as sys_enter/sys_exit (raw NR or named), sched_switch, sched_wakeup and
+# <stack trace> events.  The same arguments and seed always give the same
+# trace.
+
+comms = ["fish", "python3", "mysqld", "kworker/%d:1", "Web Content", "btrfs-transacti",
+         "systemd-journal", "sshd", "gcc", "nginx", "postgres", "rsyslogd"]
+
+# The syscalls tasks make, the ones with a True block now and then
+syscall_mix = [(0, True), (1, True), (2, False), (3, False), (4, False),
+               (5, False), (7, True), (9, False), (13, False), (14, False),
+               (16, True), (17, True), (23, True), (202, True), (232, True)]
+
+kernel_funcs = ["__schedule", "schedule", "schedule_timeout", "io_schedule",
+                "wait_for_completion", "futex_wait_queue", "futex_wait",
+                "do_futex", "__x64_sys_futex", "ep_poll", "do_epoll_wait",
+                "__x64_sys_epoll_wait", "pipe_read", "vfs_read", "ksys_read",
+                "__x64_sys_read", "unix_stream_read_generic", "sock_read_iter",
+                "do_select", "core_sys_select", "__x64_sys_select",
+                "wait_on_page_bit", "filemap_fault", "__do_fault",
+                "handle_mm_fault", "do_user_addr_fault", "exc_page_fault",
+                "btrfs_commit_transaction", "btrfs_sync_file", "do_fsync",
+                "__x64_sys_fsync", "jbd2_log_wait_commit", "ext4_sync_file",
+                "blk_mq_get_tag", "submit_bio_wait", "try_to_wake_up",
+                "wake_up_q", "futex_wake", "__wake_up_common",
+                "pipe_write", "vfs_write", "ksys_write", "__x64_sys_write",
+                "sock_def_readable", "tcp_data_queue", "tcp_rcv_established",
+                "do_syscall_64", "entry_SYSCALL_64_after_hwframe"]
+
+preempt_stack = ["__schedule", "preempt_schedule_irq", "irqentry_exit_to_user_mode",
+                 "asm_sysvec_apic_timer_interrupt"]
+idle_stack = ["__schedule", "schedule_idle", "do_idle", "cpu_startup_entry",
+              "start_secondary", "secondary_startup_64_no_verify"]
+
+class Task:
+    def __init__(self, pid, comm, cpu):
+        self.pid = pid
+        self.comm = comm
+        self.cpu = cpu
+        # "run", "ready" or "sleep"
+        self.state = "ready"
+        # (nr, named, blocks) of the syscall we're in
+        self.syscall = None
+
+def makeStacks(rand, count, depth):
+    stacks = []
+    for i in range(count):
+        d = max(3, int(rand.gauss(depth, depth / 4.0)))
+        middle = [rand.choice(kernel_funcs[2:-2]) for j in range(d - 4)]
+        stacks.append(["__schedule", "schedule"] + middle +
+                      ["do_syscall_64", "entry_SYSCALL_64_after_hwframe"])
+    return stacks
+
+class Generator:
+    def __init__(self, out, pids=64, cpus=4, depth=12, rate=200000.0, seed=1,
+                 header="new", syscalls="mixed", stacks=True, stackPool=64):
+        self.out = out
+        self.rand = random.Random(seed)
+        self.cpus = cpus
+        self.rate = rate
+        self.header = header
+        self.syscalls = syscalls
+        self.stacks = stacks
+        self.names = syscalltable.x86_64
+        self.timestamp = 1000.0
+        self.events = 0
+        self.sleepStacks = makeStacks(self.rand, stackPool, depth)
+        self.wakeStacks = makeStacks(self.rand, max(1, stackPool // 4), depth)
+        self.tasks = []
+        for i in range(pids):
+            comm = self.rand.choice(comms)
+            if "%d" in comm:
+                comm = comm % (i % cpus)
+            self.tasks.append(Task(1000 + i, comm, i % cpus))
+        self.running = [None] * cpus
+        self.sleeping = []
+
+    def write(self, comm, pid, cpu, data):
+        if self.header == "new":
+            self.out.write("%16s-%-5d [%03d] .... %.6f: %s\n" %
+                           (comm, pid, cpu, self.timestamp, data))
+        else:
+            self.out.write("%16s-%-5d [%03d] %.6f: %s\n" %
+                           (comm, pid, cpu, self.timestamp, data))
+        self.events += 1
+
+    def writeStack(self, comm, pid, cpu, frames):
+        if not self.stacks:
+            return
+        self.write(comm, pid, cpu, "<stack trace>")
+        self.out.write("".join(" => %s\n" % f for f in frames))
+
+    def current(self, cpu):
+        task = self.running[cpu]
+        if task is None:
+            return ("<idle>", 0)
+        return (task.comm, task.pid)
+
+    def enter(self, task):
+        nr, blocks = self.rand.choice(syscall_mix)
+        named = self.syscalls == "named" or \
+                (self.syscalls == "mixed" and self.rand.random() < 0.5)
+        task.syscall = (nr, named, blocks)
+        r = self.rand
+        if named:
+            self.write(task.comm, task.pid, task.cpu,
+                       "sys_%s(fd: %x, buf: %x, count: %x)" %
+                       (self.names[nr], r.randrange(64), r.randrange(1 << 40),
+                        r.randrange(1 << 16)))
+        else:
+            self.write(task.comm, task.pid, task.cpu,
+                       "sys_enter: NR %d (%x, %x, %x, %x, %x, %x)" %
+                       ((nr,) + tuple(r.randrange(1 << 32) for i in range(6))))
+
+    def exit(self, task):
+        nr, named, blocks = task.syscall
+        ret = self.rand.randrange(4096)
+        if named:
+            self.write(task.comm, task.pid, task.cpu,
+                       "sys_%s -> 0x%x" % (self.names[nr], ret))
+        else:
+            self.write(task.comm, task.pid, task.cpu,
+                       "sys_exit: NR %d = %d" % (nr, ret))
+        task.syscall = None
+
+    def switch(self, cpu, state):
+        prev = self.running[cpu]
+        ready = [t for t in self.tasks if t.state == "ready" and t.cpu == cpu]
+        if prev is not None:
+            prev.state = "sleep" if state == "S" else "ready"
+            if state == "S":
+                self.sleeping.append(prev)
+        nxt = None
+        if ready:
+            nxt = self.rand.choice(ready)
+            nxt.state = "run"
+        if prev is None and nxt is None:
+            return
+        prevComm, prevPid = ("swapper/%d" % cpu, 0) if prev is None else (prev.comm, prev.pid)
+        nextComm, nextPid = ("swapper/%d" % cpu, 0) if nxt is None else (nxt.comm, nxt.pid)
+        comm, pid = self.current(cpu)
+        self.write(comm, pid, cpu,
+                   "sched_switch: prev_comm=%s prev_pid=%d prev_prio=120 prev_state=%s ==> next_comm=%s next_pid=%d next_prio=120" %
+                   (prevComm, prevPid, state if prev is not None else "R",
+                    nextComm, nextPid))
+        if prev is None:
+            self.writeStack(comm, pid, cpu, idle_stack)
+        elif state == "S":
+            self.writeStack(comm, pid, cpu, self.rand.choice(self.sleepStacks))
+        else:
+            self.writeStack(comm, pid, cpu, preempt_stack)
+        self.running[cpu] = nxt
+
+    def wakeup(self, cpu):
+        if not self.sleeping:
+            return
+        task = self.sleeping.pop(self.rand.randrange(len(self.sleeping)))
+        task.state = "ready"
+        if self.rand.random() < 0.2:
+            task.cpu = self.rand.randrange(self.cpus)
+        comm, pid = self.current(cpu)
+        self.write(comm, pid, cpu,
+                   "sched_wakeup: comm=%s pid=%d prio=120 success=1 target_cpu=%03d" %
+                   (task.comm, task.pid, task.cpu))
+        self.writeStack(comm, pid, cpu, self.rand.choice(self.wakeStacks))
+
+    def step(self):
+        r = self.rand
+        self.timestamp += r.expovariate(self.rate)
+        cpu = r.randrange(self.cpus)
+        task = self.running[cpu]
+        if task is None:
+            if r.random() < 0.3:
+                self.wakeup(cpu)
+            else:
+                self.switch(cpu, "R")
+            return
+        x = r.random()
+        if task.syscall is None:
+            if x < 0.6:
+                self.enter(task)
+            elif x < 0.8:
+                self.wakeup(cpu)
+            else:
+                self.switch(cpu, "R")
+        elif x < 0.6 or not task.syscall[2]:
+            self.exit(task)
+        elif x < 0.9:
+            self.switch(cpu, "S")
+        else:
+            self.wakeup(cpu)
+
+    def run(self, events):
+        while self.events < events:
+            self.step()
+
+def generate(out, events, **kw):
+    g = Generator(out, **kw)
+    g.run(events)
+    return g.events
+
+def addArguments(parser):
+    parser.add_argument('-n', '--events', type=int, default=100000,
+                        help="Number of events to generate")
+    parser.add_argument('--pids', type=int, default=64, help="Number of tasks")
+    parser.add_argument('--cpus', type=int, default=4, help="Number of cpus")
+    parser.add_argument('--depth', type=int, default=12, help="Average stack depth")
+    parser.add_argument('--rate', type=float, default=200000.0,
+                        help="Events per second of trace time")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--header', choices=["new", "old"], default="new",
+                        help="With or without the irqs-off/need-resched flags")
+    parser.add_argument('--syscalls', choices=["raw", "named", "mixed"], default="mixed",
+                        help="sys_enter/sys_exit NR lines, sys_read() style lines or both")
+    parser.add_argument('--no-stacks', action='store_true',
+                        help="Don't log stack traces for switches and wakeups")
+
+def generatorOptions(args):
+    return { "pids" : args.pids, "cpus" : args.cpus, "depth" : args.depth,
+             "rate" : args.rate, "seed" : args.seed, "header" : args.header,
+             "syscalls" : args.syscalls, "stacks" : not args.no_stacks }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic ftrace text trace")
+    addArguments(parser)
+    parser.add_argument('-o', '--output', type=str, help="Write here instead of stdout")
+    args = parser.parse_args()
+    out = sys.stdout
+    if args.output:
+        out = open(args.output, "w")
+    generate(out, args.events, **generatorOptions(args))
+    if args.output:
+        out.close()
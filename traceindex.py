@@ -0,0 +1,218 @@
+#!/bin/python
+
+import argparse
+import bisect
+import json
+import mmap
+import os
+import re
+import sys
+import tracecache
+import traceinput
+
+# Seekable time index of a text trace file, so looking at a few seconds in the
+# middle of an hour long capture doesn't mean parsing the hour.  We note the
+# byte offset of the first line of every slice of trace time, and the first and
+# last timestamp of every cpu, and keep that in a small JSON sidecar next to
+# the trace (the same places tracecache puts its sidecar).  A window query
+# bisects the slices to a byte range and only reads that, starting a little
+# before the window so the syscalls and sleeps that were already going when it
+# started pair up.
+
+VERSION = 1
+# Seconds of trace time per slice
+INTERVAL = 0.1
+
+# Just enough of a trace line to get at its cpu and timestamp.  It isn't
+# anchored to the start of the line, that's a lot slower, we go back to the
+# start of the line for the few matches we keep.  The " => func" lines of stack
+# traces don't match so slices always start on an event.
+header_re = re.compile(rb"-\d+[ \t]+\[(\d+)\][ \t]+(?:\S+[ \t]+)?(\d+\.\d+): ")
+
+def indexPath(path):
+    return tracecache.sidecarPath(path, ".ptindex")
+
+def buildIndex(path, interval=INTERVAL):
+    times = []
+    offsets = []
+    cpus = {}
+    f = open(path, "rb")
+    try:
+        if os.fstat(f.fileno()).st_size:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                ints = {}
+                first = None
+                nextSlice = None
+                for match in header_re.finditer(m):
+                    cpu, timestamp = match.groups()
+                    timestamp = float(timestamp)
+                    try:
+                        cpu = ints[cpu]
+                    except KeyError:
+                        cpu = ints[cpu] = int(cpu)
+                    if first is None:
+                        first = timestamp
+                        nextSlice = timestamp
+                    if timestamp >= nextSlice:
+                        times.append(timestamp)
+                        offsets.append(m.rfind(b"\n", 0, match.start()) + 1)
+                        nextSlice = first + (int((timestamp - first) / interval) + 1) * interval
+                    seen = cpus.get(cpu)
+                    if seen is None:
+                        cpus[cpu] = [timestamp, timestamp]
+                    elif timestamp < seen[0]:
+                        seen[0] = timestamp
+                    elif timestamp > seen[1]:
+                        seen[1] = timestamp
+            finally:
+                m.close()
+    finally:
+        f.close()
+    return {
+        "version" : VERSION,
+        "key" : tracecache.fileKey(path),
+        "interval" : interval,
+        "times" : times,
+        "offsets" : offsets,
+        "cpus" : dict((str(cpu), seen) for cpu, seen in cpus.items()),
+    }
+
+def saveIndex(path, index):
+    sidecar = indexPath(path)
+    tmp = sidecar + ".%d.tmp" % os.getpid()
+    try:
+        if not os.path.isdir(os.path.dirname(sidecar)):
+            os.makedirs(os.path.dirname(sidecar))
+        f = open(tmp, "w")
+        json.dump(index, f)
+        f.close()
+        os.rename(tmp, sidecar)
+    except (IOError, OSError):
+        pass
+
+# The index of path if it has one that still matches the file
+def loadIndex(path):
+    try:
+        f = open(indexPath(path), "r")
+        index = json.load(f)
+        f.close()
+    except (IOError, OSError, ValueError):
+        return None
+    if index.get("version") != VERSION or index.get("key") != tracecache.fileKey(path):
+        return None
+    return index
+
+def getIndex(path, interval=INTERVAL):
+    index = loadIndex(path)
+    if index is None or index["interval"] != interval:
+        index = buildIndex(path, interval)
+        saveIndex(path, index)
+    return index
+
+# Before this every cpu's buffer had already been going, events from earlier
+# than that may be missing for some cpus
+def completeFrom(index):
+    if not index["cpus"]:
+        return None
+    return max(first for first, last in index["cpus"].values())
+
+# The byte range to read to see every event between start and end, either of
+# which can be None
+def windowRange(index, start=None, end=None):
+    times = index["times"]
+    offsets = index["offsets"]
+    begin = 0
+    if start is not None:
+        i = bisect.bisect_right(times, start) - 1
+        if i > 0:
+            begin = offsets[i]
+    stop = None
+    if end is not None:
+        i = bisect.bisect_right(times, end)
+        if i < len(offsets):
+            stop = offsets[i]
+    return begin, stop
+
+# The events from lookback seconds before start up to end.  Compressed files
+# can't be seeked around in, so we read those from the top but still stop at
+# the end of the window.
+def readWindow(path, start=None, end=None, lookback=1.0, unmatched=None,
+               interval=INTERVAL):
+    seekFrom = None
+    if start is not None:
+        seekFrom = start - lookback
+    if traceinput.isCompressed(path):
+        events = traceinput.readFile(path, unmatched)
+    else:
+        begin, stop = windowRange(getIndex(path, interval), seekFrom, end)
+        events = traceinput.readFile(path, unmatched, begin, stop)
+    for trace in events:
+        if seekFrom is not None and trace.timestamp < seekFrom:
+            continue
+        if end is not None and trace.timestamp > end:
+            # A little leeway for lines that are a bit out of order
+            if trace.timestamp > end + lookback:
+                break
+            continue
+        yield trace
+
+# Splits the events of readWindow() into the lookback, which callers only use
+# to know what was in flight, and the events inside the window.  lookback()
+# has to be used up before inside().
+class Window:
+    def __init__(self, events, start=None):
+        self.events = iter(events)
+        self.start = start
+        self.first = None
+
+    def lookback(self):
+        if self.start is None:
+            return
+        for trace in self.events:
+            if trace.timestamp >= self.start:
+                self.first = trace
+                return
+            yield trace
+
+    def inside(self):
+        if self.first is not None:
+            yield self.first
+            self.first = None
+        for trace in self.events:
+            yield trace
+
+# --from/--to/--lookback for the tools
+def addArguments(parser):
+    parser.add_argument('--from', dest='start', type=float,
+                        help="Only look at events from this timestamp on, uses a time index of the trace file")
+    parser.add_argument('--to', dest='end', type=float,
+                        help="Only look at events up to this timestamp")
+    parser.add_argument('--lookback', type=float, default=1.0,
+                        help="Seconds before --from to read to pair up what was already in flight")
+
+def windowed(args):
+    return args.start is not None or args.end is not None
+
+def printIndex(index):
+    times = index["times"]
+    if not times:
+        print("No events")
+        return
+    print("%d slices of %g seconds, %f to %f" %
+          (len(times), index["interval"], times[0], times[-1]))
+    for cpu in sorted(index["cpus"], key=int):
+        first, last = index["cpus"][cpu]
+        print("cpu %s: %f to %f" % (cpu, first, last))
+    print("Every cpu has events from %f" % completeFrom(index))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or show the time index of a trace file")
+    parser.add_argument('infile', help="Trace file to index")
+    parser.add_argument('--interval', type=float, default=INTERVAL,
+                        help="Seconds of trace time between index entries")
+    args = parser.parse_args()
+    if traceinput.isCompressed(args.infile):
+        print("%s is compressed, it can't be indexed" % args.infile)
+        sys.exit(1)
+    printIndex(getIndex(args.infile, args.interval))
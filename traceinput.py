@@ -0,0 +1,106 @@
+import gzip
+import lzma
+import mmap
+import os
+import traceline
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Where the offline tools get their events from.  Plain trace files are
+# mmapped and handed to traceline.scanEvents() a window at a time, straight out
+# of the page cache.  Compressed captures are streamed through their
+# decompressor in chunks, nothing gets written out to a temp file.
+
+WINDOW = 4 << 20
+
+# magic, name
+compressors = [
+    (b"\x1f\x8b", "gzip"),
+    (b"\xfd7zXZ\x00", "xz"),
+    (b"\x28\xb5\x2f\xfd", "zstd"),
+]
+
+def compression(path):
+    f = open(path, "rb")
+    head = f.read(8)
+    f.close()
+    for magic, name in compressors:
+        if head.startswith(magic):
+            return name
+    return None
+
+def openDecompressed(path, kind):
+    if kind == "gzip":
+        return gzip.open(path, "rb")
+    if kind == "xz":
+        return lzma.open(path, "rb")
+    if zstandard is None:
+        raise IOError("%s is zstd compressed, install the zstandard module to read it" % path)
+    return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"))
+
+# Windows of the file between start and end, which are expected to be on line
+# boundaries.  Every window ends just after a newline, if the file doesn't end
+# with one the last line is copied out and given one.
+def mappedWindows(path, start=0, end=None):
+    f = open(path, "rb")
+    size = os.fstat(f.fileno()).st_size
+    if end is None or end > size:
+        end = size
+    if start >= end:
+        f.close()
+        return
+    m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        pos = start
+        while pos < end:
+            stop = min(pos + WINDOW, end)
+            if stop < end:
+                nl = m.rfind(b"\n", pos, stop)
+                if nl == -1:
+                    nl = m.find(b"\n", stop, end)
+                stop = end if nl == -1 else nl + 1
+            elif m[stop-1:stop] != b"\n":
+                last = m.rfind(b"\n", pos, stop) + 1
+                if last > pos:
+                    yield (m, pos, last)
+                tail = m[max(last, pos):stop] + b"\n"
+                yield (tail, 0, len(tail))
+                break
+            yield (m, pos, stop)
+            pos = stop
+    finally:
+        m.close()
+        f.close()
+
+def streamWindows(f):
+    rest = b""
+    try:
+        while True:
+            chunk = f.read(WINDOW)
+            if not chunk:
+                break
+            buf = rest + chunk
+            nl = buf.rfind(b"\n") + 1
+            rest = buf[nl:]
+            if nl:
+                yield (buf, 0, nl)
+        if rest:
+            rest += b"\n"
+            yield (rest, 0, len(rest))
+    finally:
+        f.close()
+
+def isCompressed(path):
+    return compression(path) is not None
+
+# Events from a trace file, compressed or not.  start and end pick a byte range
+# of an uncompressed file.
+def readFile(path, unmatched=None, start=0, end=None):
+    kind = compression(path)
+    if kind is None:
+        windows = mappedWindows(path, start, end)
+    else:
+        windows = streamWindows(openDecompressed(path, kind))
+    return traceline.scanEvents(windows, unmatched)
@@ -1,4 +1,5 @@
 import re
+from sys import intern
 
 # There are two formats I've seen so far
 #       python2.7-4415  [011] .... 161710.648515: sys_exit: NR 13 = 0
@@ -7,13 +8,14 @@ import re
 # Newer versions include things like need_resched and irqs disabled whereas
 # older versions don't, so we account for both cases in our RE.
 trace_re = re.compile("\s+(.*)-(\d+)\s+\[(\d+)\] (?:....\s+|)(\d+\.\d+): (.*)$")
-stacktrace_re = re.compile(" => (.+)")
 
 def parseStacktraceLine(line):
-    m = stacktrace_re.match(line)
-    if not m:
+    if not line.startswith(" => "):
+        return None
+    func = line[4:].rstrip("\n")
+    if not func:
         return None
-    return m.group(1)
+    return func
 
 def traceParseLine(traceStr):
     m = trace_re.match(traceStr)
@@ -32,6 +34,242 @@ def isStackTrace(data):
         return True
     return False
 
-class TraceLine:
+# Base for the small parsed records.  They use __slots__ so we don't pay for a
+# dict per line, but still allow trace["pid"] style access so code written
+# against the traceParseLine() dicts keeps working.
+class Record(object):
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__,
+                           ", ".join("%s=%r" % (k, getattr(self, k, None))
+                                     for k in self.__slots__))
+
+# One parsed trace line.  event is the event name ("sched_switch", "sys_enter",
+# "sys_read", "<stack trace>"...) and fields is whatever the decoder registered
+# for that event returned, or None if nobody cares about the event.
+class TraceEvent(Record):
+    __slots__ = ("comm", "pid", "cpu", "timestamp", "event", "data", "fields")
+
+    def __init__(self, comm, pid, cpu, timestamp, event, data, fields=None):
+        # There are only so many comms, share one copy of each
+        self.comm = intern(comm)
+        self.pid = pid
+        self.cpu = cpu
+        self.timestamp = timestamp
+        self.event = event
+        self.data = data
+        self.fields = fields
+
+# Decoders are called as decoder(event, data) and return a record for the
+# payload, or None if the data didn't look like what they expected.  Prefix
+# decoders handle whole families of events (like sys_read, sys_write...), the
+# first lookup of a name resolves them and caches the result in decoders.
+decoders = {}
+prefixDecoders = []
+
+def registerDecoder(event, decoder):
+    decoders[event] = decoder
+
+def registerPrefixDecoder(prefix, decoder):
+    prefixDecoders.append((prefix, decoder))
+    # Forget any names we already resolved, they may belong to us now
+    for event in [e for e, d in decoders.items() if d is None]:
+        del decoders[event]
+
+def findDecoder(event):
+    try:
+        return decoders[event]
+    except KeyError:
+        pass
+    decoder = None
+    for prefix, d in prefixDecoders:
+        if event.startswith(prefix):
+            decoder = d
+            break
+    decoders[event] = decoder
+    return decoder
+
+# Raw decoders are the same idea for the binary trace_pipe_raw records, they
+# are called as decoder(event, values) with the dict of decoded fields from the
+# event's format file and return a (data, fields) tuple, where data is the text
+# the kernel would have printed for the event.
+rawDecoders = {}
+rawPrefixDecoders = []
+
+def registerRawDecoder(event, decoder):
+    rawDecoders[event] = decoder
+
+def registerRawPrefixDecoder(prefix, decoder):
+    rawPrefixDecoders.append((prefix, decoder))
+    for event in [e for e, d in rawDecoders.items() if d is None]:
+        del rawDecoders[event]
+
+def findRawDecoder(event):
+    try:
+        return rawDecoders[event]
+    except KeyError:
+        pass
+    decoder = None
+    for prefix, d in rawPrefixDecoders:
+        if event.startswith(prefix):
+            decoder = d
+            break
+    rawDecoders[event] = decoder
+    return decoder
+
+# Same formats as trace_re, but we also pick out the event name (the first
+# word of the data, or "<stack trace>") so parseLine doesn't need a second pass
+# to figure out what kind of line it has.  The comm is matched lazily so we
+# don't backtrack over the whole line like trace_re does.
+event_re = re.compile(r"\s*(.+?)-(\d+)\s+\[(\d+)\]\s+(?:\S+\s+)?(\d+\.\d+): ((<[^>]*>|[^:( ]+).*)")
+
+def eventName(data):
+    if data.startswith("<"):
+        return data
+    end = len(data)
+    for c in ":( ":
+        i = data.find(c, 0, end)
+        if i != -1:
+            end = i
+    return data[:end]
+
+# Parse the header once, look up the decoder for the event and hand it the
+# data.  Returns a TraceEvent or None if this isn't a trace line.
+def parseLine(line):
+    m = event_re.match(line)
+    if m is None:
+        return None
+    comm, pid, cpu, timestamp, data, event = m.groups()
+    try:
+        decoder = decoders[event]
+    except KeyError:
+        decoder = findDecoder(event)
+    fields = None
+    if decoder is not None:
+        fields = decoder(event, data)
+    return TraceEvent(comm, int(pid), int(cpu), float(timestamp), event, data,
+                      fields)
+
+# Turn an iterable of lines into TraceEvents.  The " => func" lines that follow
+# a "<stack trace>" line are folded into that event, its fields become the tuple
+# of functions, which is also what the raw reader gives us.  Lines that aren't
+# trace lines are handed to unmatched() if it's given.  An empty string (not
+# even a newline) just finishes off a pending stack trace, live readers use it
+# when the pipe goes quiet.
+def readEvents(lines, unmatched=None):
+    stack = None
+    frames = []
+    for line in lines:
+        if stack is not None:
+            # parseStacktraceLine() inlined, we see a lot of these
+            if line.startswith(" => "):
+                func = line[4:].rstrip("\n")
+                if func:
+                    frames.append(func)
+                    continue
+            stack.fields = tuple(frames)
+            yield stack
+            stack = None
+        if not line:
+            continue
+        trace = parseLine(line)
+        if trace is None:
+            if unmatched:
+                unmatched(line)
+            continue
+        if trace.event == "<stack trace>":
+            stack = trace
+            frames = []
+            continue
+        yield trace
+    if stack is not None:
+        stack.fields = tuple(frames)
+        yield stack
+
+# readEvents() for raw bytes, this is what the offline readers use.  Rather
+# than having Python split the input into lines and then matching each one we
+# let one bytes regex pick apart every line of a buffer in a single findall(),
+# and only decode the bits we need.  comms, pids and cpus repeat all the time,
+# so their conversions are cached.  windows is an iterable of (buf, start,
+# end), every window has to end with a full line (including the newline), and
+# buf can be anything that supports the buffer interface, like an mmap.
+line_re = re.compile(rb"(?:( => )([^\n]*)|[ \t]*(.+?)-(\d+)[ \t]+\[(\d+)\][ \t]+(?:\S+[ \t]+)?(\d+\.\d+): ((<[^>\n]*>|[^:( \n]+)[^\n]*)((?:\n => [^\n]+)*)|([^\n]*))\n")
+
+def scanEvents(windows, unmatched=None):
+    comms = {}
+    names = {}
+    ints = {}
+    stack = None
+    frames = []
+    for buf, start, end in windows:
+        for arrow, frame, comm, pid, cpu, timestamp, data, event, block, other in \
+                line_re.findall(buf, start, end):
+            if stack is not None:
+                if frame:
+                    frames.append(frame.decode("utf-8", "replace"))
+                    continue
+                stack.fields = tuple(frames)
+                yield stack
+                stack = None
+            if not pid:
+                if unmatched:
+                    unmatched((arrow + frame + other).decode("utf-8", "replace") + "\n")
+                continue
+            try:
+                name = names[event]
+            except KeyError:
+                name = names[event] = event.decode("utf-8", "replace")
+            try:
+                c = comms[comm]
+            except KeyError:
+                c = comms[comm] = intern(comm.decode("utf-8", "replace"))
+            try:
+                p = ints[pid]
+            except KeyError:
+                p = ints[pid] = int(pid)
+            try:
+                n = ints[cpu]
+            except KeyError:
+                n = ints[cpu] = int(cpu)
+            data = data.decode("utf-8", "replace")
+            if name == "<stack trace>":
+                # The " => func" lines came along with the match, but the
+                # stack may carry on into the next window
+                stack = TraceEvent(c, p, n, float(timestamp), name, data)
+                frames = block.decode("utf-8", "replace").split("\n => ")[1:]
+                continue
+            try:
+                decoder = decoders[name]
+            except KeyError:
+                decoder = findDecoder(name)
+            fields = None
+            if decoder is not None:
+                fields = decoder(name, data)
+            yield TraceEvent(c, p, n, float(timestamp), name, data, fields)
+            if block and unmatched:
+                for line in block.decode("utf-8", "replace").split("\n")[1:]:
+                    unmatched(line + "\n")
+    if stack is not None:
+        stack.fields = tuple(frames)
+        yield stack
+
+# The reverse of readEvents, used when we need to write out what we read
+def formatEvent(trace):
+    line = "%16s-%-5d [%03d] %.6f: %s\n" % (trace.comm, trace.pid, trace.cpu,
+                                            trace.timestamp, trace.data)
+    if trace.event == "<stack trace>" and trace.fields:
+        line += "".join(" => %s\n" % func for func in trace.fields)
+    return line
+
+class TraceLine(object):
+	__slots__ = ("trace",)
+
 	def __init__(self, trace):
 		self.trace = trace
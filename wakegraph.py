@@ -0,0 +1,227 @@
+import collections
+import report
+# For the sched_switch/sched_wakeup decoders
+import sched
+import stats
+
+# Who waits on whom.  Every time a task that went to sleep gets a sched_wakeup
+# we know which task woke it, so from sched_switch/sched_wakeup pairs we build
+# a graph with an edge from the waker to the sleeper, carrying how often that
+# happened and how long the sleeper was blocked for.  Edges are aggregated by
+# pid (or by comm with collapse), so the graph is as big as the set of tasks
+# that woke each other up, not the number of events.
+#
+# On top of that we do critical path attribution.  When a target sleeps from s
+# until B wakes it at w, B was the one doing the work during [s, w], unless B
+# was itself blocked for some of that, in which case that part of the time
+# belongs to whoever woke B, and so on down the chain.  To walk the chain we
+# keep the last few blocked intervals of every task.  The time from the wakeup
+# to actually getting on a cpu goes to RUNNABLE.
+#
+# All of the per task state goes away when sched_switch says the task exited,
+# except the comm of a task that made it into the graph, so with tasks coming
+# and going all the time we hold on to the live tasks and the graph, not
+# every task we ever saw.
+
+RUNNABLE = "<runnable>"
+
+# prev_state of a task switching out for the last time
+exit_states = ("X", "Z")
+
+# A sleep that ended with a wakeup, blocked from start until woken by waker.
+# The waker's comm comes along in case it exits before we're done with it.
+class Blocked(object):
+    __slots__ = ("start", "woken", "waker", "wakerComm")
+
+    def __init__(self, start, woken, waker, wakerComm):
+        self.start = start
+        self.woken = woken
+        self.waker = waker
+        self.wakerComm = wakerComm
+
+class WakeGraph:
+    # collapse keys everything by comm instead of pid, pid and name pick the
+    # targets we do the critical path attribution for, everybody by default.
+    # history is how many blocked intervals per task we keep to walk chains
+    # with, depth how far down a chain we go.
+    def __init__(self, collapse=False, pid=None, name=None, history=8, depth=8):
+        self.collapse = collapse
+        self.pid = pid
+        self.name = name
+        self.history = history
+        self.depth = depth
+        self.reset()
+
+    def reset(self):
+        # (waker key, sleeper key) -> stats.RunningStats of the blocked times
+        self.edges = {}
+        # target key -> key -> seconds of the target's off cpu time we put on
+        # that task, and target key -> total seconds off cpu
+        self.blame = {}
+        self.offCpu = {}
+        self.comms = {}
+        # The pids in edges and blame, their comms stay after they exit.
+        # With collapse the comms are the keys and this stays empty.
+        self.reported = set()
+        # pid -> when it switched out, pid -> Blocked for the tasks that have
+        # been woken but aren't on a cpu yet, pid -> the last few Blocked
+        self.sleeping = {}
+        self.waiting = {}
+        self.blocked = {}
+
+    # Forget what we aggregated but not what's in flight, or the history we
+    # walk the chains with.  Sleeps that were already going are counted from
+    # timestamp.
+    def startWindow(self, timestamp):
+        self.edges = {}
+        self.blame = {}
+        self.offCpu = {}
+        self.reported = set()
+        for pid, start in self.sleeping.items():
+            if start < timestamp:
+                self.sleeping[pid] = timestamp
+        for b in self.waiting.values():
+            b.start = max(b.start, timestamp)
+            b.woken = max(b.woken, timestamp)
+
+    def key(self, pid):
+        if self.collapse:
+            return self.comms.get(pid, str(pid))
+        return pid
+
+    def keyName(self, key):
+        if self.collapse or not isinstance(key, int):
+            return key
+        return "%s-%d" % (self.comms.get(key, "<unknown>"), key)
+
+    def isTarget(self, pid):
+        if self.pid and pid != self.pid:
+            return False
+        if self.name and self.comms.get(pid, "").find(self.name) == -1:
+            return False
+        return True
+
+    def addEvents(self, events):
+        for trace in events:
+            if trace.event == "sched_switch":
+                if trace.fields:
+                    self.switch(trace, trace.fields)
+            elif trace.event == "sched_wakeup":
+                if trace.fields:
+                    self.wakeEvent(trace, trace.fields)
+
+    def addEvent(self, trace):
+        if trace.event == "sched_switch":
+            if trace.fields:
+                self.switch(trace, trace.fields)
+        elif trace.event == "sched_wakeup":
+            if trace.fields:
+                self.wakeEvent(trace, trace.fields)
+
+    def wakeEvent(self, trace, event):
+        start = self.sleeping.pop(event.pid, None)
+        if start is None:
+            return
+        self.comms[trace.pid] = trace.comm
+        self.waiting[event.pid] = Blocked(start, trace.timestamp, trace.pid, trace.comm)
+
+    def switch(self, trace, event):
+        now = trace.timestamp
+        pid = event.next_pid
+        self.sleeping.pop(pid, None)
+        b = self.waiting.pop(pid, None)
+        if b is not None:
+            self.comms[pid] = event.next_comm
+            self.addBlocked(pid, b, now)
+        if event.prev_pid != 0:
+            if event.prev_state[:1] in exit_states:
+                self.exited(event.prev_pid)
+                return
+            self.comms[event.prev_pid] = event.prev_comm
+            # If it was preempted it'll come back on without a wakeup and we
+            # just forget about it
+            self.sleeping[event.prev_pid] = now
+
+    def exited(self, pid):
+        self.sleeping.pop(pid, None)
+        self.waiting.pop(pid, None)
+        self.blocked.pop(pid, None)
+        if pid not in self.reported:
+            self.comms.pop(pid, None)
+
+    # The key of whoever woke b, it may have exited since and taken its comm
+    # with it
+    def wakerKey(self, b):
+        if self.collapse:
+            return self.comms.get(b.waker, b.wakerComm)
+        if b.waker not in self.comms:
+            self.comms[b.waker] = b.wakerComm
+        self.reported.add(b.waker)
+        return b.waker
+
+    def addBlocked(self, pid, b, onCpu):
+        key = self.key(pid)
+        wakerKey = self.wakerKey(b)
+        edge = (wakerKey, key)
+        s = self.edges.get(edge)
+        if s is None:
+            s = self.edges[edge] = stats.RunningStats()
+            if not self.collapse:
+                self.reported.add(pid)
+        s.add(b.woken - b.start)
+        if self.isTarget(pid):
+            blame = self.blame.get(key)
+            if blame is None:
+                blame = self.blame[key] = {}
+            self.attribute(blame, b.waker, wakerKey, b.start, b.woken, 0)
+            blame[RUNNABLE] = blame.get(RUNNABLE, 0.0) + onCpu - b.woken
+            self.offCpu[key] = self.offCpu.get(key, 0.0) + onCpu - b.start
+        history = self.blocked.get(pid)
+        if history is None:
+            history = self.blocked[pid] = collections.deque(maxlen=self.history)
+        history.append(b)
+
+    # Spread [lo, hi] over pid, which ended it, and the tasks pid was waiting
+    # on itself in that time
+    def attribute(self, blame, pid, key, lo, hi, depth):
+        history = self.blocked.get(pid, ())
+        if depth < self.depth:
+            for b in reversed(history):
+                if b.woken > hi:
+                    continue
+                if b.woken <= lo:
+                    break
+                # Running from its wakeup on, blocked on b.waker before that
+                blame[key] = blame.get(key, 0.0) + hi - b.woken
+                start = max(lo, b.start)
+                self.attribute(blame, b.waker, self.wakerKey(b), start, b.woken, depth + 1)
+                hi = start
+                if hi <= lo:
+                    return
+        blame[key] = blame.get(key, 0.0) + hi - lo
+
+    # The (key, seconds) of the tasks that target's off cpu time went to,
+    # biggest first
+    def criticalPath(self, target, top=None):
+        path = sorted(self.blame.get(target, {}).items(),
+                      key=lambda item: item[1], reverse=True)
+        if top:
+            path = path[:top]
+        return path
+
+def printCriticalPaths(graph, top=None):
+    print("Off cpu time along the wakeup chains")
+    for target, total in sorted(graph.offCpu.items(), key=lambda item: item[1],
+                                reverse=True)[:top]:
+        print("Process %s off cpu %f seconds" % (graph.keyName(target), total))
+        for key, seconds in graph.criticalPath(target, top):
+            print("\t%f\t%6.2f%%\t%s" % (seconds, seconds * 100.0 / total if total else 0.0,
+                                         graph.keyName(key)))
+
+def printEdges(graph, top=None):
+    print("Wakeups, waker -> sleeper")
+    rows = [["Waker", "Sleeper", "Wakeups", "Total blocked", "Average blocked", "Max blocked"]]
+    for (waker, sleeper), s in report.topItems(graph.edges, "total", top):
+        rows.append([str(graph.keyName(waker)), str(graph.keyName(sleeper)),
+                     "%d" % s.count, "%f" % s.total, "%f" % s.average, "%f" % s.max])
+    report.printTable(rows)